@@ -0,0 +1,2577 @@
+#!/usr/bin/env python
+"""
+Rendering of image views without a GUI. The classes here hold the geometry of
+a view of an image in a panel of a given size, warp the image into an RGB
+array for display, and transform points into the view. keypointgui.gui shows
+them in wxPython panels, but they can also be used without a display, e.g., to
+render views in batch jobs or benchmarks. Likewise, PointSelection holds the
+state of selecting point correspondences by clicking, which both the GUI and
+the headless replay of sessions (see keypointgui.session) drive.
+
+"""
+from __future__ import division, print_function
+import collections
+import itertools
+import threading
+import numpy as np
+import cv2
+import transformations
+
+# TODO: cleaner solution for relative import handling.
+try:
+  from image_source import ImageSource, ArraySource, DownsampledSource
+except ImportError:
+  from .image_source import ImageSource, ArraySource, DownsampledSource
+
+
+def update_contrast(image, c, tile_grid_size=(10,10)):
+    clahe = cv2.createCLAHE(clipLimit=c, tileGridSize=tile_grid_size)
+    if image.ndim == 3:
+        HLS = cv2.cvtColor(image, cv2.COLOR_BGR2HLS)
+        HLS[:,:,1] = clahe.apply(HLS[:,:,1])
+        image = cv2.cvtColor(HLS, cv2.COLOR_HLS2BGR)
+    else:
+        image = clahe.apply(image)
+
+    return image
+
+
+def update_contrast_tiled(image, c, band_tiles=2, cancelled=None):
+    """Apply 'update_contrast' to an image one horizontal band at a time.
+
+    Each band spans 'band_tiles' rows of the CLAHE tile grid plus one tile row
+    of margin on either side, which is all that CLAHE needs to interpolate
+    between neighboring tile histograms. The result therefore matches
+    processing the whole image at once (up to rounding), while the temporary
+    color conversions only ever hold one band in memory, and the computation
+    can be abandoned between bands.
+
+    :param image: Image to adjust.
+    :type image: numpy.ndarray
+
+    :param c: CLAHE clip limit.
+    :type c: float
+
+    :param band_tiles: Number of tile rows produced per band.
+    :type band_tiles: int
+
+    :param cancelled: Function called between bands that returns True if the
+        result is no longer needed.
+    :type cancelled: callable | None
+
+    :return: Contrast-adjusted image, or None if cancelled.
+    :rtype: numpy.ndarray | None
+
+    """
+    tiles_x, tiles_y = 10, 10
+    height, width = image.shape[:2]
+
+    # Mirror the border that cv2.CLAHE adds when the image dimensions are not
+    # divisible by the tile grid, so that every band sees the same tile size.
+    if height % tiles_y or width % tiles_x:
+        pad_x = tiles_x - width % tiles_x
+        pad_y = tiles_y - height % tiles_y
+    else:
+        pad_x = pad_y = 0
+
+    tile_height = (height + pad_y)//tiles_y
+    if tile_height <= pad_y or band_tiles >= tiles_y:
+        return update_contrast(image, c)
+
+    out = np.empty_like(image)
+    for t0 in range(0, tiles_y, band_tiles):
+        if cancelled is not None and cancelled():
+            return None
+
+        t1 = min(t0 + band_tiles, tiles_y)
+        m0 = max(t0 - 1, 0)
+        m1 = min(t1 + 1, tiles_y)
+        y0 = m0*tile_height
+        y1 = min(m1*tile_height, height)
+
+        band = image[y0:y1]
+        pad_bottom = m1*tile_height - y1
+        if pad_x or pad_bottom:
+            band = cv2.copyMakeBorder(band, 0, pad_bottom, 0, pad_x,
+                                      cv2.BORDER_REFLECT_101)
+
+        band = update_contrast(band, c, (tiles_x, m1 - m0))
+        r0 = t0*tile_height
+        r1 = min(t1*tile_height, height)
+        out[r0:r1] = band[r0-y0:r1-y0, :width]
+
+    return out
+
+
+def contrast_pyramid(pyramid, c, preview_level=0, preview=None,
+                     cancelled=None, max_untiled_pixels=2**24):
+    """Return the pyramid of a contrast-adjusted image, as MainFrame shows it
+    when a contrast slider moves.
+
+    A preview computed from a coarse pyramid level is passed to 'preview'
+    first, so that it can be shown while the full-resolution image is
+    adjusted, which happens one band at a time for large images (see
+    update_contrast_tiled).
+
+    :param pyramid: Pyramid of the original image.
+    :type pyramid: ImagePyramid
+
+    :param c: CLAHE clip limit.
+    :type c: float
+
+    :param preview_level: Pyramid level that the preview is computed from, or
+        0 for no preview.
+    :type preview_level: int
+
+    :param preview: Function called with the pyramid of the preview.
+    :type preview: callable | None
+
+    :param cancelled: Function called between bands of a large image that
+        returns True if the result is no longer needed.
+    :type cancelled: callable | None
+
+    :param max_untiled_pixels: Images with more pixels are adjusted in bands.
+    :type max_untiled_pixels: int
+
+    :return: Pyramid of the contrast-adjusted image, or None if cancelled.
+    :rtype: ImagePyramid | None
+
+    """
+    if preview_level > 0 and preview is not None:
+        image = update_contrast(pyramid.get_level(preview_level), c)
+        preview(ImagePyramid(image, level=preview_level,
+                             shape=pyramid.shape))
+
+    image = pyramid.get_level(0)
+    if image.shape[0]*image.shape[1] > max_untiled_pixels:
+        image = update_contrast_tiled(image, c, cancelled=cancelled)
+    else:
+        image = update_contrast(image, c)
+
+    if image is None:
+        return None
+
+    return ImagePyramid(image)
+
+
+def stretch_range_to_8bit(image):
+    lower_bound = int(np.min(image))
+    upper_bound = int(np.max(image))
+    lut = np.concatenate([
+        np.zeros(lower_bound, dtype=np.uint16),
+        np.linspace(0, 255, upper_bound - lower_bound).astype(np.uint16),
+        np.ones(2**16 - upper_bound, dtype=np.uint16) * 255
+    ])
+    return lut[image].astype(np.uint8)
+
+
+class ImageHistogram(object):
+    """Histogram of the pixel values of an image, used to choose the window of
+    values that is mapped to the displayed 8-bit range.
+
+    8- and 16-bit unsigned images get one bin per value. Other types are binned
+    uniformly between their smallest and largest finite values.
+
+    Attributes:
+    :param dtype: Type of the image.
+    :type dtype: numpy.dtype
+
+    :param counts: Number of pixel values (over all channels) in each bin.
+    :type counts: numpy.ndarray
+
+    :param edges: Bin edges, one more than the number of bins.
+    :type edges: numpy.ndarray
+
+    :param lower: Smallest finite value in the image.
+    :type lower: float
+
+    :param upper: Largest finite value in the image.
+    :type upper: float
+
+    """
+    def __init__(self, image, num_bins=4096):
+        """
+        :param image: Image with any number of channels.
+        :type image: numpy.ndarray
+
+        :param num_bins: Number of bins used for types other than 8- and
+            16-bit unsigned integers.
+        :type num_bins: int
+
+        """
+        # Single-channel 2-D view, so the histogram covers all channels.
+        values = np.ascontiguousarray(image).reshape(image.shape[0], -1)
+
+        self.dtype = image.dtype
+        self.integer = image.dtype in (np.uint8, np.uint16)
+        if self.integer:
+            num_values = 2**(8*image.dtype.itemsize)
+            self.counts = cv2.calcHist([values], [0], None, [num_values],
+                                       [0, num_values]).ravel()
+            self.edges = np.arange(num_values + 1)
+            nonzero = np.flatnonzero(self.counts)
+            if len(nonzero) == 0:
+                nonzero = [0]
+
+            self.lower = float(nonzero[0])
+            self.upper = float(nonzero[-1])
+        else:
+            self.lower = float(np.nanmin(values))
+            self.upper = float(np.nanmax(values))
+            if not (np.isfinite(self.lower) and np.isfinite(self.upper)):
+                finite = values[np.isfinite(values)]
+                if len(finite) == 0:
+                    finite = np.zeros(1)
+
+                self.lower = float(finite.min())
+                self.upper = float(finite.max())
+
+            # Values outside of the range (i.e., NaN and inf) are ignored.
+            self.counts, self.edges = np.histogram(values, num_bins,
+                                                   (self.lower, self.upper))
+
+    def window(self, lower_percent=0, upper_percent=100):
+        """Return the range of values between two percentiles.
+
+        :param lower_percent: Percentage of values that are below the returned
+            lower bound.
+        :type lower_percent: float
+
+        :param upper_percent: Percentage of values that are below the returned
+            upper bound.
+        :type upper_percent: float
+
+        :return: Lower and upper bound.
+        :rtype: (float, float)
+
+        """
+        if lower_percent <= 0 and upper_percent >= 100:
+            return self.lower, self.upper
+
+        cdf = np.cumsum(self.counts)
+        last = len(self.counts) - 1
+        i = np.searchsorted(cdf, cdf[-1]*lower_percent/100, side='right')
+        j = np.searchsorted(cdf, cdf[-1]*upper_percent/100, side='left')
+        i = min(i, last)
+        j = min(j, last)
+        if self.integer:
+            return float(self.edges[i]), float(self.edges[j])
+        else:
+            return float(self.edges[i]), float(self.edges[j + 1])
+
+
+def apply_window(image, window, dst=None):
+    """Map the values of an image to 8-bit for display.
+
+    Values at or below the lower bound of the window become 0, values at or
+    above the upper bound become 255, and values in between are scaled
+    linearly. NaN values become 0.
+
+    :param image: Image of any type and number of channels.
+    :type image: numpy.ndarray
+
+    :param window: Lower and upper bound.
+    :type window: (float, float)
+
+    :param dst: Optional uint8 output array with the shape of 'image'.
+    :type dst: numpy.ndarray | None
+
+    :return: 8-bit version of the image.
+    :rtype: numpy.ndarray
+
+    """
+    lower, upper = window
+    scale = 255/max(upper - lower, 1e-12)
+
+    if image.dtype in (np.uint8, np.uint16):
+        # Table lookup, at most 64 kB, is faster than arithmetic per pixel.
+        values = np.arange(2**(8*image.dtype.itemsize), dtype=np.float32)
+        lut = np.clip((values - lower)*scale + 0.5, 0, 255).astype(np.uint8)
+        if image.dtype == np.uint8:
+            return cv2.LUT(image, lut, dst=dst)
+
+        return np.take(lut, image, out=dst)
+
+    # Saturates to the uint8 range.
+    return cv2.addWeighted(image, scale, image, 0, -lower*scale, dst=dst,
+                           dtype=cv2.CV_8U)
+
+
+def read_image(file_path):
+    """Decode an image file into an RGB(A) array at its original bit depth.
+
+    Types that OpenCV cannot warp are converted to float32.
+
+    :param file_path: Path of the image file.
+    :type file_path: str
+
+    :return: Image, or None if the file could not be decoded.
+    :rtype: numpy.ndarray | None
+
+    """
+    raw_image = cv2.imread(file_path,-1)
+
+    if raw_image is None:
+        return None
+
+    # Images are kept at their original bit depth and mapped to 8-bit for
+    # display by the panels. Types that OpenCV cannot warp are converted.
+    if raw_image.dtype not in (np.uint8, np.uint16, np.int16, np.float32,
+                               np.float64):
+        raw_image = raw_image.astype(np.float32)
+
+    if raw_image.ndim == 3:
+        # BGR to RGB.
+        if raw_image.dtype in (np.int16, np.float64):
+            raw_image = raw_image[:,:,[2,1,0,3][:raw_image.shape[2]]]
+        elif raw_image.shape[2] == 4:
+            raw_image = cv2.cvtColor(raw_image, cv2.COLOR_BGRA2RGBA)
+        else:
+            raw_image = cv2.cvtColor(raw_image, cv2.COLOR_BGR2RGB)
+
+    return raw_image
+
+
+# Source of unique keys identifying the content of images displayed in panels.
+image_keys = itertools.count()
+
+
+def homography_scale(homography, pos):
+    """Return the local scale factor of a homography at a point.
+
+    The scale is the smallest singular value of the Jacobian of the mapping
+    evaluated at 'pos', i.e., the factor by which the most-compressed direction
+    is shrunk. A value less than one indicates that the image is being
+    downsampled.
+
+    :param homography: Homography.
+    :type homography: numpy.ndarray of shape (3,3)
+
+    :param pos: Point in the input coordinate system of the homography.
+    :type pos: 2-array
+
+    :return: Local scale factor.
+    :rtype: float
+
+    """
+    pt = np.dot(homography, [pos[0],pos[1],1])
+    jacobian = (homography[:2,:2] -
+                np.outer(pt[:2]/pt[2], homography[2,:2]))/pt[2]
+    return np.linalg.svd(jacobian, compute_uv=False)[-1]
+
+
+def pixel_translation(homography0, homography1, tol=1e-7):
+    """Return the whole-pixel shift between the views of two homographies.
+
+    :param homography0: Homography of the first view.
+    :type homography0: numpy.ndarray of shape (3,3)
+
+    :param homography1: Homography of the second view.
+    :type homography1: numpy.ndarray of shape (3,3)
+
+    :return: Integer translation (dx, dy) such that 'homography1' is
+        'homography0' followed by the translation, or None if the views differ
+        by more than a whole-pixel translation.
+    :rtype: 2-tuple of int | None
+
+    """
+    h = np.dot(homography1, np.linalg.inv(homography0))
+    h = h/h[2,2]
+    dx, dy = np.round(h[:2,2])
+    if not np.allclose(h, [[1,0,dx],[0,1,dy],[0,0,1]], rtol=0, atol=tol):
+        return None
+
+    return int(dx), int(dy)
+
+
+# Names of the transform types accepted by fit_homography and the minimum number
+# of point pairs needed to fit each.
+TRANSFORM_NAMES = ('translation', 'rigid', 'similarity', 'affine', 'homography')
+TRANSFORM_MIN_POINTS = (1, 2, 2, 3, 4)
+
+
+def fit_homography(pts1, pts2, homography_type):
+    """Fit special class of homography that warps 'pts1' onto 'pts2'.
+
+    :param pts1: Source points.
+    :type pts1: Nx2 numpy.ndarray
+
+    :param pts2: Destination points.
+    :type pts2: Nx2 numpy.ndarray
+
+    :param homography_type: Integer indicating the type of homography to
+        fit (0 - translation, 1 - rigid, 2 - similarity, 3 - affine, 4 -
+        fully homography).
+    :type homography_type: int
+
+    :return: Homography.
+    :rtype: numpy.ndarray of shape (3,3)
+
+    :raises ValueError: If there are fewer than
+        TRANSFORM_MIN_POINTS[homography_type] pairs of points.
+
+    """
+    if homography_type not in range(len(TRANSFORM_NAMES)):
+        raise ValueError('Invalid homography type: {}'.format(homography_type))
+
+    n = TRANSFORM_MIN_POINTS[homography_type]
+    if pts1 is None or pts2 is None or len(pts1) < n:
+        raise ValueError('Need at least %i pairs of points for %s alignment.'
+                         % (n, TRANSFORM_NAMES[homography_type]))
+
+    if homography_type == 0:
+        # Translation.
+        delta = np.mean(pts2 - pts1, 0)
+        H = np.identity(3)
+        H[:2,2] = delta
+    elif homography_type == 1:
+        # Rigid.
+        H = transformations.affine_matrix_from_points(pts1.T, pts2.T,
+                                                      shear=False,
+                                                      scale=False)
+    elif homography_type == 2:
+        # Similarity.
+        H = transformations.affine_matrix_from_points(pts1.T, pts2.T,
+                                                      shear=False,
+                                                      scale=True)
+    elif homography_type == 3:
+        # Affine.
+        H = transformations.affine_matrix_from_points(pts1.T, pts2.T,
+                                                      shear=True,
+                                                      scale=True)
+    else:
+        # Homography.
+        H = cv2.findHomography(pts1.reshape(-1,1,2),
+                               pts2.reshape(-1,1,2))[0]
+
+    return H
+
+
+# Robust estimators accepted by fit_homography_robust.
+ROBUST_METHODS = ('ransac', 'lmeds', 'magsac')
+
+
+def transfer_errors(homography, pts1, pts2):
+    """Return the distance of each point of 'pts2' from the corresponding
+    point of 'pts1' warped by 'homography'.
+
+    :param homography: Homography that warps 'pts1' onto 'pts2'.
+    :type homography: numpy.ndarray of shape (3,3)
+
+    :type pts1: Nx2 numpy.ndarray
+
+    :type pts2: Nx2 numpy.ndarray
+
+    :rtype: N-array of float
+
+    """
+    pts = np.dot(pts1, homography[:2,:2].T) + homography[:2,2]
+    w = np.dot(pts1, homography[2,:2]) + homography[2,2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pts /= w[:,None]
+        return np.hypot(pts[:,0] - pts2[:,0], pts[:,1] - pts2[:,1])
+
+
+def _num_iterations(inlier_ratio, sample_size, confidence, max_iters):
+    """Return the number of random samples needed to draw a sample of only
+    inliers with probability 'confidence'.
+
+    """
+    p = inlier_ratio**sample_size
+    if p <= 0:
+        return max_iters
+
+    if p >= 1:
+        return 1
+
+    n = np.log(1 - confidence)/np.log(1 - p)
+    return int(min(np.ceil(n), max_iters))
+
+
+def _sample_consensus(pts1, pts2, homography_type, method, threshold,
+                      confidence, max_iters, seed):
+    """Robustly fit a homography by random sampling (see
+    fit_homography_robust).
+
+    """
+    num_points = len(pts1)
+    sample_size = TRANSFORM_MIN_POINTS[homography_type]
+    random = np.random.RandomState(seed)
+    if method == 'lmeds':
+        # Enough samples to handle up to 45% outliers, as in OpenCV.
+        num_iters = _num_iterations(0.55, sample_size, confidence, max_iters)
+    else:
+        num_iters = max_iters
+
+    best_score = np.inf
+    best_H = None
+    i = 0
+    while i < num_iters:
+        i += 1
+        sample = random.choice(num_points, sample_size, replace=False)
+        H = fit_homography(pts1[sample], pts2[sample], homography_type)
+        errors = transfer_errors(H, pts1, pts2)
+        if not np.all(np.isfinite(errors)):
+            # Degenerate sample.
+            continue
+
+        inliers = errors <= threshold
+        if method == 'ransac':
+            score = -np.count_nonzero(inliers)
+        elif method == 'lmeds':
+            score = np.median(errors**2)
+        else:
+            score = np.sum(np.minimum(errors, threshold)**2)
+
+        if score < best_score:
+            best_score = score
+            best_H = H
+            if method != 'lmeds':
+                num_iters = min(num_iters,
+                                _num_iterations(np.mean(inliers),
+                                                sample_size, confidence,
+                                                max_iters))
+
+    if best_H is None:
+        raise ValueError('The point pairs are degenerate.')
+
+    if method == 'lmeds':
+        if num_points > sample_size:
+            # Robust estimate of the standard deviation of the errors.
+            sigma = 1.4826*(1 + 5/(num_points - sample_size))*\
+                    np.sqrt(best_score)
+            threshold = max(2.5*sigma, 1e-9)
+        else:
+            threshold = np.inf
+
+    # Refine the model on all of its inliers.
+    inliers = transfer_errors(best_H, pts1, pts2) <= threshold
+    if np.count_nonzero(inliers) > sample_size:
+        H = fit_homography(pts1[inliers], pts2[inliers], homography_type)
+        refined = transfer_errors(H, pts1, pts2) <= threshold
+        if np.count_nonzero(refined) >= np.count_nonzero(inliers):
+            return H, refined
+
+    return best_H, inliers
+
+
+def fit_homography_robust(pts1, pts2, homography_type, method='ransac',
+                          threshold=3.0, confidence=0.995, max_iters=2000,
+                          seed=0):
+    """Fit special class of homography that warps 'pts1' onto 'pts2',
+    ignoring point pairs that are inconsistent with the others (outliers).
+
+    Affine transforms and homographies are fitted with OpenCV's robust
+    estimators. The other types of transforms are fitted to random minimal
+    samples of point pairs with fit_homography, with the model chosen as
+    OpenCV would for 'ransac' and 'lmeds'. For these, 'magsac' scores models by
+    the sum of squared errors truncated at 'threshold' (MSAC), which
+    approximates MAGSAC's marginalization over thresholds.
+
+    :param pts1: Source points.
+    :type pts1: Nx2 numpy.ndarray
+
+    :param pts2: Destination points.
+    :type pts2: Nx2 numpy.ndarray
+
+    :param homography_type: Integer indicating the type of homography to
+        fit (see fit_homography).
+    :type homography_type: int
+
+    :param method: Robust estimator, one of ROBUST_METHODS.
+    :type method: str
+
+    :param threshold: Maximum distance in pixels of a point of 'pts2' from
+        the warped point of 'pts1' for the pair to be an inlier. It is not used
+        by 'lmeds', which derives the threshold from the median error.
+    :type threshold: float
+
+    :param confidence: Probability with which a sample of only inliers is
+        drawn.
+    :type confidence: float
+
+    :param max_iters: Maximum number of random samples.
+    :type max_iters: int
+
+    :param seed: Seed of the random samples, so that fits are reproducible.
+    :type seed: int
+
+    :return: Homography and a boolean mask that is True for inliers.
+    :rtype: (numpy.ndarray of shape (3,3), N-array of bool)
+
+    :raises ValueError: If there are too few point pairs (see
+        fit_homography) or no model consistent with them was found.
+
+    """
+    if method not in ROBUST_METHODS:
+        raise ValueError('Invalid robust method: {}'.format(method))
+
+    if homography_type not in range(len(TRANSFORM_NAMES)):
+        raise ValueError('Invalid homography type: {}'.format(homography_type))
+
+    n = TRANSFORM_MIN_POINTS[homography_type]
+    if pts1 is None or pts2 is None or len(pts1) < n:
+        raise ValueError('Need at least %i pairs of points for %s alignment.'
+                         % (n, TRANSFORM_NAMES[homography_type]))
+
+    # OpenCV rejects non-contiguous arrays, e.g., columns of a point array.
+    pts1 = np.ascontiguousarray(pts1, dtype=np.float64)
+    pts2 = np.ascontiguousarray(pts2, dtype=np.float64)
+    if homography_type < 3:
+        return _sample_consensus(pts1, pts2, homography_type, method,
+                                 threshold, confidence, max_iters, seed)
+
+    if method == 'ransac':
+        flags = cv2.RANSAC
+    elif method == 'lmeds':
+        flags = cv2.LMEDS
+    else:
+        flags = getattr(cv2, 'USAC_MAGSAC', None)
+        if flags is None:
+            raise ValueError('MAGSAC requires OpenCV 4.5 or newer.')
+
+    cv2.setRNGSeed(seed)
+    src = pts1.reshape(-1,1,2)
+    dst = pts2.reshape(-1,1,2)
+    if homography_type == 4:
+        H, mask = cv2.findHomography(src, dst, flags, threshold,
+                                     maxIters=max_iters,
+                                     confidence=confidence)
+    else:
+        H, mask = cv2.estimateAffine2D(src, dst, method=flags,
+                                       ransacReprojThreshold=threshold,
+                                       maxIters=max_iters,
+                                       confidence=confidence)
+        if H is not None:
+            H = np.vstack([H, [0, 0, 1]])
+
+    if H is None:
+        raise ValueError('No %s consistent with the point pairs was found.'
+                         % TRANSFORM_NAMES[homography_type])
+
+    return H, mask.ravel().astype(bool)
+
+
+class ImagePyramid(object):
+    """Lazily-built, multi-resolution version of an image.
+
+    Level 0 is the original full-resolution image, and each subsequent level is
+    downsampled by a factor of two relative to the previous one using
+    cv2.pyrDown, which low-pass filters before decimating so that rendering
+    from a coarse level does not alias. Levels are only computed the first time
+    they are requested. Levels may be requested from several threads.
+
+    A pixel with coordinates (x, y) in level n corresponds to the point
+    (2**n*x, 2**n*y) in the full-resolution image.
+
+    A pyramid can also be created from a coarse level alone (e.g., a quick
+    preview computed before the full-resolution result is available). Requests
+    for finer levels then return 'base_level' instead.
+
+    When the image is an ImageSource that is read on demand, levels larger
+    than 'max_level_bytes' are DownsampledSources, so only the regions that
+    are rendered are ever read. Smaller levels are read into memory, which
+    reads all of the finer levels they are computed from, unless the source
+    stores overviews (see ImageSource.overviews). Overviews whose shape
+    matches a level are used as that level, and levels finer than an overview
+    are always read on demand, so reading the coarse levels only reads the
+    overviews.
+
+    Attributes:
+    :param num_levels: Number of levels available, including level 0.
+    :type num_levels: int
+
+    :param base_level: Finest level available.
+    :type base_level: int
+
+    """
+    def __init__(self, image, min_size=64, level=0, shape=None,
+                 max_level_bytes=64*2**20):
+        """
+        :param image: Full-resolution image, or the image at 'level'.
+        :type image: numpy.ndarray | ImageSource
+
+        :param min_size: Levels are not generated beyond the point where the
+            smaller image dimension would drop below this size.
+        :type min_size: int
+
+        :param level: Pyramid level that 'image' corresponds to.
+        :type level: int
+
+        :param shape: Shape of the full-resolution image. Required when
+            'level' is greater than zero.
+        :type shape: tuple | None
+
+        :param max_level_bytes: Largest level of an ImageSource that is read
+            into memory.
+        :type max_level_bytes: int
+
+        """
+        if isinstance(image, ArraySource):
+            image = image.array
+
+        if not isinstance(image, ImageSource):
+            # OpenCV copies arrays that are not contiguous (e.g., the [:,:,::-1]
+            # view used for BGR to RGB conversion) on every call, so make the
+            # copy once up front.
+            image = np.ascontiguousarray(image)
+
+        self._levels = [None]*level + [image]
+        self._lock = threading.Lock()
+        self.base_level = level
+        self.max_level_bytes = max_level_bytes
+
+        if shape is None:
+            assert level == 0
+            shape = image.shape
+
+        self._shape = tuple(shape)
+        height, width = shape[:2]
+        level_shapes = [(height, width)]
+        while min(height, width) >= 2*min_size:
+            height = (height + 1)//2
+            width = (width + 1)//2
+            level_shapes.append((height, width))
+
+        self.num_levels = max(len(level_shapes), level + 1)
+
+        self._overviews = {}
+        if isinstance(image, ImageSource) and level == 0:
+            for overview in image.overviews():
+                if (overview.shape[:2] in level_shapes[1:] and
+                    overview.shape[2:] == image.shape[2:] and
+                    overview.dtype == image.dtype):
+                    overview_level = level_shapes.index(overview.shape[:2])
+                    self._overviews.setdefault(overview_level, overview)
+                else:
+                    overview.close()
+
+    @property
+    def overview_levels(self):
+        """Levels that are read from overviews stored with the image.
+
+        """
+        return sorted(self._overviews)
+
+    @property
+    def shape(self):
+        """Shape of the full-resolution image.
+
+        """
+        return self._shape
+
+    def get_level(self, level):
+        """Return pyramid level, building any missing levels as needed.
+
+        :param level: Requested level, which is clamped to the valid range.
+        :type level: int
+
+        :return: Image at the requested level.
+        :rtype: numpy.ndarray | ImageSource
+
+        """
+        level = int(np.clip(level, self.base_level, self.num_levels - 1))
+        with self._lock:
+            while len(self._levels) <= level:
+                self._levels.append(self._downsample(self._levels[-1]))
+
+        return self._levels[level]
+
+    @classmethod
+    def from_levels(cls, levels, min_size=64):
+        """Create a pyramid from levels that were already computed.
+
+        :param levels: Pyramid levels, finest first. Levels beyond these are
+            computed as needed.
+        :type levels: list of numpy.ndarray
+
+        """
+        pyramid = cls(levels[0], min_size)
+        pyramid._levels = list(levels[:pyramid.num_levels])
+        return pyramid
+
+    def _downsample(self, image):
+        level = len(self._levels)
+        if level in self._overviews:
+            downsampled = self._overviews[level]
+        elif isinstance(image, np.ndarray):
+            return cv2.pyrDown(image)
+        else:
+            downsampled = DownsampledSource(image)
+
+        if any(l > level for l in self._overviews):
+            return downsampled
+
+        if (downsampled.nbytes <= self.max_level_bytes or
+            level == self.num_levels - 1):
+            return downsampled.read()
+
+        return downsampled
+
+    def in_memory_level(self):
+        """Return the finest level that is held in memory as a numpy.ndarray,
+        reading it if needed.
+
+        """
+        for level in range(self.base_level, self.num_levels):
+            if isinstance(self.get_level(level), np.ndarray):
+                return level
+
+    def level_for_scale(self, scale):
+        """Return the coarsest level that still has at least one pixel per
+        output pixel when rendered at 'scale'.
+
+        :param scale: Number of output pixels per full-resolution pixel.
+        :type scale: float
+
+        """
+        if scale >= 1:
+            return self.base_level
+
+        level = int(np.floor(np.log2(1/scale)))
+        return int(np.clip(level, self.base_level, self.num_levels - 1))
+
+
+class PointGridIndex(object):
+    """Uniform-grid spatial index over a set of 2-D points.
+
+    Points are bucketed into square cells and stored sorted by cell, so the
+    points in any run of cells along one grid row are contiguous. A rectangle
+    query touches one slice per grid row it spans, and its cost is
+    proportional to the number of rows spanned plus the number of points
+    returned.
+
+    The index holds a reference to the point array rather than a copy. Points
+    appended since the grid was last built form an unsorted tail that is
+    scanned linearly, and the grid is rebuilt lazily once the tail grows past
+    'max_tail'. Changing or removing trailing points only shortens the prefix
+    of points that the grid is trusted for, so adding and removing the last
+    point are O(1).
+
+    Points with non-finite coordinates are never returned.
+
+    """
+    def __init__(self, points=None, max_tail=4096):
+        """
+        :param points: Points to index.
+        :type points: Nx2 numpy.ndarray | None
+
+        :param max_tail: Number of points not covered by the grid before it is
+            rebuilt.
+        :type max_tail: int
+
+        """
+        self.max_tail = max_tail
+        self._points = np.zeros((0,2))
+        self._num_indexed = 0
+        self._order = np.zeros(0, dtype=np.int64)
+        self._keys = np.zeros(0, dtype=np.int64)
+        self.update(points)
+
+    def __len__(self):
+        return len(self._points)
+
+    def update(self, points, num_unchanged=0):
+        """Replace the indexed points.
+
+        :param points: Points to index. The array is referenced, not copied,
+            so it must not be modified in place without calling 'update'.
+        :type points: Nx2 numpy.ndarray | None
+
+        :param num_unchanged: Number of leading points that are identical to
+            the previously indexed points (e.g., the old number of points when
+            a point is appended).
+        :type num_unchanged: int
+
+        """
+        if points is None:
+            points = np.zeros((0,2))
+
+        self._points = points
+        self._num_indexed = min(self._num_indexed, num_unchanged, len(points))
+
+    def _build(self):
+        points = self._points
+        ind = np.nonzero(np.all(np.isfinite(points), axis=1))[0]
+        self._num_indexed = len(points)
+
+        if len(ind) == 0:
+            self._order = np.zeros(0, dtype=np.int64)
+            self._keys = np.zeros(0, dtype=np.int64)
+            return
+
+        pts = points[ind]
+        self._origin = pts.min(0)
+        extent = np.maximum(pts.max(0) - self._origin, 1)
+
+        # Aim for a few points per cell.
+        self._cell_size = max(2*np.sqrt(np.prod(extent)/len(ind)), 1)
+        cells = ((pts - self._origin)//self._cell_size).astype(np.int64)
+        self._grid_shape = cells.max(0) + 1
+
+        keys = cells[:,1]*self._grid_shape[0] + cells[:,0]
+        order = np.argsort(keys, kind='mergesort')
+        self._keys = keys[order]
+        self._order = ind[order]
+
+    def query_rect(self, x0, y0, x1, y1):
+        """Return indices of the points within a rectangle.
+
+        :return: Indices of points with x0 <= x <= x1 and y0 <= y <= y1.
+        :rtype: numpy.ndarray of int
+
+        """
+        if len(self._points) - self._num_indexed > self.max_tail:
+            self._build()
+
+        points = self._points
+        result = []
+        if len(self._order) > 0:
+            ncols, nrows = self._grid_shape
+            c0, r0 = ((np.array([x0, y0]) - self._origin)//self._cell_size)
+            c1, r1 = ((np.array([x1, y1]) - self._origin)//self._cell_size)
+            c0, c1 = int(max(c0, 0)), int(min(c1, ncols - 1))
+            r0, r1 = int(max(r0, 0)), int(min(r1, nrows - 1))
+
+            if c0 <= c1 and r0 <= r1:
+                if c0 == 0 and r0 == 0 and c1 == ncols - 1 and r1 == nrows - 1:
+                    ind = self._order
+                else:
+                    rows = np.arange(r0, r1 + 1)*ncols
+                    lo = np.searchsorted(self._keys, rows + c0, 'left')
+                    hi = np.searchsorted(self._keys, rows + c1, 'right')
+                    ind = [self._order[l:h] for l, h in zip(lo, hi) if h > l]
+                    if len(ind) > 0:
+                        ind = np.concatenate(ind)
+                    else:
+                        ind = self._order[:0]
+
+                # Grid entries beyond the trusted prefix may be stale.
+                ind = ind[ind < self._num_indexed]
+                result.append(ind)
+
+        result.append(np.arange(self._num_indexed, len(points)))
+        ind = np.concatenate(result)
+        pts = points[ind]
+        inside = np.logical_and.reduce([pts[:,0] >= x0, pts[:,0] <= x1,
+                                        pts[:,1] >= y0, pts[:,1] <= y1])
+        return ind[inside]
+
+    def nearest(self, pos, max_distance):
+        """Return the index of the point nearest to 'pos'.
+
+        :param pos: Query point.
+        :type pos: 2-array
+
+        :param max_distance: Only points within this distance are considered.
+        :type max_distance: float
+
+        :return: Index of the nearest point or None if there are no points
+            within 'max_distance'.
+        :rtype: int | None
+
+        """
+        x, y = pos
+        ind = self.query_rect(x - max_distance, y - max_distance,
+                              x + max_distance, y + max_distance)
+        if len(ind) == 0:
+            return None
+
+        d = np.sum((self._points[ind] - [x, y])**2, 1)
+        i = np.argmin(d)
+        if d[i] > max_distance**2:
+            return None
+
+        return int(ind[i])
+
+
+def error_summary(errors, percentiles=(50, 90)):
+    """Return the root mean square and percentiles of the finite errors.
+
+    :param errors: Errors, where non-finite values are ignored.
+    :type errors: N-array of float
+
+    :param percentiles: Percentiles (0 to 100) to compute.
+    :type percentiles: sequence of float
+
+    :return: Root mean square and the percentiles, or None if there are no
+        finite errors.
+    :rtype: (float, list of float) | None
+
+    """
+    errors = errors[np.isfinite(errors)]
+    if len(errors) == 0:
+        return None
+
+    return (float(np.sqrt(np.mean(errors**2))),
+            [float(v) for v in np.percentile(errors, percentiles)])
+
+
+class ReprojectionErrors(object):
+    """Reprojection errors of point correspondences under a homography that
+    warps the left image into the right image.
+
+    The forward error of a row is the distance in the right image between its
+    right point and its left point warped by the homography, and the backward
+    error is the distance in the left image between its left point and its
+    right point warped by the inverse homography. Errors are NaN for rows with
+    an unknown point or if there is no homography.
+
+    Like PointGridIndex, the rows are referenced rather than copied, and
+    changing or removing rows only shortens the prefix of rows whose errors
+    are trusted. Errors of the remaining rows are computed in one batched
+    transform when they are next read, so appending a row computes only its
+    errors.
+
+    Attributes:
+    :param threshold: Error in pixels up to which a pair agrees with the
+        homography (see 'classify').
+    :type threshold: float
+
+    """
+    def __init__(self, homography=None, threshold=3.0):
+        self.threshold = threshold
+        self._points = np.zeros((0,4))
+        self._errors = np.zeros((0,2))
+        self._num_valid = 0
+        self.homography = homography
+
+    @property
+    def homography(self):
+        return self._homography
+
+    @homography.setter
+    def homography(self, homography):
+        self._homography = homography
+        if homography is None:
+            self._inverse_homography = None
+        else:
+            self._inverse_homography = np.linalg.inv(homography)
+
+        self._num_valid = 0
+
+    def update(self, points, num_unchanged=0):
+        """Replace the rows.
+
+        :param points: Rows (x1, y1, x2, y2). The array is referenced, not
+            copied, so it must not be modified in place without calling
+            'update'.
+        :type points: Nx4 numpy.ndarray
+
+        :param num_unchanged: Number of leading rows that are identical to the
+            previous rows.
+        :type num_unchanged: int
+
+        """
+        self._points = points
+        self._num_valid = min(self._num_valid, num_unchanged, len(points))
+
+    def _compute(self):
+        n = len(self._points)
+        i = self._num_valid
+        if i >= n:
+            return
+
+        if len(self._errors) < n:
+            errors = np.full((max(n, 2*len(self._errors)), 2), np.nan)
+            errors[:i] = self._errors[:i]
+            self._errors = errors
+
+        pts = self._points[i:n]
+        if self._homography is None:
+            self._errors[i:n] = np.nan
+        else:
+            self._errors[i:n,0] = transfer_errors(self._homography,
+                                                  pts[:,:2], pts[:,2:])
+            self._errors[i:n,1] = transfer_errors(self._inverse_homography,
+                                                  pts[:,2:], pts[:,:2])
+
+        self._num_valid = n
+
+    @property
+    def forward(self):
+        """Forward error of every row in pixels of the right image.
+
+        """
+        self._compute()
+        return self._errors[:len(self._points),0]
+
+    @property
+    def backward(self):
+        """Backward error of every row in pixels of the left image.
+
+        """
+        self._compute()
+        return self._errors[:len(self._points),1]
+
+    @property
+    def errors(self):
+        """Larger of the forward and backward error of every row.
+
+        """
+        self._compute()
+        errors = self._errors[:len(self._points)]
+        return np.maximum(errors[:,0], errors[:,1])
+
+    def classify(self, rows=None):
+        """Return how well rows agree with the homography.
+
+        :param rows: Indices of the rows, or None for all rows.
+        :type rows: N-array of int | None
+
+        :return: 0 if the error of a row is at most half of 'threshold' or
+            unknown, 1 if it is at most 'threshold', and 2 otherwise.
+        :rtype: N-array of int
+
+        """
+        self._compute()
+        errors = self._errors[:len(self._points)]
+        if rows is not None:
+            errors = errors[rows]
+
+        errors = np.maximum(errors[:,0], errors[:,1])
+        with np.errstate(invalid='ignore'):
+            return ((errors > self.threshold/2).astype(np.int64) +
+                    (errors > self.threshold))
+
+
+class CorrespondenceStore(object):
+    """Point correspondences between the left and right images.
+
+    Each row holds the raw-image coordinates (x1, y1, x2, y2) of a point in the
+    left image and its match in the right image, along with a state flag. Rows
+    live in a preallocated array whose capacity doubles when it fills, so
+    appending is amortized O(1). Panels read views of the arrays instead of
+    keeping their own copies. A spatial index over each image's points is
+    kept up to date as rows change, as are the reprojection errors of the
+    rows under the current fit.
+
+    States:
+    PENDING: Point clicked in one image whose match has not been clicked yet.
+        The coordinates for the other image are NaN.
+    ACCEPTED: Complete correspondence.
+    OUTLIER: Complete correspondence flagged as inconsistent with the others.
+
+    Attributes:
+    :param indexes: Spatial index over the points of the left (0) and right
+        (1) images.
+    :type indexes: 2-tuple of PointGridIndex
+
+    :param residuals: Reprojection errors of the rows under the homography
+        set as its 'homography' attribute.
+    :type residuals: ReprojectionErrors
+
+    """
+    PENDING = 0
+    ACCEPTED = 1
+    OUTLIER = 2
+
+    # States of the rows whose points are both known.
+    COMPLETE = (ACCEPTED, OUTLIER)
+
+    def __init__(self, points=None, capacity=64):
+        """
+        :param points: Initial accepted correspondences.
+        :type points: Nx4 numpy.ndarray | None
+
+        :param capacity: Number of rows to initially allocate.
+        :type capacity: int
+
+        """
+        self._points = np.full((max(capacity, 1), 4), np.nan)
+        self._states = np.zeros(max(capacity, 1), dtype=np.uint8)
+        self._size = 0
+        self.indexes = (PointGridIndex(), PointGridIndex())
+        self.residuals = ReprojectionErrors()
+
+        if points is not None:
+            self.extend(points)
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def points(self):
+        """View of all rows (x1, y1, x2, y2).
+
+        """
+        return self._points[:self._size]
+
+    @property
+    def states(self):
+        """View of the state of all rows.
+
+        """
+        return self._states[:self._size]
+
+    def side_points(self, side):
+        """View of the points of one image.
+
+        :param side: 0 for the left image or 1 for the right image.
+        :type side: int
+
+        :return: Raw image coordinates of the image's point in every row.
+        :rtype: Nx2 numpy.ndarray
+
+        """
+        return self._points[:self._size, 2*side:2*side+2]
+
+    def _reserve(self, size):
+        capacity = len(self._points)
+        if size <= capacity:
+            return
+
+        while capacity < size:
+            capacity *= 2
+
+        points = np.full((capacity, 4), np.nan)
+        points[:self._size] = self.points
+        states = np.zeros(capacity, dtype=np.uint8)
+        states[:self._size] = self.states
+        self._points = points
+        self._states = states
+
+    def _changed(self, first):
+        """Called after all rows from index 'first' on may have changed.
+
+        """
+        for side, index in enumerate(self.indexes):
+            index.update(self.side_points(side), first)
+
+        self.residuals.update(self.points, first)
+
+    def append(self, pt1, pt2, state=ACCEPTED):
+        """Append one row.
+
+        :param pt1: Point in the left image, or None if not yet known.
+        :type pt1: 2-array | None
+
+        :param pt2: Point in the right image, or None if not yet known.
+        :type pt2: 2-array | None
+
+        :return: Index of the new row.
+        :rtype: int
+
+        """
+        i = self._size
+        self._reserve(i + 1)
+        self._points[i] = np.nan
+        if pt1 is not None:
+            self._points[i,:2] = np.ravel(pt1)
+
+        if pt2 is not None:
+            self._points[i,2:] = np.ravel(pt2)
+
+        self._states[i] = state
+        self._size += 1
+        self._changed(i)
+        return i
+
+    def extend(self, points, state=ACCEPTED):
+        """Append rows.
+
+        :param points: Rows (x1, y1, x2, y2) to append.
+        :type points: Nx4 numpy.ndarray
+
+        """
+        points = np.atleast_2d(np.asarray(points, dtype=np.float64))
+        assert points.shape[1] == 4
+        i = self._size
+        self._reserve(i + len(points))
+        self._points[i:i+len(points)] = points
+        self._states[i:i+len(points)] = state
+        self._size += len(points)
+        self._changed(i)
+
+    def set_point(self, i, side, pt):
+        """Set the point of one image in row 'i'.
+
+        """
+        self._points[i, 2*side:2*side+2] = np.ravel(pt)
+        self._changed(i)
+
+    def set_state(self, i, state):
+        """Set the state of row(s) 'i', which may be an index, index array, or
+        boolean mask.
+
+        """
+        self.states[i] = state
+
+    def delete(self, i):
+        """Remove row 'i', shifting subsequent rows down by one.
+
+        """
+        n = self._size
+        self._points[i:n-1] = self._points[i+1:n].copy()
+        self._states[i:n-1] = self._states[i+1:n].copy()
+        self._size -= 1
+        self._changed(i)
+
+    def clear(self):
+        self._size = 0
+        self._changed(0)
+
+    def select(self, states=(ACCEPTED,)):
+        """Return a copy of the rows with the given states.
+
+        :param states: States to include.
+        :type states: sequence of int
+
+        :return: Selected rows (x1, y1, x2, y2).
+        :rtype: Nx4 numpy.ndarray
+
+        """
+        return self.points[np.isin(self.states, states)]
+
+    def query_rect(self, side, rect):
+        """Return indices of the rows whose point in one image lies within a
+        rectangle.
+
+        :param rect: Bounding box (x0, y0, x1, y1) in raw image coordinates,
+            or None to return all rows with a known point in the image.
+        :type rect: 4-tuple of float | None
+
+        """
+        if rect is None:
+            rect = (-np.inf, -np.inf, np.inf, np.inf)
+
+        return self.indexes[side].query_rect(*rect)
+
+    def nearest(self, side, pos, max_distance, states=(ACCEPTED,)):
+        """Return the index of the row whose point in one image is nearest to
+        'pos', or None if there is none within 'max_distance'.
+
+        :param states: Only rows in these states are considered.
+        :type states: sequence of int
+
+        """
+        x, y = pos
+        ind = self.query_rect(side, (x - max_distance, y - max_distance,
+                                     x + max_distance, y + max_distance))
+        ind = ind[np.isin(self.states[ind], states)]
+        if len(ind) == 0:
+            return None
+
+        d = np.sum((self.side_points(side)[ind] - [x, y])**2, 1)
+        i = np.argmin(d)
+        if d[i] > max_distance**2:
+            return None
+
+        return int(ind[i])
+
+
+class PointSelection(object):
+    """Selection of point correspondences by clicking in the two images.
+
+    Holds the state of the interaction that MainFrame and the headless replay
+    of sessions (see keypointgui.session) share: the pair of points being
+    selected, the suggested pairs that were neither accepted nor rejected,
+    and the classification of the pairs by the fitted alignment. Displaying
+    the points is left to the caller, so methods that change points return
+    the rows (x1, y1, x2, y2) whose markers need to be redrawn.
+
+    A click picks the nearest point within 'pick_radius' pixels of the view
+    that was clicked, which callers convert to image pixels with
+    'pick_distance'.
+
+    Attributes:
+    :param correspondences: Selected point correspondences.
+    :type correspondences: CorrespondenceStore
+
+    :param candidates: Suggested pairs (x1, y1, x2, y2) that were neither
+        accepted nor rejected.
+    :type candidates: Nx4 numpy.ndarray
+
+    :param click_state: 0 if no pair is being selected, otherwise 1 plus the
+        side of the image whose point was selected.
+    :type click_state: int
+
+    :param pending_index: Row in 'correspondences' of the pair being
+        selected.
+    :type pending_index: int | None
+
+    :param pick_radius: Distance in view pixels within which a click picks a
+        point.
+    :type pick_radius: float
+
+    """
+    def __init__(self, correspondences=None, pick_radius=10):
+        if correspondences is None:
+            correspondences = CorrespondenceStore()
+
+        self.correspondences = correspondences
+        self.candidates = np.zeros((0,4))
+        self.click_state = 0
+        self.pending_index = None
+        self.pick_radius = pick_radius
+
+    def pick_distance(self, homography, pos):
+        """Return the distance in image pixels within which a click at 'pos'
+        picks a point.
+
+        :param homography: Homography of the view that was clicked, from image
+            to view coordinates.
+        :type homography: numpy.ndarray of shape (3,3)
+
+        """
+        return self.pick_radius/homography_scale(homography, pos)
+
+    def nearest_candidate(self, side, pos, max_distance):
+        """Return the index of the suggested pair whose point in one image is
+        nearest to 'pos', or None if there is none within 'max_distance'.
+
+        """
+        if len(self.candidates) == 0:
+            return None
+
+        d = np.sum((self.candidates[:,2*side:2*side+2] - pos)**2, 1)
+        i = np.argmin(d)
+        if d[i] > max_distance**2:
+            return None
+
+        return int(i)
+
+    def add_point(self, side, pos, max_distance):
+        """Handle a click that selects a point.
+
+        Clicking a suggested pair accepts it. Otherwise, the click starts a
+        new pair, or completes the pair started in the other image.
+
+        :param side: Side of the image that was clicked.
+        :type side: int
+
+        :param pos: Image coordinates of the click.
+        :type pos: 2-array
+
+        :return: Rows whose markers changed.
+        :rtype: Nx4 numpy.ndarray
+
+        """
+        if self.click_state == 0:
+            i = self.nearest_candidate(side, pos, max_distance)
+            if i is not None:
+                return self.accept_candidates([i])
+
+            pts = (pos, None) if side == 0 else (None, pos)
+            self.pending_index = self.correspondences.append(
+                                    pts[0], pts[1],
+                                    CorrespondenceStore.PENDING)
+            self.click_state = 1 + side
+        elif self.click_state == 2 - side:
+            self.correspondences.set_point(self.pending_index, side, pos)
+            self.correspondences.set_state(self.pending_index,
+                                           CorrespondenceStore.ACCEPTED)
+            self.click_state = 0
+        else:
+            return np.zeros((0,4))
+
+        return self.correspondences.points[self.pending_index:
+                                           self.pending_index+1].copy()
+
+    def remove_point(self, side, pos, max_distance):
+        """Handle a click that removes a point.
+
+        Suggestions are drawn over the other points, so clicking a suggested
+        pair rejects it. Otherwise, the nearest complete pair is deleted.
+
+        :return: Rows whose markers changed.
+        :rtype: Nx4 numpy.ndarray
+
+        """
+        i = self.nearest_candidate(side, pos, max_distance)
+        if i is not None:
+            return self.reject_candidates([i])
+
+        i = self.correspondences.nearest(side, pos, max_distance,
+                                         CorrespondenceStore.COMPLETE)
+        if i is None:
+            return np.zeros((0,4))
+
+        points = self.correspondences.points[i:i+1].copy()
+        self.correspondences.delete(i)
+        if self.click_state != 0 and i < self.pending_index:
+            self.pending_index -= 1
+
+        return points
+
+    @staticmethod
+    def synced_center(side, pos, align_homographies):
+        """Return the point of the other image that shows the same feature as
+        'pos' in one image, e.g., to center both zoom views on it.
+
+        :param align_homographies: Alignment homography of the left and the
+            right image (see Viewport.align_homography).
+        :type align_homographies: sequence of (numpy.ndarray | None)
+
+        :return: Image coordinates in the other image, or None unless exactly
+            one image is aligned to the other.
+        :rtype: 2-array | None
+
+        """
+        h1, h2 = align_homographies
+        if h1 is not None and h2 is None:
+            h = h1
+        elif h2 is not None and h1 is None:
+            h = np.linalg.inv(h2)
+        else:
+            return None
+
+        if side == 1:
+            h = np.linalg.inv(h)
+
+        pos2 = np.dot(h, np.hstack([pos, 1]))
+        return pos2[:2]/pos2[2]
+
+    def clear_last(self):
+        """Delete the pair being selected, or else the last pair.
+
+        :return: Rows whose markers changed.
+        :rtype: Nx4 numpy.ndarray
+
+        """
+        if self.click_state == 0:
+            i = len(self.correspondences) - 1
+        else:
+            i = self.pending_index
+
+        self.click_state = 0
+        if i < 0:
+            return np.zeros((0,4))
+
+        points = self.correspondences.points[i:i+1].copy()
+        self.correspondences.delete(i)
+        return points
+
+    def clear(self):
+        """Delete all pairs and suggestions.
+
+        """
+        self.correspondences.clear()
+        self.candidates = np.zeros((0,4))
+        self.click_state = 0
+
+    def load_points(self, points):
+        """Replace the pairs with 'points' (e.g., loaded from a file).
+
+        :type points: Nx4 numpy.ndarray
+
+        """
+        self.correspondences.clear()
+        self.correspondences.extend(points)
+        self.click_state = 0
+
+    def set_candidates(self, candidates):
+        """Replace the suggested pairs.
+
+        :type candidates: Nx4 numpy.ndarray
+
+        """
+        self.candidates = np.asarray(candidates,
+                                     dtype=np.float64).reshape(-1, 4)
+
+    def accept_candidates(self, rows=None):
+        """Add suggested pairs to the correspondences.
+
+        :param rows: Indices of the suggestions, or None for all of them.
+        :type rows: sequence of int | None
+
+        :return: Rows whose markers changed.
+        :rtype: Nx4 numpy.ndarray
+
+        """
+        points = self.reject_candidates(rows)
+        self.correspondences.extend(points)
+        return points
+
+    def reject_candidates(self, rows=None):
+        """Discard suggested pairs.
+
+        :param rows: Indices of the suggestions, or None for all of them.
+        :type rows: sequence of int | None
+
+        :return: Rows whose markers changed.
+        :rtype: Nx4 numpy.ndarray
+
+        """
+        if rows is None:
+            rows = np.arange(len(self.candidates))
+
+        points = self.candidates[rows]
+        self.candidates = np.delete(self.candidates, rows, 0)
+        return points
+
+    @property
+    def rows_to_align(self):
+        """Row indices in 'correspondences' of the points to use for
+        alignment, i.e., of the complete correspondences.
+
+        Correspondences flagged as outliers by a previous fit are included, so
+        that each fit classifies all of them again.
+
+        """
+        return np.flatnonzero(np.isin(self.correspondences.states,
+                                      CorrespondenceStore.COMPLETE))
+
+    def fit(self, side, homography_type, method=None, threshold=3.0,
+            confidence=0.995):
+        """Fit a homography that warps the points of one image onto those of
+        the other, and flag the complete correspondences as accepted or
+        outliers accordingly.
+
+        :param side: Side of the image whose points are warped.
+        :type side: int
+
+        :param homography_type: Index in TRANSFORM_NAMES of the type of
+            homography to fit.
+        :type homography_type: int
+
+        :param method: Robust estimator (see fit_homography_robust), or None
+            to fit all pairs by least squares and accept them.
+        :type method: str | None
+
+        :return: Homography, inlier mask of the pairs, and the rows whose
+            markers changed.
+        :rtype: (numpy.ndarray of shape (3,3), N-array of bool,
+            Nx4 numpy.ndarray)
+
+        :raises ValueError: If there are too few pairs or the robust fit
+            fails.
+
+        """
+        if homography_type not in range(len(TRANSFORM_NAMES)):
+            raise ValueError('Unknown homography type %r.' %
+                             (homography_type,))
+
+        rows = self.rows_to_align
+        n = TRANSFORM_MIN_POINTS[homography_type]
+        if len(rows) < n:
+            raise ValueError('Need to select at least %i pairs of points for '
+                             '%s alignment.' %
+                             (n, TRANSFORM_NAMES[homography_type]))
+
+        points = self.correspondences.points[rows]
+        pts1 = points[:,2*side:2*side+2]
+        pts2 = points[:,2-2*side:4-2*side]
+        if method is None:
+            H = fit_homography(pts1, pts2, homography_type)
+            inliers = np.ones(len(rows), dtype=bool)
+        else:
+            H, inliers = fit_homography_robust(pts1, pts2, homography_type,
+                                               method, threshold=threshold,
+                                               confidence=confidence)
+
+        states = np.where(inliers, CorrespondenceStore.ACCEPTED,
+                          CorrespondenceStore.OUTLIER)
+        changed = self.correspondences.states[rows] != states
+        self.correspondences.set_state(rows, states)
+        return H, inliers, points[changed]
+
+    def set_fit(self, homography, side=0, threshold=3.0):
+        """Set the homography that the reprojection errors of the
+        correspondences are computed under.
+
+        :param homography: Homography that warps one side's image into the
+            other, or None if there is no fit.
+        :type homography: numpy.ndarray of shape (3,3) | None
+
+        :param side: Side of the image that 'homography' warps.
+        :type side: int
+
+        :param threshold: Inlier threshold that the errors are classified by.
+        :type threshold: float
+
+        """
+        if homography is not None and side == 1:
+            homography = np.linalg.inv(homography)
+
+        residuals = self.correspondences.residuals
+        residuals.homography = homography
+        residuals.threshold = threshold
+
+
+def align_views(side_views, homography=None, side=0):
+    """Show one image warped into the other's coordinates in all views, or
+    both images unwarped.
+
+    :param side_views: Navigation and zoom view of the left image and of the
+        right image. These may be Viewports or anything with the same
+        attributes (e.g., the panels of MainFrame).
+    :type side_views: sequence of (Viewport, ZoomViewport)
+
+    :param homography: Homography that warps the image of 'side' into the
+        other image, or None to show both images unwarped.
+    :type homography: numpy.ndarray of shape (3,3) | None
+
+    :param side: Side of the image that 'homography' warps.
+    :type side: int
+
+    :return: Views that need to be updated.
+    :rtype: list
+
+    """
+    if homography is None:
+        views = [view for views in side_views for view in views]
+        for view in views:
+            view.align_homography = None
+            if view.raw_image is not None:
+                view.corrected_img_shape = view.raw_image.shape[:2]
+
+        return [view for view in views if view.raw_image is not None]
+
+    src, dst = side_views[side], side_views[1 - side]
+
+    # Set zooms so that they match after alignment.
+    src[1].set_zoom(dst[1].zoom)
+    img_shape = dst[0].raw_image.shape[:2]
+    for view in src:
+        view.align_homography = homography
+        view.corrected_img_shape = img_shape
+
+    for view in dst:
+        view.align_homography = None
+        view.corrected_img_shape = view.raw_image.shape[:2]
+
+    return list(src) + list(dst)
+
+
+# View of an image to be rendered into a panel. 'key' identifies the view (see
+# Viewport.render_key), 'homography' warps from raw image coordinates
+# to panel coordinates, 'dsize' is the panel (width, height), 'interpolation'
+# is the OpenCV interpolation flag, 'preview' indicates a fast interactive
+# preview that will be replaced by a full-quality render, and 'window' is the
+# display window passed to apply_window (None to display 8-bit values as is).
+RenderRequest = collections.namedtuple('RenderRequest',
+                                       ['key', 'image_pyramid', 'homography',
+                                        'inverse_homography', 'dsize',
+                                        'interpolation', 'preview', 'window'])
+
+
+def draw_circles(image, positions, colour, radius=5, thickness=3):
+    """Draw circle markers into an RGB image, e.g., at the positions returned
+    by Viewport.marker_positions.
+
+    :param image: RGB image to draw into.
+    :type image: numpy.ndarray
+
+    :param positions: Centers of the circles in image coordinates.
+    :type positions: Nx2 numpy.ndarray
+
+    :param colour: RGB colour of the circles.
+    :type colour: 3-tuple of int
+
+    """
+    for x, y in np.round(positions).astype(int):
+        cv2.circle(image, (int(x), int(y)), radius, colour, thickness)
+
+    return image
+
+
+class Viewport(object):
+    """View of an image in a panel of a given size.
+
+    This holds the geometry of the view, a homography that warps from the raw
+    image coordinate system to the panel coordinate system, and renders the
+    view into an RGB array. It does not depend on any GUI toolkit, so views can
+    be rendered in batch jobs or benchmarks without a display.
+    keypointgui.gui.ImagePanelManager displays a Viewport in a wx.Panel.
+
+    The base class shows the image at its original resolution. Subclasses
+    define the homography for a particular kind of view by overriding
+    'update_homography'.
+
+    Note: the image coordinate system has its orgin (0,0) at the center of the
+    upper left pixel.
+
+    Attributes:
+    :param raw_image: The original full-resolution source image.
+    :type raw_image: numpy.ndarray | ImageSource | None
+
+    :param image_pyramid: Multi-resolution version of raw_image used for
+        rendering when the view downsamples the image.
+    :type image_pyramid: ImagePyramid
+
+    :param image_key: Hashable value identifying the content of raw_image.
+    :type image_key: hashable
+
+    :param size: Panel size (width, height).
+    :type size: 2-tuple of int
+
+    :param homography: Homography that warps from the raw_image coordinate
+        system to the panel coordinate system.
+    :type homography: numpy.ndarray of shape (3,3) | None
+
+    :param interpolation: OpenCV interpolation flag.
+    :type interpolation: int
+
+    :param display_window: Range of raw image values mapped to the displayed
+        8-bit range (see apply_window), or None to display 8-bit images as is.
+    :type display_window: (float, float) | None
+
+    """
+    def __init__(self, raw_image=None, size=(1, 1), interpolation=1,
+                 image_key=None, image_pyramid=None):
+        """
+        :param raw_image: Image.
+        :type raw_image: numpy.ndarray | ImageSource | None
+
+        :param size: Panel size (width, height).
+        :type size: 2-tuple of int
+
+        :param interpolation: Integer specifying the quality of the
+            interpolation (see set_interpolation).
+        :type interpolation: int
+
+        :param image_key: Hashable value identifying the content of
+            'raw_image'. If None, a new unique key is generated.
+        :type image_key: hashable | None
+
+        :param image_pyramid: Pyramid to render from. If None, one is built
+            from 'raw_image'.
+        :type image_pyramid: ImagePyramid | None
+
+        """
+        self.size = tuple(size)
+        self.homography = None
+        self.inverse_homography = None
+        self.display_window = None
+        self._buffers = {}
+        self._buffer_view = None
+        self._warped_key = None
+        self.set_interpolation(interpolation)
+        self.raw_image = None
+        self.image_pyramid = None
+        self.image_key = next(image_keys)
+        if raw_image is not None:
+            self.set_image(raw_image, image_key, image_pyramid)
+
+    def set_image(self, raw_image, image_key=None, image_pyramid=None):
+        """Replace raw_image and update the homography.
+
+        :param image_key: Hashable value identifying the content of
+            'raw_image' (e.g., the source image and contrast setting it was
+            derived from) used to look up previously rendered views. If None, a
+            new unique key is generated.
+        :type image_key: hashable | None
+
+        :param image_pyramid: Pyramid to render from, which may be shared with
+            other views or hold a different version of 'raw_image' (e.g., a
+            contrast-adjusted preview). If None, one is built from 'raw_image'.
+        :type image_pyramid: ImagePyramid | None
+
+        """
+        self.raw_image = raw_image
+        if image_pyramid is None:
+            image_pyramid = ImagePyramid(raw_image)
+
+        self.image_pyramid = image_pyramid
+
+        if image_key is None:
+            image_key = next(image_keys)
+
+        self.image_key = image_key
+        self.update()
+
+    def set_interpolation(self, interp):
+        """
+        :param interp: Integer specifying the quality of the interpolation. The
+            values ranges for 0-4 and corresponds to nearest, linear, area,
+            cubic, and lanczos4 respectively.
+        :type interp: int
+        """
+        if interp == 0:
+            self.interpolation = cv2.INTER_NEAREST
+        elif interp == 1:
+            self.interpolation = cv2.INTER_LINEAR
+        elif interp == 2:
+            self.interpolation = cv2.INTER_AREA
+        elif interp == 3:
+            self.interpolation = cv2.INTER_CUBIC
+        elif interp == 4:
+            self.interpolation = cv2.INTER_LANCZOS4
+        else:
+            raise Exception('Invalid value for interp: {}'.format(interp))
+
+    def set_size(self, size):
+        """Set the panel size (width, height) and update the homography.
+
+        """
+        self.size = tuple(size)
+        self.update()
+
+    def update(self):
+        """Recalculate the homography and its inverse.
+
+        """
+        if self.raw_image is not None:
+            self.update_homography()
+            self.update_inverse_homography()
+
+    def update_homography(self):
+        """
+        Determine what the homography should be based on all existing
+        attributes.
+
+        """
+        self.homography = np.identity(3)
+
+    def update_inverse_homography(self):
+        """
+        Calculate inverse of the homography.
+
+        """
+        if self.homography is None:
+            return None
+        else:
+            self.inverse_homography = np.linalg.inv(self.homography)
+
+    def to_image(self, pos):
+        """Return the raw image coordinates of a panel point.
+
+        """
+        pos = np.dot(self.inverse_homography, [pos[0],pos[1],1])
+        return pos[:2]/pos[2]
+
+    def to_panel(self, pos):
+        """Return the panel coordinates of a raw image point.
+
+        """
+        pos = np.dot(self.homography, [pos[0],pos[1],1])
+        return pos[:2]/pos[2]
+
+    def contains(self, pos):
+        """Return True if raw image coordinates are within the image.
+
+        """
+        return np.all([pos[0] >= 0,
+                       pos[0] <= self.raw_image.shape[1],
+                       pos[1] >= 0,
+                       pos[1] <= self.raw_image.shape[0]])
+
+    def render_key(self, interpolation=None):
+        """Return a key that uniquely identifies the current view rendered
+        with 'interpolation'.
+
+        """
+        if interpolation is None:
+            interpolation = self.interpolation
+
+        return (self.image_key, np.round(self.homography, 9).tobytes(),
+                self.size, interpolation, self.display_window)
+
+    def get_request(self, interpolation=None, key=None):
+        """Return a request to render the current view.
+
+        :param interpolation: OpenCV interpolation flag. If None, the selected
+            interpolation is used, otherwise the request is a preview.
+        :type interpolation: int | None
+
+        :param key: Key identifying the view (see render_key).
+        :type key: hashable | None
+
+        """
+        if interpolation is None:
+            interpolation = self.interpolation
+
+        if key is None:
+            key = self.render_key(interpolation)
+
+        return RenderRequest(key, self.image_pyramid,
+                             self.homography.copy(),
+                             self.inverse_homography.copy(),
+                             self.size, interpolation,
+                             interpolation != self.interpolation,
+                             self.display_window)
+
+    def render_view(self):
+        """Render the current view.
+
+        :return: RGB image with the size of the panel, which is overwritten by
+            the next render.
+        :rtype: numpy.ndarray
+
+        """
+        return self.render(self.get_request())
+
+    def get_render_level(self, request):
+        """Return the pyramid level that a view is rendered from.
+
+        The level is chosen to match the scale of the homography at the center
+        of the panel.
+
+        :param request: View to render.
+        :type request: RenderRequest
+
+        """
+        panel_width, panel_height = request.dsize
+        center = np.dot(request.inverse_homography,
+                        [panel_width/2, panel_height/2, 1])
+        scale = homography_scale(request.homography, center[:2]/center[2])
+        return request.image_pyramid.level_for_scale(scale)
+
+    def get_view_level(self):
+        """Return the pyramid level that the current view is rendered from.
+
+        """
+        return self.get_render_level(self.get_request(key=()))
+
+    def get_render_source(self, request):
+        """Return the image to render from and the homography mapping panel
+        coordinates into it.
+
+        The pyramid level is chosen to match the scale of the homography at the
+        center of the panel, so rendering cost depends on the panel size rather
+        than the size of the raw image.
+
+        :param request: View to render.
+        :type request: RenderRequest
+
+        :return: Source image and the homography that warps from the panel
+            coordinate system to the source image coordinate system.
+        :rtype: (numpy.ndarray, numpy.ndarray of shape (3,3))
+
+        """
+        level = self.get_render_level(request)
+        s = 2**level
+        inverse_homography = np.dot(np.diag([1/s, 1/s, 1]),
+                                    request.inverse_homography)
+        return request.image_pyramid.get_level(level), inverse_homography
+
+    def _get_buffer(self, name, shape, dtype):
+        """Return a persistent array, reallocating it only if the requested
+        shape or dtype differs from the previous call.
+
+        """
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = np.empty(shape, dtype=dtype)
+            self._buffers[name] = buf
+
+        return buf
+
+    def render(self, request):
+        """Render a view of the image.
+
+        This may be called from a worker thread, so it must only depend on the
+        contents of 'request'. Requests must not be rendered concurrently. The
+        result is written into a persistent panel-sized buffer, which is reused
+        by the next render.
+
+        :param request: View to render.
+        :type request: RenderRequest
+
+        :return: RGB image with the size of the panel.
+        :rtype: numpy.ndarray
+
+        """
+        flags = request.interpolation | cv2.WARP_INVERSE_MAP
+        source, inverse_homography = self.get_render_source(request)
+        panel_width, panel_height = request.dsize
+        rgb = self._get_buffer('rgb', (panel_height, panel_width, 3),
+                               np.uint8)
+
+        direct = (source.ndim == 3 and source.shape[2] == 3 and
+                  source.dtype == np.uint8 and request.window is None)
+        if direct:
+            # Warp directly into the output buffer.
+            warped = rgb
+        else:
+            # Keep the warped raw values, so that a new display window can be
+            # applied without warping again.
+            shape = (panel_height, panel_width) + source.shape[2:]
+            warped = self._get_buffer('warped', shape, source.dtype)
+
+        # Everything but the homography that determines the contents of
+        # 'warped'. The shape of the source identifies the pyramid level.
+        view = (direct, request.key[0], request.dsize, request.interpolation,
+                source.shape)
+        shift = None
+        if self._buffer_view is not None and self._buffer_view[0] == view:
+            shift = pixel_translation(self._buffer_view[1],
+                                      request.homography)
+
+        # Invalid until the buffer has been completely updated.
+        self._buffer_view = None
+        if (shift is not None and abs(shift[0]) < panel_width and
+            abs(shift[1]) < panel_height):
+            self.scroll_render(source, inverse_homography, flags, warped,
+                               shift)
+        else:
+            self.warp_source(source, inverse_homography, request.dsize,
+                             flags, dst=warped)
+
+        self._buffer_view = (view, request.homography)
+
+        if direct:
+            self._warped_key = None
+        else:
+            self._warped_key = request.key[:-1]
+            self.convert_to_rgb(warped, request.window, rgb)
+
+        return rgb
+
+    def scroll_render(self, source, inverse_homography, flags, warped,
+                      shift):
+        """Update a rendered view for a view shifted by whole pixels.
+
+        The part of the previous view that remains visible is moved within
+        'warped', and only the newly exposed strips along the edges are
+        warped from the source image.
+
+        :param source: Image to warp.
+        :type source: numpy.ndarray | ImageSource
+
+        :param inverse_homography: Homography that warps from the panel
+            coordinate system of the new view to the source image coordinate
+            system.
+        :type inverse_homography: numpy.ndarray of shape (3,3)
+
+        :param flags: OpenCV interpolation flags.
+        :type flags: int
+
+        :param warped: Panel-sized buffer holding the previous view, which is
+            updated in place.
+        :type warped: numpy.ndarray
+
+        :param shift: Translation (dx, dy) in panel pixels from the previous to
+            the new view.
+        :type shift: 2-tuple of int
+
+        """
+        dx, dy = shift
+        height, width = warped.shape[:2]
+        y0, y1 = max(dy, 0), height + min(dy, 0)
+        x0, x1 = max(dx, 0), width + min(dx, 0)
+        warped[y0:y1, x0:x1] = warped[y0-dy:y1-dy, x0-dx:x1-dx]
+
+        # Exposed rows spanning the full width, then exposed columns next to
+        # the retained region.
+        strips = []
+        if dy > 0:
+            strips.append((0, 0, width, dy))
+        elif dy < 0:
+            strips.append((0, y1, width, -dy))
+
+        if dx > 0:
+            strips.append((0, y0, dx, y1 - y0))
+        elif dx < 0:
+            strips.append((x1, y0, -dx, y1 - y0))
+
+        for x, y, w, h in strips:
+            h_strip = np.dot(inverse_homography, [[1,0,x],[0,1,y],[0,0,1]])
+            warped[y:y+h, x:x+w] = self.warp_source(source, h_strip, (w, h),
+                                                    flags)
+
+    def convert_to_rgb(self, warped, window, rgb):
+        """Convert a warped view of the raw image to RGB for display.
+
+        :param warped: Panel-sized view with the type and channels of the raw
+            image.
+        :type warped: numpy.ndarray
+
+        :param window: Display window passed to apply_window. If None, 8-bit
+            images are displayed as is, and other types are mapped from the
+            full range of their type (0-1 for floating point).
+        :type window: (float, float) | None
+
+        :param rgb: Output RGB buffer.
+        :type rgb: numpy.ndarray
+
+        """
+        if window is None and warped.dtype != np.uint8:
+            if warped.dtype.kind in 'iu':
+                window = (np.iinfo(warped.dtype).min,
+                          np.iinfo(warped.dtype).max)
+            else:
+                window = (0, 1)
+
+        if window is not None:
+            if warped.ndim == 3 and warped.shape[2] == 3:
+                return apply_window(warped, window, dst=rgb)
+
+            windowed = self._get_buffer('windowed', warped.shape, np.uint8)
+            warped = apply_window(warped, window, dst=windowed)
+
+        if warped.ndim == 2:
+            cv2.cvtColor(warped, cv2.COLOR_GRAY2RGB, dst=rgb)
+        elif warped.shape[2] == 4:
+            cv2.cvtColor(warped, cv2.COLOR_RGBA2RGB, dst=rgb)
+        else:
+            np.copyto(rgb, warped)
+
+        return rgb
+
+    def rewindow(self, window):
+        """Apply a new display window to the last rendered view, without
+        warping the raw image again.
+
+        Must not be called while a render is in progress.
+
+        :param window: Lower and upper bound, or None to display 8-bit images
+            as is.
+        :type window: (float, float) | None
+
+        :return: RGB image, or None if the last rendered view was not the
+            current view with its raw values kept.
+        :rtype: numpy.ndarray | None
+
+        """
+        key = self.render_key()
+        if self._warped_key != key[:-1]:
+            return None
+
+        return self.convert_to_rgb(self._buffers['warped'], window,
+                                   self._buffers['rgb'])
+
+    def warp_source(self, source, inverse_homography, dsize, flags,
+                    dst=None):
+        """Warp the source image into the panel coordinate system.
+
+        :param source: Image to warp. Pyramid levels of images read on demand
+            are ImageSources, of which only the visible region is read.
+        :type source: numpy.ndarray | ImageSource
+
+        :param inverse_homography: Homography that warps from the panel
+            coordinate system to the source image coordinate system.
+        :type inverse_homography: numpy.ndarray of shape (3,3)
+
+        :param dsize: Size (width, height) of the output image.
+        :type dsize: 2-tuple of int
+
+        :param flags: OpenCV interpolation flags.
+        :type flags: int
+
+        :param dst: Optional array to write the warped image into.
+        :type dst: numpy.ndarray | None
+
+        :return: Warped image.
+        :rtype: numpy.ndarray
+
+        """
+        if isinstance(source, ImageSource):
+            return self.warp_visible_region(source, inverse_homography,
+                                            dsize, flags, dst)
+
+        return cv2.warpPerspective(source, inverse_homography, dst=dst,
+                                   dsize=dsize, flags=flags)
+
+    def warp_visible_region(self, source, inverse_homography, dsize, flags,
+                            dst=None):
+        """Warp only the region of the source image visible in the panel.
+
+        The panel corners are projected back into the source image, and only
+        the bounding box of the result, padded by the support of the
+        interpolation kernel, is read and passed to OpenCV. When the
+        homography is affine, the cheaper cv2.warpAffine is used.
+
+        """
+        panel_width, panel_height = dsize
+        corners = np.array([[0,panel_width,panel_width,0],
+                            [0,0,panel_height,panel_height],
+                            [1,1,1,1]])
+        pts = np.dot(inverse_homography, corners)
+
+        # If any corner maps to or beyond the horizon, the bounding box is not
+        # defined, and we fall back to warping the whole image.
+        if np.all(pts[2] > 0):
+            pts = pts[:2]/pts[2]
+            im_height, im_width = source.shape[:2]
+
+            # Lanczos4 has the widest support of the interpolation options.
+            pad = 4
+            x0 = max(int(np.floor(pts[0].min())) - pad, 0)
+            y0 = max(int(np.floor(pts[1].min())) - pad, 0)
+            x1 = min(int(np.ceil(pts[0].max())) + pad + 1, im_width)
+            y1 = min(int(np.ceil(pts[1].max())) + pad + 1, im_height)
+
+            if x0 >= x1 or y0 >= y1:
+                # The view does not overlap the image.
+                if dst is None:
+                    dst = np.empty((panel_height, panel_width) +
+                                   source.shape[2:], dtype=source.dtype)
+
+                dst[...] = 0
+                return dst
+
+            source = source[y0:y1, x0:x1]
+            inverse_homography = np.dot([[1,0,-x0],[0,1,-y0],[0,0,1]],
+                                        inverse_homography)
+
+        if isinstance(source, ImageSource):
+            # Only reached when falling back to the whole image.
+            source = source[:, :]
+
+        inverse_homography = inverse_homography/inverse_homography[2,2]
+        if np.allclose(inverse_homography[2,:2], 0):
+            return cv2.warpAffine(source, inverse_homography[:2], dst=dst,
+                                  dsize=dsize, flags=flags)
+
+        return cv2.warpPerspective(source, inverse_homography, dst=dst,
+                                   dsize=dsize, flags=flags)
+
+    def get_view_rect(self, margin=0, rect=None):
+        """Return the bounding box of the panel view in raw image coordinates.
+
+        :param margin: Number of panel pixels to grow the view by on each side.
+        :type margin: float
+
+        :param rect: Part (x, y, width, height) of the panel to consider. If
+            None, the whole panel is used.
+        :type rect: 4-tuple of int | None
+
+        :return: Bounding box (x0, y0, x1, y1), or None if the view is not
+            bounded in the raw image (i.e., it contains the horizon of the
+            homography).
+        :rtype: 4-tuple of float | None
+
+        """
+        if rect is None:
+            panel_width, panel_height = self.size
+            rect = (0, 0, panel_width, panel_height)
+
+        x0, y0 = rect[0] - margin, rect[1] - margin
+        x1, y1 = rect[0] + rect[2] + margin, rect[1] + rect[3] + margin
+        pts = np.dot(self.inverse_homography, [[x0,x1,x1,x0],
+                                               [y0,y0,y1,y1],
+                                               [1,1,1,1]])
+        if not np.all(pts[2] > 0):
+            return None
+
+        pts = pts[:2]/pts[2]
+        return pts[0].min(), pts[1].min(), pts[0].max(), pts[1].max()
+
+    def marker_positions(self, points, margin=0):
+        """Transform raw image points into the panel.
+
+        All points are transformed in one batched operation, and points that
+        fall outside of the panel by more than 'margin' are culled.
+
+        :param points: Raw image coordinates. Points that are not finite are
+            culled.
+        :type points: Nx2 numpy.ndarray | 2-array
+
+        :param margin: Distance in panel pixels outside of the panel within
+            which points are kept (e.g., the radius of a marker).
+        :type margin: float
+
+        :return: Panel coordinates of the points that were kept and their
+            indices into 'points'.
+        :rtype: (Mx2 numpy.ndarray, M-array of int)
+
+        """
+        points = np.atleast_2d(points)
+        pts = np.dot(self.homography[:,:2], points.T) + \
+              self.homography[:,2:]
+
+        panel_width, panel_height = self.size
+        r = margin
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x = pts[0]/pts[2]
+            y = pts[1]/pts[2]
+            ind = np.logical_and.reduce([pts[2] > 0,
+                                         x > -r, x < panel_width + r,
+                                         y > -r, y < panel_height + r])
+
+        ind = np.flatnonzero(ind)
+        return np.column_stack([x[ind], y[ind]]), ind
+
+
+class NavigationViewport(Viewport):
+    """View that fits the whole image into the panel.
+
+    Attributes:
+    :param align_homography: Homography that "corrects" the image. It takes
+        image coordinates from the raw image and returns the corrected image
+        coordinates.
+    :param corrected_img_shape: Desired output resolution after
+        'align_homography' is applied to the raw image.
+
+    """
+    def __init__(self, raw_image=None, size=(1, 1), interpolation=1,
+                 image_key=None, image_pyramid=None):
+        self.align_homography = None
+        self.corrected_img_shape = None
+        super(NavigationViewport, self).__init__(raw_image, size,
+                                                 interpolation, image_key,
+                                                 image_pyramid)
+
+    def set_image(self, raw_image, image_key=None, image_pyramid=None):
+        if self.align_homography is None or self.corrected_img_shape is None:
+            # If align_homography is set, that means the image is to be warped
+            # to align with another image, and 'corrected_img_shape' should be
+            # the resolution of the other image. Otherwise, there is no
+            # correction, and corrected_image_shape matches the raw image.
+            self.corrected_img_shape = raw_image.shape[:2]
+
+        super(NavigationViewport, self).set_image(raw_image, image_key,
+                                                  image_pyramid)
+
+    def update_homography(self):
+        panel_width, panel_height = self.size
+
+        # The corrected image shape comes from the dimensions of the image that
+        # this one is being corrected to.
+        im_height, im_width = self.corrected_img_shape
+
+        if im_width/im_height > panel_width/panel_height:
+            # Side edges of image should hit the edges of the panel.
+            s = panel_width/im_width
+            ty = (panel_height - s*im_height)/2
+            h = np.array([[s,0,0],[0,s,ty],[0,0,1]])
+        else:
+            # Top edges of image should hit the edges of the panel.
+            s = panel_height/im_height
+            tx = (panel_width-s*im_width)/2
+            h = np.array([[s,0,tx],[0,s,0],[0,0,1]])
+
+        if self.align_homography is not None:
+            h = np.dot(h, self.align_homography)
+
+        self.homography = h
+
+    def get_zoom_box(self, view):
+        """Return the outline of another view of the same image (e.g., a
+        ZoomViewport) in panel coordinates.
+
+        :param view: View to outline.
+        :type view: Viewport
+
+        :return: Closed polygon with the first corner repeated at the end, or
+            None if either view has no homography.
+        :rtype: numpy.ndarray of shape (2,5) | None
+
+        """
+        if self.homography is None or view.inverse_homography is None:
+            return None
+
+        w, h = view.size
+        pts = np.array([[0,w,w,0,0],[0,0,h,h,0],[1,1,1,1,1]])
+        pts = np.dot(view.inverse_homography, pts)
+        pts = np.dot(self.homography, pts)
+        return pts[:2]/pts[2]
+
+
+class ZoomViewport(Viewport):
+    """View of the image magnified about a center point.
+
+    The translation of the homography is rounded to whole panel pixels, so
+    views at the same zoom differ by whole-pixel translations, and a panned
+    view is rendered by scrolling the previous one (see scroll_render).
+
+    Attributes:
+    :param align_homography: Homography that "corrects" the image (see
+        NavigationViewport).
+    :param corrected_img_shape: Desired output resolution after
+        'align_homography' is applied to the raw image.
+
+    """
+    def __init__(self, raw_image=None, size=(1, 1), interpolation=1,
+                 image_key=None, image_pyramid=None, zoom=400, center=None):
+        """
+        :param zoom: Percent zoom.
+        :type zoom: float
+
+        :param center: Full-image coordinates corresponding to the center of
+            the view. If None, the view is centered on the image.
+        :type center: 2-array of float | None
+
+        """
+        self.align_homography = None
+        self.corrected_img_shape = None
+        self._zoom = zoom
+        self._center = None
+        super(ZoomViewport, self).__init__(raw_image, size, interpolation,
+                                           image_key, image_pyramid)
+        if center is not None:
+            self.set_center(center)
+
+    @property
+    def zoom(self):
+        return self._zoom
+
+    @property
+    def center(self):
+        return self._center
+
+    def set_image(self, raw_image, image_key=None, image_pyramid=None):
+        corrected_img_shape0 = self.corrected_img_shape
+
+        if self.align_homography is None:
+            # If align_homography is set, that means the image is to be warped
+            # to align with another image, and 'corrected_img_shape' should be
+            # the resolution of the other image. Otherwise, there is no
+            # correction, and corrected_image_shape matches the raw image.
+            self.corrected_img_shape = raw_image.shape[:2]
+
+        if self.corrected_img_shape != corrected_img_shape0:
+            self._center = np.array(raw_image.shape[:2][::-1])/2
+
+        super(ZoomViewport, self).set_image(raw_image, image_key,
+                                            image_pyramid)
+
+    def set_center(self, center):
+        """
+        :param center: Location for the zoom center in the original image's
+            coordinates.
+        :type center: 2-array
+        """
+        self._center = center
+        self.update()
+
+    def get_min_zoom(self):
+        """Return the smallest zoom, at which the image fits into the panel.
+
+        """
+        panel_width, panel_height = self.size
+        im_height, im_width = self.raw_image.shape[:2]
+        min_zoom = np.minimum(panel_width/im_width, panel_height/im_height)*100
+        return int(np.ceil(min_zoom))
+
+    def set_zoom(self, zoom):
+        """
+        :param zoom: Zoom percentage, which is clamped to 'get_min_zoom'.
+        :type zoom: float
+
+        :return: The zoom that was set.
+        :rtype: float
+
+        """
+        if self.raw_image is not None:
+            zoom = max(zoom, self.get_min_zoom())
+
+        self._zoom = zoom
+        self.update()
+        return zoom
+
+    def update_homography(self):
+        if self.raw_image is None:
+            return
+
+        panel_width, panel_height = self.size
+        s = self._zoom/100
+
+        if self.align_homography is not None:
+            # Get the coordinate in the "corrected" image of the clicked center.
+            center = np.dot(self.align_homography, [self._center[0],
+                                                    self._center[1], 1])
+            center = center[:2]/center[2]
+        else:
+            center = self._center
+
+        # Round to whole pixels, so that views at the same zoom differ by
+        # whole-pixel translations.
+        tx = np.round(panel_width/2-s*center[0])
+        ty = np.round(panel_height/2-s*center[1])
+        h_zoom = np.array([[s,0,tx],[0,s,ty],[0,0,1]])
+
+        if self.align_homography is not None:
+            self.homography = np.dot(h_zoom, self.align_homography)
+        else:
+            self.homography = h_zoom
+
+    def warp_source(self, source, inverse_homography, dsize, flags,
+                    dst=None):
+        """Warp only the region of the source image visible in the panel.
+
+        """
+        return self.warp_visible_region(source, inverse_homography, dsize,
+                                        flags, dst)
@@ -5,13 +5,45 @@ from wx.lib.wordwrap import wordwrap
 import cv2
 import numpy as np
 import os
-import transformations
+import collections
+import threading
+import time
+import traceback
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 # TODO: cleaner solution for relative import handling.
 try:
   import form_builder_output
+  from image_source import (LRUCache, ImageSource, PyramidDiskCache,
+                            open_image_source)
+  from profiling import StageTimer, timed
+  from matching import suggest_matches, create_pool, FEATURE_TYPES
+  from session import (SessionRecorder, SESSION_VERSION, PANEL_NAMES,
+                       latency_percentiles)
+  from core import (update_contrast, stretch_range_to_8bit,
+                    ImageHistogram, apply_window, read_image, image_keys,
+                    pixel_translation, ImagePyramid, PointGridIndex,
+                    CorrespondenceStore, PointSelection, RenderRequest,
+                    Viewport, NavigationViewport, ZoomViewport,
+                    error_summary, align_views, contrast_pyramid)
 except ImportError:
   from . import form_builder_output
+  from .image_source import (LRUCache, ImageSource, PyramidDiskCache,
+                             open_image_source)
+  from .profiling import StageTimer, timed
+  from .matching import suggest_matches, create_pool, FEATURE_TYPES
+  from .session import (SessionRecorder, SESSION_VERSION, PANEL_NAMES,
+                        latency_percentiles)
+  from .core import (update_contrast, stretch_range_to_8bit,
+                     ImageHistogram, apply_window, read_image, image_keys,
+                     pixel_translation, ImagePyramid, PointGridIndex,
+                     CorrespondenceStore, PointSelection, RenderRequest,
+                     Viewport, NavigationViewport, ZoomViewport,
+                     error_summary, align_views, contrast_pyramid)
 
 
 license_str = ''.join(['Copyright 2017-2018 by Kitware, Inc.\n',
@@ -43,27 +75,294 @@ license_str = ''.join(['Copyright 2017-2018 by Kitware, Inc.\n',
 'POSSIBILITY OF SUCH DAMAGE.'])
 
 
-def update_contrast(image, c):
-    clahe = cv2.createCLAHE(clipLimit=c, tileGridSize=(10,10))
-    if image.ndim == 3:
-        HLS = cv2.cvtColor(image, cv2.COLOR_BGR2HLS)
-        HLS[:,:,1] = clahe.apply(HLS[:,:,1])
-        image = cv2.cvtColor(HLS, cv2.COLOR_HLS2BGR)
-    else:
-        image = clahe.apply(image)
+# Image file to load into one side, read by a RenderWorker. 'load_id' identifies
+# the most recent load of that side.
+LoadRequest = collections.namedtuple('LoadRequest', ['side', 'file_path',
+                                                     'load_id'])
+
+# Suggested matches between the images of both sides (see
+# keypointgui.matching), computed by a RenderWorker. 'pyramids' are the
+# pyramids of the images that the features are detected in, and 'windows'
+# their display windows. 'match_id' identifies the most recent request.
+MatchRequest = collections.namedtuple('MatchRequest',
+                                      ['pyramids', 'windows', 'feature_type',
+                                       'ratio', 'cross_check',
+                                       'ransac_threshold', 'homography_type',
+                                       'match_id'])
+
+# Contrast adjustment of one side's image, computed by a RenderWorker.
+ContrastRequest = collections.namedtuple('ContrastRequest',
+                                         ['side', 'image_key',
+                                          'image_pyramid', 'clip_limit',
+                                          'preview_level'])
+
+
+class RenderPool(object):
+    """Fixed set of threads shared by the RenderWorkers of several panels.
+
+    Re-rendering all panels at once (e.g., after changing the interpolation)
+    then runs at most 'num_threads' renders in parallel, which together with
+    the number of threads OpenCV uses within each render (see
+    cv2.setNumThreads) bounds the load on the CPU.
+
+    """
+    def __init__(self, num_threads=None):
+        """
+        :param num_threads: Number of threads. Defaults to the number of
+            panels (four) or the number of CPUs, whichever is smaller.
+        :type num_threads: int | None
+
+        """
+        if num_threads is None:
+            num_threads = min(4, cv2.getNumberOfCPUs())
+
+        self.num_threads = num_threads
+        self._tasks = queue.Queue()
+        self._threads = []
+        for _ in range(num_threads):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, task):
+        """Run 'task' (a function without arguments) on one of the threads.
+
+        """
+        self._tasks.put(task)
+
+    def stop(self):
+        for _ in self._threads:
+            self._tasks.put(None)
+
+    def _run(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+
+            try:
+                task()
+            except Exception:
+                traceback.print_exc()
+
+
+class RenderWorker(object):
+    """Background thread that renders the newest of a stream of requests.
+
+    Requests are submitted from the GUI thread. Only the most recent request
+    that has not started rendering is kept, so a burst of requests (e.g., from
+    spinning the mouse wheel) results in at most one render in progress and
+    one waiting. The OpenCV warps release the GIL, so the GUI thread keeps
+    processing events while a render is in progress. Finished results are
+    handed back to the GUI thread with wx.CallAfter.
+
+    If a RenderPool is given, requests are rendered on the threads of the pool
+    instead of a dedicated thread.
+
+    """
+    def __init__(self, render, callback, pool=None):
+        """
+        :param render: Function called on the worker thread with a request,
+            returning the rendered result.
+        :type render: callable
+
+        :param callback: Function called on the GUI thread with the request
+            and the rendered result.
+        :type callback: callable
+
+        :param pool: Threads to render on.
+        :type pool: RenderPool | None
+
+        """
+        self._render = render
+        self._callback = callback
+        self._condition = threading.Condition()
+        self._pending = None
+        self._busy = False
+        self._stopped = False
+        self._pool = pool
+        self._scheduled = False
+        if pool is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    @property
+    def idle(self):
+        """True if no request is pending or being rendered.
+
+        """
+        with self._condition:
+            return self._pending is None and not self._busy
+
+    @property
+    def has_pending(self):
+        """True if a newer request is waiting, i.e., the result of the one
+        being rendered will not be needed.
+
+        """
+        with self._condition:
+            return self._pending is not None or self._stopped
+
+    def submit(self, request):
+        """Queue a request, replacing any request that has not yet started.
+
+        """
+        with self._condition:
+            self._pending = request
+            if self._pool is not None and not self._scheduled:
+                # At most one task per worker is queued in the pool, so the
+                # requests of one panel never render concurrently.
+                self._scheduled = True
+                self._pool.submit(self._run_pending)
+
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._pending = None
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None and not self._stopped:
+                    self._condition.wait()
+
+                if self._stopped:
+                    return
+
+                request = self._pending
+                self._pending = None
+                self._busy = True
+
+            if not self._process(request):
+                return
+
+    def _run_pending(self):
+        with self._condition:
+            if self._pending is None or self._stopped:
+                self._scheduled = False
+                return
+
+            request = self._pending
+            self._pending = None
+            self._busy = True
+
+        self._process(request)
+
+        with self._condition:
+            if self._pending is not None and not self._stopped:
+                # Go to the back of the queue, so other panels get a turn.
+                self._pool.submit(self._run_pending)
+            else:
+                self._scheduled = False
+
+    def _process(self, request):
+        """Render a request and hand the result to the GUI thread.
+
+        :return: False if the worker was stopped.
+        :rtype: bool
+
+        """
+        try:
+            result = self._render(request)
+        except Exception:
+            traceback.print_exc()
+            result = None
+
+        with self._condition:
+            self._busy = False
+            if self._stopped:
+                return False
+
+        if result is not None:
+            wx.CallAfter(self._callback, request, result)
+
+        return True
+
+
+class FrameCoalescer(object):
+    """Collapse bursts of calls into at most one call per frame.
+
+    Input events such as mouse motion can arrive much faster than the panels
+    can be updated, e.g., over a remote X11 connection. The first call after a
+    quiet period is made immediately. Further calls within the same frame
+    only replace the arguments of a single call made once the frame has
+    passed, so the function is always called with the latest arguments and
+    the event queue does not back up.
+
+    Must be used on the GUI thread.
+
+    """
+    def __init__(self, func, interval=16):
+        """
+        :param func: Function to call.
+        :type func: callable
+
+        :param interval: Frame interval in milliseconds.
+        :type interval: int
+
+        """
+        self.func = func
+        self.interval = interval
+        self._args = None
+        self._timer = None
+        self._last_time = None
+
+    @property
+    def pending(self):
+        """True if a call is scheduled.
+
+        """
+        return self._args is not None
+
+    def __call__(self, *args):
+        now = time.time()
+        if self._args is not None:
+            # A call is already scheduled.
+            self._args = args
+            return
+
+        if (self._last_time is None or
+            now - self._last_time >= self.interval/1000):
+            self._call(args)
+            return
+
+        self._args = args
+        delay = self._last_time + self.interval/1000 - now
+        delay = max(int(np.ceil(delay*1000)), 1)
+        if self._timer is None:
+            self._timer = wx.CallLater(delay, self.flush)
+        else:
+            self._timer.Start(delay)
+
+    def flush(self):
+        """Make the scheduled call, if there is one, now.
+
+        """
+        if self._timer is not None:
+            self._timer.Stop()
+
+        args = self._args
+        if args is not None:
+            self._args = None
+            self._call(args)
+
+    def stop(self):
+        """Cancel the scheduled call.
 
-    return image
+        """
+        if self._timer is not None:
+            self._timer.Stop()
 
+        self._args = None
 
-def stretch_range_to_8bit(image):
-    lower_bound = np.min(image)
-    upper_bound = np.max(image)
-    lut = np.concatenate([
-        np.zeros(lower_bound, dtype=np.uint16),
-        np.linspace(0, 255, upper_bound - lower_bound).astype(np.uint16),
-        np.ones(2**16 - upper_bound, dtype=np.uint16) * 255
-    ])
-    return lut[image].astype(np.uint8)
+    def _call(self, args):
+        self._last_time = time.time()
+        self.func(*args)
 
 
 class ImagePanelManager(object):
@@ -71,50 +370,93 @@ class ImagePanelManager(object):
 
     This class allows a warped version of an image to be displayed in a panel
     while providing convenient operations defined in raw image coordinates.
-    This object contains a raw version of an image but displays a warped
-    version in the panel defined by a homography. When a user clicks on the
-    panel image, the abstract method 'process_clicked_point' is called with the
-    raw-image coordinates of the feature that was clicked. Likewise, if an
-    instance of wx.StatusBar is passed, the raw-image coordinates will be
-    displayed when the mouse hovers over the image.
-
-    The object also allows blue and red circle markers to be specified in
-    raw-image coordinates and then appropriately drawn on the warped image in
-    the panel.
-
-    Common subclass functionality include rescaling an image to fit the panel
-    and warping the image to rectify it relative to another panel image.
-
-    Note: the image coordinate system has its orgin (0,0) at the center of the
-    upper left pixel.
+    The geometry and rendering of the view are handled by a Viewport from
+    keypointgui.core, and this class adapts it to a wx.Panel: it renders views
+    on a background thread, caches them, displays them, and handles input.
+    When a user clicks on the panel image, the abstract method
+    'process_clicked_point' is called with the raw-image coordinates of the
+    feature that was clicked. Likewise, if an instance of wx.StatusBar is
+    passed, the raw-image coordinates will be displayed when the mouse hovers
+    over the image.
+
+    The object also draws circle markers at the point correspondences in a
+    CorrespondenceStore, which may be shared between panels: red for accepted
+    correspondences and blue for a point whose match has not been selected
+    yet. Green markers can be specified directly in raw-image coordinates.
+
+    Subclasses choose the kind of view with 'view_class'.
 
     Attributes:
-    :param raw_image: The original full-resolution source image.
-    :type raw_image: numpy.ndarray
+    :param view: View of the image shown in the panel. The properties
+        raw_image, image_pyramid, image_key, homography, inverse_homography,
+        interpolation, and display_window are those of the view.
+    :type view: Viewport
 
     :param wx_panel: Panel to add the image to.
     :type wx_panel: wx.Panel
 
-    :param homography: Homography that warps from the raw_image coordinate
-        system to the panel image coordinate system.
-    :type homography: numpy.ndarray of shape (3,3)
+    :param wx_bitmap: Image container with size matching the wx_panel size.
+        It is None until the first view has been rendered.
+    :type wx_bitmap: wx.Bitmap | None
 
-    :param wx_image: Image container with size matching the wx_panel size.
-    :type wx_image: wx.Image
+    :param correspondences: Point correspondences to draw.
+    :type correspondences: CorrespondenceStore
 
-    :param wx_bitmap: Image container with size matching the wx_panel size.
-    :type wx_bitmap: wx.Bitmap
+    :param side: Which image of the correspondences the panel shows (0 for
+        left, 1 for right).
+    :type side: int
+
+    :param green_points: Raw image coordinates to draw green circles at.
+    :type green_points: Nx2 numpy.ndarray
+
+    :param render_cache: Cache of rendered panel bitmaps, which may be shared
+        between panels.
+    :type render_cache: LRUCache | None
+
+    :param render_worker: Background thread that renders views, or None if
+        views are rendered synchronously.
+    :type render_worker: RenderWorker | None
+
+    :param refine_delay: Milliseconds of idle input after which an interactive
+        nearest-neighbor preview is replaced by a full-quality render.
+    :type refine_delay: int
+
+    :param max_dirty_rects: Maximum number of marker rectangles invalidated
+        individually by refresh_points. Beyond this, one rectangle bounding all
+        of the markers is invalidated.
+    :type max_dirty_rects: int
+
+    :param marginal_colour: Colour of the markers of accepted correspondences
+        whose reprojection error under the current fit is between half of
+        and the full threshold of 'correspondences.residuals' (those below are
+        red).
+    :type marginal_colour: wx.Colour
+
+    :param outlier_colour: Colour of the markers of correspondences flagged as
+        outliers by a robust fit or whose reprojection error under the current
+        fit exceeds the threshold.
+    :type outlier_colour: wx.Colour
+
+    :param stage_timer: Times the stages of updating the panel (e.g.,
+        'warp_image', 'render', 'to_bitmap', 'paint') and the time from a
+        change of the view until it is painted ('frame'), or None.
+    :type stage_timer: StageTimer | None
 
-    :param blue_points: Raw image coordinates to draw blue circles at.
-    :type blue_points: Nx2 numpy.ndarray
+    :param stage_category: Category of the stages timed for this panel.
+    :type stage_category: str
 
-    :param red_points: Raw image coordinates to draw red circles at.
-    :type red_points: Nx2 numpy.ndarray
+    :param show_stats: Draw the recent frame and stage times and the render
+        cache hit rate in the upper left corner of the panel.
+    :type show_stats: bool
 
     """
+    view_class = Viewport
+
     def __init__(self, wx_panel, raw_image=None, interpolation=1,
-                 status_bar=None, red_points=None, green_points=None,
-                 blue_points=None):
+                 status_bar=None, correspondences=None, side=0,
+                 green_points=None, render_cache=None, threaded_render=True,
+                 render_pool=None, view=None, stage_timer=None,
+                 stage_category=None):
         """Abstract base class.
 
         :param wx_panel: Panel to add the image to.
@@ -131,34 +473,96 @@ class ImagePanelManager(object):
         :param status_bar: Status bar.
         :type status_bar: wx.StatusBar | None
 
-        :param blue_points: Raw image coordinates to draw blue circles at.
-        :type blue_points: Nx2 numpy.ndarray
+        :param correspondences: Point correspondences to draw. If None, the
+            panel gets its own empty store.
+        :type correspondences: CorrespondenceStore | None
+
+        :param side: Which image of the correspondences the panel shows (0 for
+            left, 1 for right).
+        :type side: int
+
+        :param green_points: Raw image coordinates to draw green circles at.
+        :type green_points: Nx2 numpy.ndarray
+
+        :param render_cache: Cache of rendered panel bitmaps. Views that were
+            already rendered are drawn from the cache instead of re-warping
+            the image.
+        :type render_cache: LRUCache | None
+
+        :param threaded_render: Render views on a background thread so that
+            the GUI remains responsive while large images are warped.
+        :type threaded_render: bool
+
+        :param render_pool: Threads shared with other panels to render on. If
+            None, the panel gets its own render thread.
+        :type render_pool: RenderPool | None
+
+        :param view: View to show. If None, an instance of 'view_class' is
+            created for 'raw_image'.
+        :type view: Viewport | None
+
+        :param stage_timer: Timer of the stages of updating the panel, which
+            may be shared with other panels. If None, the panel gets its own.
+        :type stage_timer: StageTimer | None
 
-        :param red_points: Raw image coordinates to draw red circles at.
-        :type red_points: Nx2 numpy.ndarray
+        :param stage_category: Category of the stages timed for this panel.
+            Defaults to the name of the class.
+        :type stage_category: str | None
 
         """
+        if stage_timer is None:
+            stage_timer = StageTimer()
+
+        self.stage_timer = stage_timer
+        self.stage_category = stage_category or type(self).__name__
+        self.show_stats = False
+
+        # Start time of a view change that has not been painted yet, and
+        # whether its rendering is shown in the bitmap.
+        self._frame_start = None
+        self._frame_shown = False
+
         self.wx_panel = wx_panel
-        self.raw_image = raw_image
+        if view is None:
+            view = self.view_class(raw_image,
+                                   size=tuple(self.wx_panel.GetSize()))
 
-        if raw_image is not None:
-            self.corrected_img_shape = self.raw_image.shape[:2]
-        else:
-            self.corrected_img_shape = None
+        self.view = view
+        self.render_cache = render_cache
 
         self.image = None
-        self.wx_image = None
-        self._blue_points = blue_points
-        self._red_points = red_points
+        self.wx_bitmap = None
+        self._render_key = None
+        self._refine_timer = None
+        self.refine_delay = 150
+        if correspondences is None:
+            correspondences = CorrespondenceStore()
+
+        self.correspondences = correspondences
+        self.side = side
         self._green_points = green_points
         self.circle_radius = 5
         self.circle_thickness = 3
+        self.max_dirty_rects = 16
+        self.marginal_colour = wx.Colour(255, 128, 0)
+        self.outlier_colour = wx.YELLOW
 
         if interpolation is not None:
             self.set_interpolation(interpolation)
 
         self.status_bar = status_bar
 
+        if threaded_render:
+            self.render_worker = RenderWorker(self.render,
+                                              self.on_render_finished,
+                                              render_pool)
+        else:
+            self.render_worker = None
+
+        # Handle bursts of mouse motion and resizing once per frame.
+        self._motion_coalescer = FrameCoalescer(self.show_mouse_position)
+        self._size_coalescer = FrameCoalescer(self.update_all)
+
         # Needed by
         self.wx_panel.SetBackgroundStyle(wx.BG_STYLE_CUSTOM)
 
@@ -168,15 +572,55 @@ class ImagePanelManager(object):
         # coordinates.
         self.wx_panel.Bind(wx.EVT_LEFT_DOWN, self.on_click)
         self.wx_panel.Bind(wx.EVT_RIGHT_DOWN, self.on_click)
+        self.wx_panel.Bind(wx.EVT_MIDDLE_DOWN, self.on_click)
         self.wx_panel.Bind(wx.EVT_MOTION, self.on_mouse_over)
 
         self.wx_panel.Bind(wx.EVT_PAINT, self.on_paint)
         self.wx_panel.Bind(wx.EVT_SIZE, self.on_size)
         # --------------------------------------------------------------------
 
+    @property
+    def raw_image(self):
+        return self.view.raw_image
+
+    @property
+    def image_pyramid(self):
+        return self.view.image_pyramid
+
+    @property
+    def image_key(self):
+        return self.view.image_key
+
+    @property
+    def homography(self):
+        return self.view.homography
+
+    @property
+    def inverse_homography(self):
+        return self.view.inverse_homography
+
+    @property
+    def interpolation(self):
+        return self.view.interpolation
+
+    @property
+    def display_window(self):
+        return self.view.display_window
+
+    @display_window.setter
+    def display_window(self, window):
+        self.view.display_window = window
+
     @property
     def red_points(self):
-        return self._red_points
+        """Raw image coordinates of accepted correspondences in this image.
+
+        """
+        points = self.correspondences.select([CorrespondenceStore.ACCEPTED])
+        if len(points) == 0:
+            return None
+
+        return points[:, 2*self.side:2*self.side+2]
 
     @property
     def green_points(self):
@@ -184,49 +628,261 @@ class ImagePanelManager(object):
 
     @property
     def blue_points(self):
-        return self._blue_points
+        """Raw image coordinates of points in this image that are waiting for
+        their match to be selected.
+
+        """
+        points = self.correspondences.select([CorrespondenceStore.PENDING])
+        points = points[:, 2*self.side:2*self.side+2]
+        points = points[np.all(np.isfinite(points), axis=1)]
+        if len(points) == 0:
+            return None
+
+        return points
+
+    @property
+    def settled(self):
+        """True if the current view is displayed and no input is waiting to be
+        handled.
 
-    def update_raw_image(self, raw_image):
+        """
+        if self.render_worker is not None and not self.render_worker.idle:
+            return False
+
+        return (self._frame_start is None and
+                not self._motion_coalescer.pending and
+                not self._size_coalescer.pending)
+
+    @timed()
+    def update_raw_image(self, raw_image, image_key=None, image_pyramid=None):
         """Replace raw_image and update the rendered view in the panel.
 
+        :param image_key: Hashable value identifying the content of
+            'raw_image' (e.g., the source image and contrast setting it was
+            derived from) used to look up previously rendered views. If None, a
+            new unique key is generated.
+        :type image_key: hashable | None
+
+        :param image_pyramid: Pyramid to render from, which may be shared with
+            other panels or hold a different version of 'raw_image' (e.g., a
+            contrast-adjusted preview). If None, one is built from 'raw_image'.
+        :type image_pyramid: ImagePyramid | None
+
         """
-        self.raw_image = raw_image
+        if raw_image is None:
+            return
+
+        self.view.size = tuple(self.wx_panel.GetSize())
+        self.view.set_image(raw_image, image_key, image_pyramid)
 
         # The resolution of the image could have changed, so we need to update
         # everything.
         self.update_all()
 
-    def warp_image(self):
+    def get_view_level(self):
+        """Return the pyramid level that the current view is rendered from.
+
+        """
+        return self.view.get_view_level()
+
+    @timed()
+    def warp_image(self, interactive=False):
         """Apply homography.
 
+        If the current view was rendered before, the cached bitmap is used
+        immediately. Otherwise, the view is rendered by the render worker, and
+        the panel is refreshed once it is finished.
+
+        :param interactive: The view is changing in response to ongoing user
+            input. A fast nearest-neighbor preview is rendered, and the view is
+            re-rendered with the selected interpolation once the input has been
+            idle for 'refine_delay' milliseconds.
+        :type interactive: bool
+
+        :return: True if the panel bitmap was updated immediately.
+        :rtype: bool
+
+        """
+        if self.raw_image is None or self.inverse_homography is None:
+            return False
+
+        if self._frame_start is None:
+            self._frame_start = StageTimer.now()
+
+        if self._refine_timer is not None:
+            self._refine_timer.Stop()
+
+        interpolation = self.interpolation
+        key = self.view.render_key(interpolation)
+        if self._show_cached(key):
+            return True
+
+        if interactive and interpolation != cv2.INTER_NEAREST:
+            interpolation = cv2.INTER_NEAREST
+            key = self.view.render_key(interpolation)
+
+            if self._refine_timer is None:
+                self._refine_timer = wx.CallLater(self.refine_delay,
+                                                  self.refine)
+            else:
+                self._refine_timer.Start(self.refine_delay)
+
+            if self._show_cached(key):
+                return True
+
+        self._render_key = key
+        request = self.view.get_request(interpolation, key)
+
+        if self.render_worker is not None:
+            self.render_worker.submit(request)
+            return False
+
+        self.on_render_finished(request, self.render(request),
+                                refresh=False)
+        return True
+
+    def _show_cached(self, key):
+        """Display the cached rendering for 'key', if there is one.
+
+        """
+        if self.render_cache is None:
+            return False
+
+        image = self.render_cache.get(key)
+        if self.stage_timer is not None:
+            self.stage_timer.count('render_cache', image is not None,
+                                   self.stage_category)
+
+        if image is None:
+            return False
+
+        self._render_key = key
+        self._show_image(image)
+        return True
+
+    @timed('to_bitmap')
+    def _show_image(self, image):
+        """Copy an RGB image into the panel bitmap.
+
+        The bitmap is only reallocated when the panel size changes.
+
+        """
+        height, width = image.shape[:2]
+        if (self.wx_bitmap is None or
+            tuple(self.wx_bitmap.GetSize()) != (width, height)):
+            self.wx_bitmap = wx.Bitmap.FromBuffer(width, height, image)
+        else:
+            self.wx_bitmap.CopyFromBuffer(image)
+
+        self._frame_shown = True
+
+    @timed()
+    def render(self, request):
+        """Render a view of the image (see Viewport.render).
+
+        This is called from the render worker thread.
+
+        """
+        return self.view.render(request)
+
+    @timed()
+    def set_display_window(self, window):
+        """Set the range of raw image values mapped to the displayed 8-bit
+        range.
+
+        If the current view was already warped, the new window is applied to
+        the panel-sized warped image, without warping the raw image again.
+
+        :param window: Lower and upper bound, or None to display 8-bit images
+            as is.
+        :type window: (float, float) | None
+
+        """
+        self.display_window = window
+        if self.raw_image is None or self.inverse_homography is None:
+            return
+
+        rgb = None
+        if self.render_worker is None or self.render_worker.idle:
+            rgb = self.view.rewindow(window)
+
+        if rgb is not None:
+            key = self.view.render_key()
+            self._render_key = key
+            self._show_image(rgb)
+            if self.render_cache is not None:
+                self.render_cache.put(key, rgb.copy(), rgb.nbytes)
+
+            updated = True
+        else:
+            updated = self.warp_image()
+
+        if updated:
+            self.wx_panel.Refresh(True)
+
+    @timed()
+    def on_render_finished(self, request, image, refresh=True):
+        """Display a rendered view.
+
+        Called on the GUI thread. Results for views that are no longer
+        current are discarded.
+
+        """
+        if not self.wx_panel or request.key != self._render_key:
+            return
+
+        self._show_image(image)
+
+        # 'image' is a reusable buffer, so the cache needs its own copy.
+        # Previews are cheap to recompute and are not worth the cache space.
+        if self.render_cache is not None and not request.preview:
+            self.render_cache.put(request.key, image.copy(), image.nbytes)
+
+        if refresh:
+            self.wx_panel.Refresh(True)
+
+    def refine(self):
+        """Replace an interactive preview with a full-quality render.
+
+        """
+        if self.warp_image():
+            self.wx_panel.Refresh(True)
+
+    def render_key(self, interpolation):
+        """Return a key that uniquely identifies the current view rendered
+        with 'interpolation'.
+
+        """
+        return self.view.render_key(interpolation)
+
+    def close(self):
+        """Stop the render worker and any pending refinement.
+
         """
-        if self.raw_image is not None and self.inverse_homography is not None:
-            panel_width, panel_height = self.wx_panel.GetSize()
-            flags = self.interpolation | cv2.WARP_INVERSE_MAP
-            image = cv2.warpPerspective(self.raw_image,
-                                        self.inverse_homography,
-                                        dsize=(panel_width, panel_height),
-                                        flags=flags)
+        if self._refine_timer is not None:
+            self._refine_timer.Stop()
 
-            if image.ndim == 2:
-                image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+        self._motion_coalescer.stop()
+        self._size_coalescer.stop()
 
-            self.wx_image.SetData(image.tostring())
-            self.wx_bitmap = self.wx_image.ConvertToBitmap()
+        if self.render_worker is not None:
+            self.render_worker.stop()
 
+    @timed()
     def on_click(self, event):
-        """Called on events wx.EVT_RIGHT_DOWN or wx.EVT_LEFT_DOWN.
+        """Called on events wx.EVT_RIGHT_DOWN, wx.EVT_LEFT_DOWN, or
+        wx.EVT_MIDDLE_DOWN.
 
         """
         if self.raw_image is not None:
-            pos = event.GetPosition()
-            pos = np.dot(self.inverse_homography, [pos[0],pos[1],1])
-            pos = pos[:2]/pos[2]
+            pos = self.view.to_image(event.GetPosition())
 
             if event.LeftDown():
                 button = 0
             elif event.RightDown():
                 button = 1
+            elif event.MiddleDown():
+                button = 2
             else:
                 button = None
 
@@ -236,15 +892,20 @@ class ImagePanelManager(object):
         """Called on event wx.EVT_MOTION.
 
         """
-        if self.status_bar is not None and self.raw_image is not None:
-            pos = event.GetPosition()
-            pos = np.dot(self.inverse_homography, [pos[0],pos[1],1])
-            pos = pos[:2]/pos[2]
-            if np.all([pos[0] >= 0,
-                       pos[0] <= self.raw_image.shape[1],
-                       pos[0] >= 0,
-                       pos[1] <= self.raw_image.shape[0]]):
+        pos = event.GetPosition()
+        self._motion_coalescer((pos[0], pos[1]))
 
+    @timed()
+    def show_mouse_position(self, pos):
+        """Show the raw image coordinates under the mouse in the status bar.
+
+        :param pos: Panel coordinates of the mouse.
+        :type pos: 2-tuple
+
+        """
+        if self.status_bar is not None and self.raw_image is not None:
+            pos = self.view.to_image(pos)
+            if self.view.contains(pos):
                 pos = tuple(pos)
                 # If coordinates are actually within the image.
                 disp_str = 'Raw Image Coordinates ({:.2f},{:.2f})'.format(*pos)
@@ -259,44 +920,38 @@ class ImagePanelManager(object):
             cubic, and lanczos4 respectively.
         :type interp: None | int
         """
-        if interp == 0:
-            self.interpolation = cv2.INTER_NEAREST
-        elif interp == 1:
-            self.interpolation = cv2.INTER_LINEAR
-        elif interp == 2:
-            self.interpolation = cv2.INTER_AREA
-        elif interp == 3:
-            self.interpolation = cv2.INTER_CUBIC
-        elif interp == 4:
-            self.interpolation = cv2.INTER_LANCZOS4
-        else:
-            raise Exception('Invalid value for interp: {}'.format(interp))
+        self.view.set_interpolation(interp)
 
     def on_size(self, event):
         """Called on event wx.EVT_SIZE.
 
         """
-        self.update_all()
+        self._size_coalescer()
+
+    @timed()
+    def update_all(self, interactive=False):
+        """Recalculate the homography and render the current view.
+
+        :param interactive: The view is changing in response to ongoing user
+            input (see warp_image).
+        :type interactive: bool
 
-    def update_all(self):
+        """
         if self.raw_image is not None:
             #print('on_size')
-            panel_width, panel_height = self.wx_panel.GetSize()
-            self.wx_image = wx.Image(panel_width, panel_height)
-            self.update_homography()
-            self.update_inverse_homography()
-            self.warp_image()
-            self.wx_panel.Refresh(True)
+            self.view.set_size(self.wx_panel.GetSize())
+            if self.warp_image(interactive):
+                self.wx_panel.Refresh(True)
 
     # ----------------- Manage Points that will be Displayed -----------------
-    def set_blue_points(self, points, refresh=True):
+    def set_green_points(self, points, refresh=True):
         points = np.atleast_2d(np.array(points, dtype=np.float64))
-        self._blue_points = points
+        self._green_points = points
 
         if refresh:
             self.wx_panel.Refresh(True)
 
-    def add_blue_point(self, point, refresh=True):
+    def add_green_point(self, point, refresh=True):
         """
         :param point:
         :type point: numpy.ndarray
@@ -307,96 +962,34 @@ class ImagePanelManager(object):
             point = np.atleast_2d(point)
 
         assert point.shape[1] == 2
-        if self.blue_points is None:
-            self.set_blue_points(point, refresh)
+        if self.green_points is None:
+            self.set_green_points(point, refresh=False)
         else:
-            self.set_blue_points(np.vstack([self.blue_points, point]),
-                                 refresh)
-
-    def set_red_points(self, points, refresh=True):
-        points = np.atleast_2d(np.array(points, dtype=np.float64))
-        self._red_points = points
+            self.set_green_points(np.vstack([self.green_points, point]),
+                                  refresh=False)
 
         if refresh:
-            self.wx_panel.Refresh(True)
-
-    def add_red_point(self, point, refresh=True):
-        """
-        :param point:
-        :type point: numpy.ndarray
+            self.refresh_points(point)
 
-        """
-        point = np.array(point)
-        if point.ndim == 1:
-            point = np.atleast_2d(point)
+    def clear_last_green_point(self, refresh=True):
+        if self.green_points is None:
+            return
 
-        assert point.shape[1] == 2
-        if self.red_points is None:
-            self.set_red_points(point, refresh)
+        point = self.green_points[-1]
+        if len(self.green_points) == 1:
+            self._green_points = None
         else:
-            self.set_red_points(np.vstack([self.red_points, point]),
-                                refresh)
-
-    def set_green_points(self, points, refresh=True):
-        points = np.atleast_2d(np.array(points, dtype=np.float64))
-        self._green_points = points
+            self._green_points = self.green_points[:-1]
 
         if refresh:
-            self.wx_panel.Refresh(True)
+            self.refresh_points(point)
 
-    def add_green_point(self, point, refresh=True):
-        """
-        :param point:
-        :type point: numpy.ndarray
+    def get_view_rect(self, margin=0, rect=None):
+        """Return the bounding box of the panel view in raw image coordinates
+        (see Viewport.get_view_rect).
 
         """
-        point = np.array(point)
-        if point.ndim == 1:
-            point = np.atleast_2d(point)
-
-        assert point.shape[1] == 2
-        if self.green_points is None:
-            self.set_green_points(point, refresh)
-        else:
-            self.set_green_points(np.vstack([self.green_points, point]),
-                                  refresh)
-
-    def clear_last_blue_point(self, refresh=True):
-        if self.blue_points is not None:
-            if len(self.blue_points) == 1:
-                self._blue_points = None
-            else:
-                self._blue_points = self.blue_points[:-1]
-        if refresh:
-            self.wx_panel.Refresh(True)
-
-    def clear_last_red_point(self, refresh=True):
-        if self.red_points is not None:
-            if len(self.red_points) == 1:
-                self._red_points = None
-            else:
-                self._red_points = self.red_points[:-1]
-        if refresh:
-            self.wx_panel.Refresh(True)
-
-    def clear_last_green_point(self, refresh=True):
-        if self.green_points is not None:
-            if len(self.green_points) == 1:
-                self._green_points = None
-            else:
-                self._green_points = self.red_points[:-1]
-        if refresh:
-            self.wx_panel.Refresh(True)
-
-    def clear_blue_points(self, refresh=True):
-        self._blue_points = None
-        if refresh:
-            self.wx_panel.Refresh(True)
-
-    def clear_red_points(self, refresh=True):
-        self._red_points = None
-        if refresh:
-            self.wx_panel.Refresh(True)
+        return self.view.get_view_rect(margin, rect)
 
     def clear_green_points(self, refresh=True):
         self._green_points = None
@@ -404,49 +997,121 @@ class ImagePanelManager(object):
             self.wx_panel.Refresh(True)
     # -----------------------------------------------------------------------
 
+    @timed('paint')
     def on_paint(self, event=None):
         """Called on event wx.EVT_PAINT.
 
+        Drawing is clipped to the invalidated region of the panel, and only
+        markers that overlap it are drawn.
+
         """
         #print('on_paint', self)
-        if self.wx_image is not None:
-            # AutoBufferedPaintDC helps avoid flicker.
-            #dc = wx.AutoBufferedPaintDC(self.wx_panel)
-            dc = wx.PaintDC(self.wx_panel)
-            #dc = wx.BufferedDC(dc)
+        # AutoBufferedPaintDC helps avoid flicker.
+        #dc = wx.AutoBufferedPaintDC(self.wx_panel)
+        dc = wx.PaintDC(self.wx_panel)
+        #dc = wx.BufferedDC(dc)
+        if self.wx_bitmap is not None:
             dc.DrawBitmap(self.wx_bitmap, 0,0)
             self.draw_overlay(dc)
 
-        if self.red_points is not None:
-            dc.SetPen(wx.Pen(wx.RED, self.circle_thickness))
-            dc.SetBrush(wx.Brush("red", wx.TRANSPARENT))
-            for i in range(len(self.red_points)):
-                x, y = self.red_points[i]
-                pt = np.dot(self.homography, [x,y,1])
-                x, y = pt[:2]/pt[2]
-                dc.DrawCircle(x, y, self.circle_radius)
-
-        if self.green_points is not None:
-            dc.SetPen(wx.Pen(wx.GREEN, self.circle_thickness))
-            dc.SetBrush(wx.Brush("green", wx.TRANSPARENT))
-            for i in range(len(self.green_points)):
-                x, y = self.green_points[i]
-                pt = np.dot(self.homography, [x,y,1])
-                x, y = pt[:2]/pt[2]
-                dc.DrawCircle(x, y, self.circle_radius)
-
-        if self.blue_points is not None:
-            dc.SetPen(wx.Pen(wx.BLUE, self.circle_thickness))
-            dc.SetBrush(wx.Brush("blue", wx.TRANSPARENT))
-            for i in range(len(self.blue_points)):
-                x, y = self.blue_points[i]
-                pt = np.dot(self.homography, [x,y,1])
-                x, y = pt[:2]/pt[2]
-                dc.DrawCircle(x, y, self.circle_radius)
+        if self.raw_image is not None:
+            # Only consider correspondences within the invalidated region.
+            box = self.wx_panel.GetUpdateRegion().GetBox()
+            rect = self.get_view_rect(self.circle_radius +
+                                      self.circle_thickness,
+                                      (box.x, box.y, box.width, box.height))
+            ind = self.correspondences.query_rect(self.side, rect)
+            states = self.correspondences.states[ind]
+            points = self.correspondences.side_points(self.side)[ind]
+
+            # How well the correspondences agree with the current fit.
+            grades = self.correspondences.residuals.classify(ind)
+            accepted = states == CorrespondenceStore.ACCEPTED
+            outlier = ((states == CorrespondenceStore.OUTLIER) |
+                       (accepted & (grades == 2)))
+            pending = states == CorrespondenceStore.PENDING
+
+            self.draw_markers(dc, points[accepted & (grades == 0)], wx.RED)
+            self.draw_markers(dc, points[accepted & (grades == 1)],
+                              self.marginal_colour)
+            self.draw_markers(dc, points[outlier], self.outlier_colour)
+            self.draw_markers(dc, self.green_points, wx.GREEN)
+            self.draw_markers(dc, points[pending], wx.BLUE)
+
+        if self._frame_shown:
+            if self._frame_start is not None and self.stage_timer is not None:
+                start = self._frame_start
+                self.stage_timer.record('frame', self.stage_category, start,
+                                        StageTimer.now() - start, span=True)
+
+            self._frame_start = None
+            self._frame_shown = False
+
+        if self.show_stats and self.stage_timer is not None:
+            self.draw_stats(dc)
 
         if event is not None:
             event.Skip()
 
+    def stats_text(self):
+        """Return the recent frame and stage times and the render cache hit
+        rate of the panel as text.
+
+        """
+        def ms(stage):
+            t = self.stage_timer.mean(stage, self.stage_category)
+            return '-' if t is None else '%.1f ms' % (t*1000)
+
+        hit_rate = self.stage_timer.hit_rate('render_cache',
+                                             self.stage_category)
+        hit_rate = '-' if hit_rate is None else '%i%%' % round(hit_rate*100)
+        return ('frame %s\nrender %s, bitmap %s, paint %s\ncache hits %s' %
+                (ms('frame'), ms('render'), ms('to_bitmap'), ms('paint'),
+                 hit_rate))
+
+    def draw_stats(self, dc):
+        """Draw the text of 'stats_text' in the upper left corner.
+
+        """
+        text = self.stats_text()
+        width, height = dc.GetMultiLineTextExtent(text)
+        dc.SetPen(wx.TRANSPARENT_PEN)
+        dc.SetBrush(wx.BLACK_BRUSH)
+        dc.DrawRectangle(0, 0, width + 8, height + 4)
+        dc.SetTextForeground(wx.WHITE)
+        dc.DrawText(text, 4, 2)
+
+    @timed()
+    def draw_markers(self, dc, points, colour):
+        """Draw circles at raw-image points.
+
+        All points are transformed into the panel in one batched operation,
+        points whose circles fall outside of the panel are culled, and the
+        remaining circles are drawn with a single call.
+
+        :param points: Raw image coordinates to draw circles at.
+        :type points: Nx2 numpy.ndarray | None
+
+        :param colour: Circle colour.
+        :type colour: wx.Colour
+
+        """
+        if points is None or len(points) == 0:
+            return
+
+        pts = self.view.marker_positions(points, self.circle_radius +
+                                                 self.circle_thickness)[0]
+        if len(pts) == 0:
+            return
+
+        ellipses = np.empty((len(pts), 4), dtype=np.int64)
+        ellipses[:,:2] = np.round(pts - self.circle_radius)
+        ellipses[:,2:] = 2*self.circle_radius
+
+        dc.SetPen(wx.Pen(colour, self.circle_thickness))
+        dc.SetBrush(wx.TRANSPARENT_BRUSH)
+        dc.DrawEllipseList(ellipses.tolist())
+
     def refresh(self, event=None):
         """Useful to bind the Refresh of self.wx_panel to an event.
 
@@ -456,26 +1121,42 @@ class ImagePanelManager(object):
 
         self.wx_panel.Refresh(True)
 
-    def draw_overlay(self, dc):
-        pass
+    def refresh_rect(self, x0, y0, x1, y1):
+        """Invalidate a rectangle of the panel, given in panel coordinates.
 
-    def update_inverse_homography(self):
         """
-        Calculate inverse of the homography.
+        x0, y0 = int(np.floor(x0)), int(np.floor(y0))
+        x1, y1 = int(np.ceil(x1)), int(np.ceil(y1))
+        self.wx_panel.RefreshRect(wx.Rect(x0, y0, x1 - x0, y1 - y0), False)
+
+    def refresh_points(self, points):
+        """Invalidate the parts of the panel covered by markers at raw image
+        points, e.g., after markers were added or removed there.
+
+        :param points: Raw image coordinates. Points that are not finite are
+            ignored.
+        :type points: Nx2 numpy.ndarray | 2-array
 
         """
         if self.homography is None:
-            return None
-        else:
-            self.inverse_homography = np.linalg.inv(self.homography)
+            return
 
-    def update_homography(self):
-        """
-        Determine what the homography should be based on all existing
-        attributes.
+        r = self.circle_radius + self.circle_thickness + 1
+        pts = self.view.marker_positions(points, r)[0]
+        x, y = pts[:,0], pts[:,1]
+        if len(x) == 0:
+            return
 
-        """
-        return np.identity(3)
+        if len(x) > self.max_dirty_rects:
+            self.refresh_rect(x.min() - r, y.min() - r, x.max() + r,
+                              y.max() + r)
+            return
+
+        for xi, yi in zip(x, y):
+            self.refresh_rect(xi - r, yi - r, xi + r, yi + r)
+
+    def draw_overlay(self, dc):
+        pass
 
     def process_clicked_point(self, pos, button):
         """
@@ -501,8 +1182,12 @@ class NavigationPanelImage(ImagePanelManager):
         'align_homography' is applied to the raw image.
 
     """
+    view_class = NavigationViewport
+
     def __init__(self, wx_panel, image, zoom_panel_image, draw_zoom_box=True,
-                 status_bar=None):
+                 status_bar=None, render_cache=None, threaded_render=True,
+                 correspondences=None, side=0, render_pool=None,
+                 stage_timer=None, stage_category=None):
         """
         :param wx_panel: Panel to add the image to.
         :type wx_panel: wx.Panel
@@ -518,74 +1203,90 @@ class NavigationPanelImage(ImagePanelManager):
             is drawn from.
         :type draw_zoom_box: bool
 
+        :param render_cache: Cache of rendered panel bitmaps.
+        :type render_cache: LRUCache | None
+
+        :param threaded_render: Render views on a background thread.
+        :type threaded_render: bool
+
+        :param correspondences: Point correspondences to draw.
+        :type correspondences: CorrespondenceStore | None
+
+        :param side: Which image of the correspondences the panel shows.
+        :type side: int
+
+        :param render_pool: Threads shared with other panels to render on.
+        :type render_pool: RenderPool | None
+
+        :param stage_timer: Timer of the stages of updating the panel.
+        :type stage_timer: StageTimer | None
+
+        :param stage_category: Category of the stages timed for this panel.
+        :type stage_category: str | None
+
         """
         super(NavigationPanelImage, self).__init__(wx_panel, image,
-             status_bar=status_bar)
+             status_bar=status_bar, render_cache=render_cache,
+             threaded_render=threaded_render, correspondences=correspondences,
+             side=side, render_pool=render_pool, stage_timer=stage_timer,
+             stage_category=stage_category)
         self.zoom_panel_image = zoom_panel_image
-        self.align_homography = None
         self.draw_zoom_box = draw_zoom_box
 
-        if self.raw_image is not None:
-            self.corrected_img_shape = self.raw_image.shape[:2]
+        # Zoom box outline as last drawn, in panel coordinates.
+        self._zoom_box = None
 
-        # When the zoom panel changes, make sure the navigation panel is
+        # When the zoom panel view changes, only the zoom box needs to be
         # redrawn.
-        self.zoom_panel_image.wx_panel.Bind(wx.EVT_PAINT, self.refresh)
+        self.zoom_panel_image.view_callback = self.on_zoom_view_changed
 
-    def update_raw_image(self, raw_image):
-        if raw_image is None:
-            return False
+    @property
+    def align_homography(self):
+        return self.view.align_homography
 
-        if self.align_homography is None:
-            # If align_homography is set, that means the image is to be warped
-            # to align with another image, and 'corrected_img_shape' should be
-            # the resolution of the other image. Otherwise, there is no
-            # correction, and corrected_image_shape matches the raw image.
-            self.corrected_img_shape = raw_image.shape[:2]
-
-        super(NavigationPanelImage, self).update_raw_image(raw_image)
-
-    def update_homography(self):
-        #print('on_size')
-        panel_width, panel_height = self.wx_panel.GetSize()
-
-        if False:
-            im_height, im_width = self.raw_image.shape[:2]
-            print('Panel Size ({}, {})'.format(panel_width, panel_height))
-            print('Original Image Size ({}, {})'.format(im_width, im_height))
-
-        # The corrected image shape comes from the dimensions of the image that
-        # this one is being corrected to.
-        im_height, im_width = self.corrected_img_shape
-
-        if im_width/im_height > panel_width/panel_height:
-            # Side edges of image should hit the edges of the panel.
-            s = panel_width/im_width
-            ty = (panel_height - s*im_height)/2
-            h = np.array([[s,0,0],[0,s,ty],[0,0,1]])
-            if self.align_homography is not None:
-                h = np.dot(h, self.align_homography)
-
-            self.homography = h
-        else:
-            # Top edges of image should hit the edges of the panel.
-            s = panel_height/im_height
-            tx = (panel_width-s*im_width)/2
-            h = np.array([[s,0,tx],[0,s,0],[0,0,1]])
+    @align_homography.setter
+    def align_homography(self, homography):
+        self.view.align_homography = homography
 
-            if self.align_homography is not None:
-                h = np.dot(h, self.align_homography)
+    @property
+    def corrected_img_shape(self):
+        return self.view.corrected_img_shape
 
-            self.homography = h
-        if False:
-            print('Corrected Image Size ({}, {})'.format(im_width, im_height))
-            print('Homography', self.homography)
+    @corrected_img_shape.setter
+    def corrected_img_shape(self, shape):
+        self.view.corrected_img_shape = shape
 
     def process_clicked_point(self, pos, button):
         self.zoom_panel_image.process_clicked_point(pos, 1)
         # No need to refresh, any changes to the zoom panel will automatically
         # trigger a refresh of the navigation panel.
 
+    def get_zoom_box(self):
+        """Return the outline of the zoom panel view in panel coordinates (see
+        NavigationViewport.get_zoom_box).
+
+        """
+        return self.view.get_zoom_box(self.zoom_panel_image.view)
+
+    @timed()
+    def on_zoom_view_changed(self):
+        """Invalidate the outlines of the previous and new zoom box.
+
+        """
+        if not self.draw_zoom_box or self.raw_image is None:
+            return
+
+        # Pen width plus a pixel of rounding.
+        pad = 3
+        for pts in [self._zoom_box, self.get_zoom_box()]:
+            if pts is None or not np.all(np.isfinite(pts)):
+                continue
+
+            for i in range(4):
+                x, y = pts[:,i:i+2]
+                self.refresh_rect(x.min() - pad, y.min() - pad,
+                                  x.max() + pad, y.max() + pad)
+
     def draw_overlay(self, dc):
         """
         """
@@ -593,11 +1294,11 @@ class NavigationPanelImage(ImagePanelManager):
             dc.SetPen(wx.Pen(wx.RED, 2))
 
             # Draw zoom window
-            w, h = self.zoom_panel_image.wx_panel.GetSize()
-            pts = np.array([[0,w,w,0,0],[0,0,h,h,0],[1,1,1,1,1]])
-            pts = np.dot(self.zoom_panel_image.inverse_homography, pts)
-            pts = np.dot(self.homography, pts)
-            pts = pts[:2]/pts[2]
+            pts = self.get_zoom_box()
+            self._zoom_box = pts
+            if pts is None:
+                return
+
             for i in range(4):
                 dc.DrawLine(pts[0,i], pts[1,i], pts[0,i+1], pts[1,i+1])
 
@@ -606,9 +1307,24 @@ class ZoomPanelImage(ImagePanelManager):
     """The right navigation panel used to select where to center the
     zoom panel.
 
+    The view is panned by dragging with the right mouse button, while a right
+    click without dragging recenters the view on the clicked point. Views at
+    the same zoom differ by whole-pixel translations, so panning only renders
+    the strips of the panel that come into view (see scroll_render).
+
+    Attributes:
+    :param drag_threshold: Distance in panel pixels that the mouse has to move
+        with the right button down before the view is dragged.
+    :type drag_threshold: int
+
     """
+    view_class = ZoomViewport
+
     def __init__(self, wx_panel, image=None, zoom=400, center=None,
-                 zoom_spin_ctrl=None, click_callback=None, status_bar=None):
+                 zoom_spin_ctrl=None, click_callback=None, status_bar=None,
+                 render_cache=None, threaded_render=True,
+                 correspondences=None, side=0, render_pool=None,
+                 stage_timer=None, stage_category=None):
         """
         :param wx_panel: Panel to add the image to.
         :type wx_panel: wx.Panel
@@ -626,92 +1342,204 @@ class ZoomPanelImage(ImagePanelManager):
         :param click_callback: Function to call when left-mouse is clicked. It
             should expect one arguement pos (the point clicked).
 
-        s"""
-        super(ZoomPanelImage, self).__init__(wx_panel, image,
-              status_bar=status_bar)
+        :param render_cache: Cache of rendered panel bitmaps.
+        :type render_cache: LRUCache | None
 
-        if center is None and self.raw_image is not None:
-            self._center = np.array(self.raw_image.shape[:2][::-1])/2
+        :param threaded_render: Render views on a background thread.
+        :type threaded_render: bool
 
-        self.align_homography = None
+        :param correspondences: Point correspondences to draw.
+        :type correspondences: CorrespondenceStore | None
 
-        if self.raw_image is not None:
-            self.corrected_img_shape = self.raw_image.shape[:2]
+        :param side: Which image of the correspondences the panel shows.
+        :type side: int
+
+        :param render_pool: Threads shared with other panels to render on.
+        :type render_pool: RenderPool | None
+
+        :param stage_timer: Timer of the stages of updating the panel.
+        :type stage_timer: StageTimer | None
+
+        :param stage_category: Category of the stages timed for this panel.
+        :type stage_category: str | None
+
+        s"""
+        view = ZoomViewport(image, size=tuple(wx_panel.GetSize()), zoom=zoom,
+                            center=center)
+        super(ZoomPanelImage, self).__init__(wx_panel, image,
+              status_bar=status_bar, render_cache=render_cache,
+              threaded_render=threaded_render,
+              correspondences=correspondences, side=side,
+              render_pool=render_pool, view=view, stage_timer=stage_timer,
+              stage_category=stage_category)
 
         self.zoom_spin_ctrl = zoom_spin_ctrl
 
         self.click_callback = click_callback
 
+        self.drag_threshold = 3
+        self._drag = None
+        self._drag_coalescer = FrameCoalescer(self.drag_to)
+
+        # Zoom accumulated from wheel events that have not been applied yet.
+        self._wheel_zoom = None
+        self._wheel_coalescer = FrameCoalescer(self.apply_wheel_zoom)
+
+        # Called without arguments when the view changes.
+        self.view_callback = None
+
+        # Called with the new zoom when the user changes the zoom.
+        self.zoom_callback = None
+
         self.set_zoom(zoom, update_spin_ctrl_text=True)
 
         self.zoom_spin_ctrl.Bind(wx.EVT_SPINCTRLDOUBLE, self.on_spin_ctrl_text)
         self.wx_panel.Bind(wx.EVT_MOUSEWHEEL, self.on_zoom_mouse_wheel)
+        self.wx_panel.Bind(wx.EVT_RIGHT_UP, self.on_right_up)
+        self.wx_panel.Bind(wx.EVT_MOUSE_CAPTURE_LOST, self.on_capture_lost)
 
     @property
     def zoom(self):
-        return self._zoom
+        return self.view.zoom
 
     @property
-    def center(self):
-        return self._center
+    def settled(self):
+        return (super(ZoomPanelImage, self).settled and
+                not self._drag_coalescer.pending and
+                not self._wheel_coalescer.pending)
 
-    def update_raw_image(self, raw_image):
-        if raw_image is None:
-            return False
+    @property
+    def center(self):
+        return self.view.center
 
-        corrected_img_shape0 = self.corrected_img_shape
+    @property
+    def align_homography(self):
+        return self.view.align_homography
 
-        if self.align_homography is None:
-            # If align_homography is set, that means the image is to be warped
-            # to align with another image, and 'corrected_img_shape' should be
-            # the resolution of the other image. Otherwise, there is no
-            # correction, and corrected_image_shape matches the raw image.
-            self.corrected_img_shape = raw_image.shape[:2]
+    @align_homography.setter
+    def align_homography(self, homography):
+        self.view.align_homography = homography
 
-        if self.corrected_img_shape != corrected_img_shape0:
-            self._center = np.array(raw_image.shape[:2][::-1])/2
+    @property
+    def corrected_img_shape(self):
+        return self.view.corrected_img_shape
 
-        super(ZoomPanelImage, self).update_raw_image(raw_image)
+    @corrected_img_shape.setter
+    def corrected_img_shape(self, shape):
+        self.view.corrected_img_shape = shape
 
-    def set_center(self, center):
+    @timed()
+    def set_center(self, center, interactive=False):
         """
         :param center: Location for the zoom center in the original image's coordinates.
         :type center: 2-array
+
+        :param interactive: The change is part of ongoing user input, so a
+            fast preview is rendered first (see warp_image).
+        :type interactive: bool
         """
-        self._center = center
-        self.update_all()
+        homography0 = self.homography
+        self.view.set_center(center)
+        if self.raw_image is not None and homography0 is not None:
+            shift = pixel_translation(homography0, self.homography)
+            panel_width, panel_height = self.view.size
+            if (shift is not None and abs(shift[0]) < panel_width and
+                abs(shift[1]) < panel_height):
+                # Only the exposed strips are rendered, which is fast enough
+                # to skip the preview.
+                interactive = False
+
+        self.update_all(interactive)
+
+    def process_clicked_point(self, pos, button):
+        self.click_callback(pos, button)
+
+    def update_all(self, interactive=False):
+        """Recalculate the homography and render the current view.
+
+        """
+        super(ZoomPanelImage, self).update_all(interactive)
+        if self.view_callback is not None:
+            self.view_callback()
+
+    def on_click(self, event):
+        """Called on events wx.EVT_RIGHT_DOWN, wx.EVT_LEFT_DOWN, or
+        wx.EVT_MIDDLE_DOWN.
+
+        A right click is handled when the button is released, since it may
+        start a drag instead.
+
+        """
+        if event.RightDown() and self.raw_image is not None:
+            self._drag = (event.GetPosition(), self.inverse_homography, False)
+            if not self.wx_panel.HasCapture():
+                self.wx_panel.CaptureMouse()
 
-    def update_homography(self):
-        if self.raw_image is None:
             return
 
-        #print('on_size')
-        panel_width, panel_height = self.wx_panel.GetSize()
-        im_height, im_width = self.raw_image.shape[:2]
-        #print('Panel Size ({}, {})'.format(panel_width, panel_height))
-        #print('Image Size ({}, {})'.format(im_width, im_height))
+        super(ZoomPanelImage, self).on_click(event)
 
-        s = self._zoom/100
+    def on_mouse_over(self, event):
+        """Called on event wx.EVT_MOTION.
 
-        if self.align_homography is not None:
-            # Get the coordinate in the "corrected" image of the clicked center.
-            center = np.dot(self.align_homography, [self._center[0],
-                                                    self._center[1], 1])
-            center = center[:2]/center[2]
-        else:
-            center = self._center
+        """
+        if self._drag is not None and event.RightIsDown():
+            pos0, inverse_homography, dragging = self._drag
+            pos = event.GetPosition()
+            dx, dy = pos[0] - pos0[0], pos[1] - pos0[1]
+            if dragging or max(abs(dx), abs(dy)) >= self.drag_threshold:
+                self._drag = (pos0, inverse_homography, True)
+                self._drag_coalescer(dx, dy)
 
-        tx = panel_width/2-s*center[0]
-        ty = panel_height/2-s*center[1]
-        h_zoom = np.array([[s,0,tx],[0,s,ty],[0,0,1]])
+        super(ZoomPanelImage, self).on_mouse_over(event)
 
-        if self.align_homography is not None:
-            self.homography = np.dot(h_zoom, self.align_homography)
-        else:
-            self.homography = h_zoom
+    @timed()
+    def drag_to(self, dx, dy):
+        """Move the view with the mouse during a drag.
 
-    def process_clicked_point(self, pos, button):
-        self.click_callback(pos, button)
+        :param dx: Horizontal distance in panel pixels that the mouse has moved
+            since the drag started.
+        :type dx: int
+
+        :param dy: Vertical distance in panel pixels.
+        :type dy: int
+
+        """
+        if self._drag is None:
+            return
+
+        # The raw image point that was at the panel center when the drag
+        # started, moved with the mouse.
+        inverse_homography = self._drag[1]
+        panel_width, panel_height = self.view.size
+        center = np.dot(inverse_homography, [panel_width/2 - dx,
+                                             panel_height/2 - dy, 1])
+        self.process_clicked_point(center[:2]/center[2], 1)
+
+    def on_right_up(self, event):
+        """Called on event wx.EVT_RIGHT_UP.
+
+        """
+        if self._drag is None:
+            return
+
+        # Apply the last position of the drag.
+        self._drag_coalescer.flush()
+        pos0, inverse_homography, dragging = self._drag
+        self._drag = None
+        if self.wx_panel.HasCapture():
+            self.wx_panel.ReleaseMouse()
+
+        if not dragging:
+            # Recenter on the clicked point.
+            pos = np.dot(inverse_homography, [pos0[0],pos0[1],1])
+            self.process_clicked_point(pos[:2]/pos[2], 1)
+
+    def on_capture_lost(self, event):
+        """Called on event wx.EVT_MOUSE_CAPTURE_LOST.
+
+        """
+        self._drag = None
 
     def on_zoom_mouse_wheel(self, event=None):
         if self.raw_image is None:
@@ -723,18 +1551,47 @@ class ZoomPanelImage(ImagePanelManager):
         else:
             change = 1.01
 
+        if self._wheel_zoom is not None:
+            zoom = self._wheel_zoom
+        else:
+            zoom = self.zoom
+
         if val > 0:
-            zoom = np.minimum(self._zoom*change, 2000)
+            zoom = np.minimum(zoom*change, 2000)
         if val < 0:
-            zoom = np.maximum(self._zoom/change, 10)
+            zoom = np.maximum(zoom/change, 10)
 
-        self.set_zoom(zoom, update_spin_ctrl_text=True)
+        self._wheel_zoom = zoom
+        self._wheel_coalescer()
+
+    @timed()
+    def apply_wheel_zoom(self):
+        """Set the zoom accumulated from mouse wheel events.
+
+        """
+        zoom = self._wheel_zoom
+        self._wheel_zoom = None
+        if zoom is not None:
+            self.set_zoom(zoom, update_spin_ctrl_text=True, interactive=True)
+            if self.zoom_callback is not None:
+                self.zoom_callback(self.zoom)
+
+    def close(self):
+        """Stop the render worker and any pending input handling.
+
+        """
+        self._drag_coalescer.stop()
+        self._wheel_coalescer.stop()
+        super(ZoomPanelImage, self).close()
 
     def on_spin_ctrl_text(self, event=None):
         self.set_zoom(self.zoom_spin_ctrl.GetValue(),
                       update_spin_ctrl_text=False)
+        if self.zoom_callback is not None:
+            self.zoom_callback(self.zoom)
 
-    def set_zoom(self, zoom, update_spin_ctrl_text=True):
+    @timed()
+    def set_zoom(self, zoom, update_spin_ctrl_text=True, interactive=False):
         """Update imagery for the passed zoom value.
 
         It is assumed that 'zoom' was is already reflected in the the
@@ -746,31 +1603,33 @@ class ZoomPanelImage(ImagePanelManager):
         :param update_spin_ctrl_text: Update the text in zoom_spin_ctrl.
         :type update_spin_ctrl_text: bool
 
+        :param interactive: The change is part of ongoing user input, so a
+            fast preview is rendered first (see warp_image).
+        :type interactive: bool
+
         """
         # Clamp to minimum value
-        if self.raw_image is not None:
-            panel_width, panel_height = self.wx_panel.GetSize()
-            im_height, im_width = self.raw_image.shape[:2]
-            min_zoom = np.minimum(panel_width/im_width, panel_height/im_height)*100
-            min_zoom = int(np.ceil(min_zoom))
-
-            if zoom < min_zoom:
-                zoom = min_zoom
-                update_spin_ctrl_text = True
-
-        self._zoom = zoom
+        self.view.size = tuple(self.wx_panel.GetSize())
+        zoom0 = zoom
+        zoom = self.view.set_zoom(zoom)
+        if zoom != zoom0:
+            update_spin_ctrl_text = True
 
         if update_spin_ctrl_text:
             self.zoom_spin_ctrl.SetValue('{}%'.format(int(np.round(zoom))))
 
-        self.update_all()
+        self.update_all(interactive)
 
 
 class MainFrame(form_builder_output.MainFrame):
     #constructor
     def __init__(self, parent, image_left, image_right, title1='Let Image',
                  title2='Right Image', passback_dict={'points',None},
-                 initial_zoom=400, window_title='Manual Image Registration'):
+                 initial_zoom=400, window_title='Manual Image Registration',
+                 render_cache_bytes=256*2**20,
+                 contrast_cache_bytes=512*2**20, pyramid_cache_dir=None,
+                 pyramid_cache_bytes=4*2**30, render_threads=None,
+                 opencv_threads=None, trace_file=None, session_file=None):
         """
         :param image1_topic: First image topic name.
         :type image_topics: list of str
@@ -778,14 +1637,127 @@ class MainFrame(form_builder_output.MainFrame):
         :param image1_topic: First image topic name.
         :type image_topics: list of str
 
+        :param render_cache_bytes: Memory budget for the cache of rendered
+            panel bitmaps shared by all panels.
+        :type render_cache_bytes: int
+
+        :param contrast_cache_bytes: Memory budget for the cache of
+            contrast-adjusted images, which makes returning to a previously
+            used contrast setting instant.
+        :type contrast_cache_bytes: int
+
+        :param pyramid_cache_dir: Directory in which the decoded pyramids of
+            loaded image files are stored, so that loading the same file again
+            is nearly instant. Defaults to the KEYPOINTGUI_CACHE_DIR
+            environment variable. If neither is set, nothing is stored.
+        :type pyramid_cache_dir: str | None
+
+        :param pyramid_cache_bytes: Maximum size of the pyramid cache
+            directory.
+        :type pyramid_cache_bytes: int
+
+        :param render_threads: Number of threads that the panels share to
+            render views in parallel. Defaults to four or the number of CPUs,
+            whichever is smaller.
+        :type render_threads: int | None
+
+        :param opencv_threads: Number of threads OpenCV uses within each
+            operation (see cv2.setNumThreads) while the window is open.
+            Defaults to dividing the CPUs between the render threads, so that
+            parallel renders do not oversubscribe the CPU.
+        :type opencv_threads: int | None
+
+        :param trace_file: File to write a trace of the timed stages of the
+            panels and event handlers to when the window is closed, in the
+            Chrome trace event format (viewable in about:tracing or Perfetto).
+            Defaults to the KEYPOINTGUI_TRACE environment variable. If neither
+            is set, a trace can be recorded from the Display menu.
+        :type trace_file: str | None
+
+        :param session_file: File to record the input events of the session
+            to (see keypointgui.session), so that it can be replayed to
+            measure latencies. Defaults to the KEYPOINTGUI_RECORD environment
+            variable. If neither is set, the session is not recorded.
+        :type session_file: str | None
+
         """
         #initialize parent class
         form_builder_output.MainFrame.__init__(self, parent)
+
+        # The session recorder and the state of a replay in progress (see
+        # replay_session), which record_event reads, so they must be set
+        # before any event handler runs.
+        self.session_recorder = None
+        self._replay = None
+
+        # Timer of the stages of the event handlers, shared with the panels.
+        self.stage_timer = StageTimer()
+        self.stage_category = 'MainFrame'
+        if trace_file is None:
+            trace_file = os.environ.get('KEYPOINTGUI_TRACE')
+
+        self.trace_file = trace_file or None
+        if self.trace_file is not None:
+            self.stage_timer.start_trace()
+
         self.SetTitle(window_title)
         self.zoom = initial_zoom
         self._image_left0 = self._image_left = image_left
         self._image_right0 = self._image_right = image_right
-        self.click_state = 0
+        self._image_left_key = next(image_keys)
+        self._image_right_key = next(image_keys)
+        self.render_cache = LRUCache(render_cache_bytes)
+        self.render_pool = RenderPool(render_threads)
+        if opencv_threads is None:
+            opencv_threads = max(cv2.getNumberOfCPUs()//
+                                 self.render_pool.num_threads, 1)
+
+        # Restored when the window is closed.
+        self._opencv_threads0 = cv2.getNumThreads()
+        cv2.setNumThreads(opencv_threads)
+        self.contrast_cache = LRUCache(contrast_cache_bytes)
+        self._contrast_keys = [(self._image_left_key, 0),
+                               (self._image_right_key, 0)]
+
+        # Apply slider movements at most once per frame.
+        self._contrast_coalescers = [FrameCoalescer(self.apply_contrast)
+                                     for side in (0, 1)]
+
+        self._contrast_workers = [RenderWorker(self.compute_contrast,
+                                               self.on_contrast_finished)
+                                  for side in (0, 1)]
+        self._load_ids = [None, None]
+        self._load_workers = [RenderWorker(self.read_image_file,
+                                           self.on_image_loaded)
+                              for side in (0, 1)]
+
+        # JPEG files at least this large first get a reduced-resolution
+        # preview, which libjpeg decodes much faster than the full image.
+        self.preview_min_bytes = 4*2**20
+        self.correspondences = CorrespondenceStore()
+        self.selection = PointSelection(self.correspondences)
+
+        # Robust estimator used to fit alignments and saved homographies (one
+        # of ROBUST_METHODS, or None for least squares), and its inlier
+        # threshold in pixels of the destination image.
+        self.fit_method = None
+        self.fit_threshold = 3.0
+        self.fit_confidence = 0.995
+
+        # Options of 'Suggest Matches', whose suggested pairs are held by
+        # 'selection' and shown as green points until they are accepted or
+        # rejected. Features are detected in a pool of 'match_processes'
+        # processes (None for one per CPU, 0 to detect them on the worker
+        # thread), created when matches are first suggested.
+        self.match_feature_type = 'orb'
+        self.match_ratio = 0.8
+        self.match_cross_check = True
+        self.match_ransac = True
+        self.match_processes = None
+        self._match_pool = None
+        self._match_id = None
+        self._match_worker = RenderWorker(self.compute_matches,
+                                          self.on_matches_found)
         assert isinstance(passback_dict, dict)
         self.passback_dict = passback_dict
 
@@ -800,197 +1772,859 @@ class MainFrame(form_builder_output.MainFrame):
                                         self.image_left,
                                         zoom_spin_ctrl=self.zoom1_spin_ctrl,
                                         click_callback=self.on_clicked_point1,
-                                        status_bar=self.status_bar)
+                                        status_bar=self.status_bar,
+                                        render_cache=self.render_cache,
+                                        correspondences=self.correspondences,
+                                        side=0,
+                                        render_pool=self.render_pool,
+                                        stage_timer=self.stage_timer,
+                                        stage_category='left zoom')
 
         self.nav_panel_left = NavigationPanelImage(self.image1_nav_panel,
                                                      self.image_left,
                                                      self.zoom_panel_left,
-                                                     self.status_bar)
+                                                     self.status_bar,
+                                        render_cache=self.render_cache,
+                                        correspondences=self.correspondences,
+                                        side=0,
+                                        render_pool=self.render_pool,
+                                        stage_timer=self.stage_timer,
+                                        stage_category='left navigation')
+
+        # Image 2 views.
+        self.zoom_panel_right = ZoomPanelImage(self.image2_zoom_panel,
+                                        self.image_right,
+                                        zoom_spin_ctrl=self.zoom2_spin_ctrl,
+                                        click_callback=self.on_clicked_point2,
+                                        status_bar=self.status_bar,
+                                        render_cache=self.render_cache,
+                                        correspondences=self.correspondences,
+                                        side=1,
+                                        render_pool=self.render_pool,
+                                        stage_timer=self.stage_timer,
+                                        stage_category='right zoom')
+
+        self.nav_panel_right = NavigationPanelImage(self.image2_nav_panel,
+                                                     self.image_right,
+                                                     self.zoom_panel_right,
+                                                     self.status_bar,
+                                        render_cache=self.render_cache,
+                                        correspondences=self.correspondences,
+                                        side=1,
+                                        render_pool=self.render_pool,
+                                        stage_timer=self.stage_timer,
+                                        stage_category='right navigation')
+
+        # The unadjusted pyramids are shared by both panels on each side.
+        self._image_pyramids0 = [self.nav_panel_left.image_pyramid,
+                                 self.nav_panel_right.image_pyramid]
+
+        # Image files at least this large are read on demand if their format
+        # allows it (see open_image_source).
+        self.lazy_load_bytes = 256*2**20
+
+        if pyramid_cache_dir is None:
+            pyramid_cache_dir = os.environ.get('KEYPOINTGUI_CACHE_DIR')
+
+        if pyramid_cache_dir:
+            self.pyramid_cache = PyramidDiskCache(pyramid_cache_dir,
+                                                  pyramid_cache_bytes)
+        else:
+            self.pyramid_cache = None
+
+        # Images other than 8-bit are kept as is and mapped to the displayed
+        # range when rendering.
+        self.auto_stretch_percentiles = (0.5, 99.5)
+        self.histogram_pixels = 2**24
+        self._histograms = [None, None]
+        for side, pyramid in enumerate(self._image_pyramids0):
+            if pyramid is not None:
+                self._histograms[side] = self.compute_histogram(pyramid)
+                self.set_display_window(side, self.default_window(side))
+
+        self._add_display_menu()
+        self._add_alignment_menu()
+
+        # Apply the current default interpolation.
+        self.on_interpolation_update(None)
+
+        # Interpolation choice bindings.
+        self.interpolation_choice.Bind(wx.EVT_CHOICE,
+                                       self.on_interpolation_update)
+
+        # Grey out check box until alignment has been performed.
+        self.sync_zooms_checkbox.SetValue(False)
+        self.sync_zooms_checkbox.Enable(False)
+
+        if self.passback_dict['points'] is not None:
+            self.correspondences.extend(self.passback_dict['points'])
+            self.refresh_panels()
+
+        self.Bind(wx.EVT_CLOSE, self.when_closed)
+
+        # Allow zooming by mouse scrolling from the upper navigation panels.
+        self.image1_nav_panel.Bind(wx.EVT_MOUSEWHEEL,
+                                   self.zoom_panel_left.on_zoom_mouse_wheel)
+        self.image2_nav_panel.Bind(wx.EVT_MOUSEWHEEL,
+                                   self.zoom_panel_right.on_zoom_mouse_wheel)
+
+        self.Show()
+        self.SetMinSize(self.GetSize())
+
+        if session_file is None:
+            session_file = os.environ.get('KEYPOINTGUI_RECORD')
+
+        if session_file:
+            # The initial state, which the replay starts from.
+            self.session_recorder = SessionRecorder(session_file)
+            panel_sizes = dict((name, tuple(panel.wx_panel.GetSize()))
+                               for name, panel in zip(PANEL_NAMES,
+                                                      self.panels))
+            zoom = (self.zoom_panel_left.zoom, self.zoom_panel_right.zoom)
+            interp = self.interpolation_choice.GetSelection()
+            self.record_event('start', version=SESSION_VERSION,
+                              window=tuple(self.GetSize()),
+                              panels=panel_sizes, zoom=zoom,
+                              interpolation=interp)
+
+        self.zoom_panel_left.zoom_callback = \
+            lambda zoom: self.record_event('zoom', side=0, zoom=zoom)
+        self.zoom_panel_right.zoom_callback = \
+            lambda zoom: self.record_event('zoom', side=1, zoom=zoom)
+
+    @property
+    def image_left(self):
+        """Return left image.
+
+        If the contrast was ajdusted, the contrast-adjusted version is
+        returned.
+
+        """
+        return self._image_left
+
+    @property
+    def image_right(self):
+        """Return right image.
+
+        If the contrast was ajdusted, the contrast-adjusted version is
+        returned.
+
+        """
+        return self._image_right
+
+    @image_left.setter
+    def image_left(self, image):
+        self.set_image(0, image)
+
+    @image_right.setter
+    def image_right(self, image):
+        self.set_image(1, image)
+
+    @timed()
+    def set_image(self, side, image, pyramid=None, histogram=None):
+        """Replace one side's image.
+
+        :param side: 0 for the left image, 1 for the right image.
+        :type side: int
+
+        :param image: New image.
+        :type image: numpy.ndarray | ImageSource | None
+
+        :param pyramid: Pyramid of 'image', if one was already built (e.g.,
+            loaded from the pyramid cache).
+        :type pyramid: ImagePyramid | None
+
+        :param histogram: Histogram of 'image', if it was already computed
+            (e.g., on a load worker). Otherwise, computing it reads the finest
+            pyramid level that fits in memory, which takes long for images
+            that are read on demand.
+        :type histogram: ImageHistogram | None
+
+        """
+        if side == 0:
+            if image is self._image_left:
+                return
+
+            # An original version is also stored for reference for contrast
+            # adjustment.
+            self._image_left0 = self._image_left = image
+            self._image_left_key = key = next(image_keys)
+        else:
+            if image is self._image_right:
+                return
+
+            self._image_right0 = self._image_right = image
+            self._image_right_key = key = next(image_keys)
+
+        image_key = (key, 0)
+        self._contrast_coalescers[side].stop()
+        self._contrast_keys[side] = image_key
+        if image is None:
+            self._image_pyramids0[side] = None
+            self._histograms[side] = None
+            return
+
+        if pyramid is None:
+            pyramid = ImagePyramid(image)
+
+        if histogram is None:
+            histogram = self.compute_histogram(pyramid)
+
+        self._image_pyramids0[side] = pyramid
+        self._histograms[side] = histogram
+        window = self.default_window(side)
+        for panel in self.side_panels(side):
+            panel.display_window = window
+            panel.update_raw_image(image, image_key, pyramid)
+
+    def _add_display_menu(self):
+        menu = wx.Menu()
+        items = [('Auto Stretch', self.on_auto_stretch),
+                 ('Full Range', self.on_full_range),
+                 ('Set Left Window...', lambda event: self.on_set_window(0)),
+                 ('Set Right Window...', lambda event: self.on_set_window(1))]
+        for label, handler in items:
+            item = menu.Append(wx.ID_ANY, label)
+            self.Bind(wx.EVT_MENU, handler, id=item.GetId())
+
+        menu.AppendSeparator()
+        item = menu.AppendCheckItem(wx.ID_ANY, 'Show Frame Times')
+        self.Bind(wx.EVT_MENU, self.on_show_frame_times, id=item.GetId())
+        self.record_trace_menu_item = menu.AppendCheckItem(wx.ID_ANY,
+                                                           'Record Trace')
+        self.record_trace_menu_item.Check(self.stage_timer.tracing)
+        self.Bind(wx.EVT_MENU, self.on_record_trace,
+                  id=self.record_trace_menu_item.GetId())
+
+        self.m_menubar1.Insert(1, menu, 'Display')
+
+    def _add_alignment_menu(self):
+        menu = wx.Menu()
+        items = [('Least Squares', None), ('RANSAC', 'ransac'),
+                 ('LMEDS', 'lmeds'), ('MAGSAC', 'magsac')]
+        for label, method in items:
+            item = menu.AppendRadioItem(wx.ID_ANY, label)
+            item.Check(method == self.fit_method)
+            self.Bind(wx.EVT_MENU,
+                      lambda event, method=method: self.set_fit_method(method),
+                      id=item.GetId())
+
+        menu.AppendSeparator()
+        item = menu.Append(wx.ID_ANY, 'Set Inlier Threshold...')
+        self.Bind(wx.EVT_MENU, self.on_set_fit_threshold, id=item.GetId())
+
+        menu.AppendSeparator()
+        item = menu.Append(wx.ID_ANY, 'Suggest Matches')
+        self.Bind(wx.EVT_MENU, self.on_suggest_matches, id=item.GetId())
+        for feature_type in FEATURE_TYPES:
+            item = menu.AppendRadioItem(wx.ID_ANY,
+                                        '%s Features' % feature_type.upper())
+            item.Check(feature_type == self.match_feature_type)
+            self.Bind(wx.EVT_MENU,
+                      lambda event, feature_type=feature_type:
+                      setattr(self, 'match_feature_type', feature_type),
+                      id=item.GetId())
+
+        item = menu.AppendCheckItem(wx.ID_ANY,
+                                    'Filter Suggestions with RANSAC')
+        item.Check(self.match_ransac)
+        self.Bind(wx.EVT_MENU,
+                  lambda event: setattr(self, 'match_ransac',
+                                        event.IsChecked()),
+                  id=item.GetId())
+        items = [('Accept All Suggestions', self.on_accept_suggestions),
+                 ('Reject All Suggestions', self.on_reject_suggestions)]
+        for label, handler in items:
+            item = menu.Append(wx.ID_ANY, label)
+            self.Bind(wx.EVT_MENU, handler, id=item.GetId())
+
+        self.m_menubar1.Insert(2, menu, 'Alignment')
+
+    def set_fit_method(self, method):
+        """Set the estimator used to fit alignments and saved homographies.
+
+        :param method: One of ROBUST_METHODS, or None for least squares.
+        :type method: str | None
+
+        """
+        self.fit_method = method
+
+    def on_set_fit_threshold(self, event=None):
+        """Ask the user for the inlier threshold of the robust fits.
+
+        """
+        msg = ''.join(['Maximum distance in pixels of a point from its warped ',
+                       'match for the pair to be an inlier of RANSAC or ',
+                       'MAGSAC fits, or to be shown as consistent with the ',
+                       'current alignment.'])
+        dlg = wx.TextEntryDialog(self, msg, 'Inlier Threshold',
+                                 '%g' % self.fit_threshold)
+        if dlg.ShowModal() == wx.ID_OK:
+            try:
+                threshold = float(dlg.GetValue())
+            except ValueError:
+                threshold = None
+
+            if threshold is None or not threshold > 0:
+                msg = 'Enter a positive number.'
+                warn_dlg = wx.MessageDialog(self, msg, 'Warning',
+                                            wx.OK | wx.ICON_WARNING)
+                warn_dlg.ShowModal()
+                warn_dlg.Destroy()
+            else:
+                self.fit_threshold = threshold
+                self.correspondences.residuals.threshold = threshold
+                self.refresh_panels()
+
+        dlg.Destroy()
+
+    @timed()
+    def on_suggest_matches(self, event=None):
+        """Detect and match features between the two images in the
+        background, and show the matches as suggestions (green points).
+
+        """
+        homography_type = self.transformation_type_choice.GetSelection()
+        if event is not None:
+            self.record_event('suggest_matches',
+                              feature_type=self.match_feature_type,
+                              ratio=self.match_ratio,
+                              cross_check=self.match_cross_check,
+                              ransac=self.match_ransac,
+                              threshold=self.fit_threshold,
+                              transform=homography_type)
+
+        if (any(pyramid is None for pyramid in self._image_pyramids0) or
+            any(load_id is not None for load_id in self._load_ids)):
+            msg = 'Load both images before suggesting matches.'
+            dlg = wx.MessageDialog(self, msg, 'Warning',
+                                   wx.OK | wx.ICON_WARNING)
+            dlg.ShowModal()
+            dlg.Destroy()
+            return
+
+        windows = tuple(self.side_panels(side)[0].display_window
+                        for side in (0, 1))
+        if self.match_ransac:
+            ransac_threshold = self.fit_threshold
+        else:
+            ransac_threshold = None
+
+        self._match_id = next(image_keys)
+        request = MatchRequest(tuple(self._image_pyramids0), windows,
+                               self.match_feature_type, self.match_ratio,
+                               self.match_cross_check, ransac_threshold,
+                               homography_type, self._match_id)
+        self.status_bar.SetStatusText('Suggesting matches...')
+        self._match_worker.submit(request)
+
+    def compute_matches(self, request):
+        """Suggest matches on the match worker thread.
+
+        :param request: Images and options.
+        :type request: MatchRequest
+
+        :return: Suggested pairs and None, or None and an error message.
+        :rtype: (Nx4 numpy.ndarray | None, str | None)
+
+        """
+        if self._match_pool is None and self.match_processes != 0:
+            self._match_pool = create_pool(self.match_processes)
+
+        try:
+            matches = suggest_matches(request.pyramids[0],
+                                      request.pyramids[1],
+                                      request.feature_type, request.ratio,
+                                      request.cross_check,
+                                      request.ransac_threshold,
+                                      request.homography_type,
+                                      windows=request.windows,
+                                      pool=self._match_pool)
+        except ValueError as e:
+            return None, str(e)
+        except Exception:
+            # The result must reach on_matches_found, which ends the request.
+            traceback.print_exc()
+            return None, 'Suggesting matches failed.'
+
+        return matches, None
+
+    def on_matches_found(self, request, result):
+        if not self or request.match_id != self._match_id:
+            return
+
+        self._match_id = None
+        if request.pyramids != tuple(self._image_pyramids0):
+            # An image was replaced in the meantime.
+            return
+
+        matches, error = result
+        if error is not None:
+            self.status_bar.SetStatusText(error)
+            return
+
+        self.set_candidates(matches)
+        msg = ('%i suggested matches. Left click a green point to accept it '
+               'or middle click to reject it.' % len(matches))
+        self.status_bar.SetStatusText(msg)
+
+    def set_candidates(self, candidates, refresh=True):
+        """Set the suggested pairs of points, which are shown as green points
+        until they are accepted or rejected.
+
+        :param candidates: Rows (x1, y1, x2, y2).
+        :type candidates: Nx4 numpy.ndarray
+
+        :param refresh: Redraw the panels. Otherwise, the caller refreshes
+            the markers that changed.
+        :type refresh: bool
+
+        """
+        self.selection.set_candidates(candidates)
+        self.show_candidates(refresh)
+
+    def show_candidates(self, refresh=True):
+        """Show the suggested pairs of 'selection' as green points.
+
+        """
+        candidates = self.selection.candidates
+        for panel in self.panels:
+            panel.set_green_points(
+                        candidates[:, 2*panel.side:2*panel.side+2], refresh)
+
+    def show_selection_changes(self, points):
+        """Redraw the markers of the pairs and suggestions that a change of
+        'selection' affected.
+
+        :param points: Rows (x1, y1, x2, y2) returned by the change.
+        :type points: Nx4 numpy.ndarray
+
+        """
+        self.show_candidates(refresh=False)
+        if len(points) > 0:
+            self.refresh_markers(points)
+
+    @timed()
+    def accept_candidates(self, rows=None):
+        """Add suggested pairs to the correspondences.
+
+        :param rows: Indices of the suggestions, or None for all of them.
+        :type rows: sequence of int | None
+
+        """
+        self.show_selection_changes(self.selection.accept_candidates(rows))
+
+    @timed()
+    def reject_candidates(self, rows=None):
+        """Discard suggested pairs.
+
+        :param rows: Indices of the suggestions, or None for all of them.
+        :type rows: sequence of int | None
+
+        """
+        self.show_selection_changes(self.selection.reject_candidates(rows))
+
+    def on_accept_suggestions(self, event=None):
+        if event is not None:
+            self.record_event('accept_suggestions')
+
+        self.accept_candidates()
+
+    def on_reject_suggestions(self, event=None):
+        if event is not None:
+            self.record_event('reject_suggestions')
+
+        self.reject_candidates()
+
+    def on_show_frame_times(self, event):
+        """Toggle drawing the recent frame and stage times and render cache
+        hit rate in each panel.
+
+        """
+        for panel in self.panels:
+            panel.show_stats = event.IsChecked()
+
+        self.refresh_panels()
+
+    def on_record_trace(self, event):
+        """Start recording a trace of the timed stages, or stop recording and
+        save it.
+
+        """
+        if event.IsChecked():
+            self.stage_timer.start_trace()
+            self.status_bar.SetStatusText('Recording trace.')
+            return
+
+        fdlg = wx.FileDialog(self, 'Save trace', os.getcwd(), 'trace.json',
+                             '*.json',
+                             style=wx.FD_SAVE|wx.FD_OVERWRITE_PROMPT)
+        if fdlg.ShowModal() == wx.ID_OK:
+            self.save_trace(fdlg.GetPath())
+        else:
+            self.stage_timer.stop_trace()
+
+    def save_trace(self, file_path):
+        """Stop recording the trace and write it to a file.
+
+        """
+        num_events = self.stage_timer.write_trace(file_path)
+        self.status_bar.SetStatusText('Wrote %i trace events to %s.' %
+                                      (num_events, file_path))
+
+    def compute_histogram(self, pyramid):
+        """Return the histogram of an image.
+
+        The histogram is computed from the finest pyramid level that is held
+        in memory and has no more than 'histogram_pixels' pixels, which is
+        plenty for choosing display windows and avoids reading all of a large
+        image (e.g., one memory mapped from the pyramid cache). Images that
+        are read on demand may have to be read in full to compute that level,
+        so it is called on the load workers.
+
+        :type pyramid: ImagePyramid
+
+        :rtype: ImageHistogram
+
+        """
+        level = pyramid.in_memory_level()
+        image = pyramid.get_level(level)
+        while (level < pyramid.num_levels - 1 and
+               image.shape[0]*image.shape[1] > self.histogram_pixels):
+            level += 1
+            image = pyramid.get_level(level)
+
+        return ImageHistogram(image)
+
+    def default_window(self, side):
+        """Return the display window used when an image is loaded.
+
+        8-bit images are displayed as is, and other images are stretched over
+        their full range of values.
+
+        """
+        histogram = self._histograms[side]
+        if histogram is None or histogram.dtype == np.uint8:
+            return None
+
+        return histogram.lower, histogram.upper
+
+    def set_display_window(self, side, window):
+        """Set the range of raw values mapped to the displayed 8-bit range
+        for one side's image.
+
+        :param side: 0 for the left image, 1 for the right image.
+        :type side: int
+
+        :param window: Lower and upper bound, or None to display 8-bit images
+            as is.
+        :type window: (float, float) | None
+
+        """
+        for panel in self.side_panels(side):
+            panel.set_display_window(window)
+
+    @timed()
+    def on_auto_stretch(self, event=None):
+        """Stretch the displayed range of both images between percentiles of
+        their histograms.
+
+        """
+        if event is not None:
+            self.record_event('auto_stretch')
 
-        # Image 2 views.
-        self.zoom_panel_right = ZoomPanelImage(self.image2_zoom_panel,
-                                        self.image_right,
-                                        zoom_spin_ctrl=self.zoom2_spin_ctrl,
-                                        click_callback=self.on_clicked_point2,
-                                        status_bar=self.status_bar)
+        for side in (0, 1):
+            histogram = self._histograms[side]
+            if histogram is not None:
+                window = histogram.window(*self.auto_stretch_percentiles)
+                self.set_display_window(side, window)
 
-        self.nav_panel_right = NavigationPanelImage(self.image2_nav_panel,
-                                                     self.image_right,
-                                                     self.zoom_panel_right,
-                                                     self.status_bar)
+    @timed()
+    def on_full_range(self, event=None):
+        if event is not None:
+            self.record_event('full_range')
 
-        # Apply the current default interpolation.
-        self.on_interpolation_update(None)
+        for side in (0, 1):
+            self.set_display_window(side, self.default_window(side))
 
-        # Interpolation choice bindings.
-        self.interpolation_choice.Bind(wx.EVT_CHOICE,
-                                       self.on_interpolation_update)
+    def on_set_window(self, side):
+        """Ask the user for the display window of one side's image.
 
-        # Grey out check box until alignment has been performed.
-        self.sync_zooms_checkbox.SetValue(False)
-        self.sync_zooms_checkbox.Enable(False)
+        """
+        histogram = self._histograms[side]
+        if histogram is None:
+            return
 
-        if self.passback_dict['points'] is not None:
-            points = self.passback_dict['points']
-            pts1 = points[:,:2]
-            pts2 = points[:,2:]
-            self.nav_panel_left.set_red_points(pts1)
-            self.zoom_panel_left.set_red_points(pts1)
-            self.nav_panel_right.set_red_points(pts2)
-            self.zoom_panel_right.set_red_points(pts2)
+        window = self.side_panels(side)[0].display_window
+        if window is None:
+            window = (0, 255)
+
+        msg = ''.join(['Lower and upper image values to map to black and ',
+                       'white (image range %g to %g).' % (histogram.lower,
+                                                          histogram.upper)])
+        dlg = wx.TextEntryDialog(self, msg, 'Display Window',
+                                 '%g %g' % tuple(window))
+        if dlg.ShowModal() == wx.ID_OK:
+            try:
+                lower, upper = [float(v) for v in dlg.GetValue().split()]
+            except ValueError:
+                lower = upper = None
+
+            if lower is None or not upper > lower:
+                msg = 'Enter two numbers, the lower one first.'
+                warn_dlg = wx.MessageDialog(self, msg, 'Warning',
+                                            wx.OK | wx.ICON_WARNING)
+                warn_dlg.ShowModal()
+                warn_dlg.Destroy()
+            else:
+                self.record_event('display_window', side=side,
+                                  window=(lower, upper))
+                self.set_display_window(side, (lower, upper))
 
-        self.Bind(wx.EVT_CLOSE, self.when_closed)
+        dlg.Destroy()
 
-        # Allow zooming by mouse scrolling from the upper navigation panels.
-        self.image1_nav_panel.Bind(wx.EVT_MOUSEWHEEL,
-                                   self.zoom_panel_left.on_zoom_mouse_wheel)
-        self.image2_nav_panel.Bind(wx.EVT_MOUSEWHEEL,
-                                   self.zoom_panel_right.on_zoom_mouse_wheel)
+    def side_panels(self, side):
+        """Return the navigation and zoom panels showing one side's image.
 
-        self.Show()
-        self.SetMinSize(self.GetSize())
+        """
+        if side == 0:
+            return self.nav_panel_left, self.zoom_panel_left
+        else:
+            return self.nav_panel_right, self.zoom_panel_right
 
     @property
-    def image_left(self):
-        """Return left image.
+    def panels(self):
+        return [self.nav_panel_left, self.nav_panel_right,
+                self.zoom_panel_left, self.zoom_panel_right]
 
-        If the contrast was ajdusted, the contrast-adjusted version is
-        returned.
+    @timed()
+    def refresh_panels(self):
+        """Redraw all panels, e.g., after the correspondences have changed.
 
         """
-        return self._image_left
+        for panel in self.panels:
+            panel.refresh()
 
-    @property
-    def image_right(self):
-        """Return right image.
+        self.show_reprojection_errors()
 
-        If the contrast was ajdusted, the contrast-adjusted version is
-        returned.
+    @timed()
+    def refresh_markers(self, points):
+        """Redraw the parts of the panels covered by the markers of some
+        correspondences, e.g., after they were added, changed, or deleted.
+
+        :param points: Rows (x1, y1, x2, y2) of the correspondences, as they
+            are or were drawn.
+        :type points: Nx4 numpy.ndarray | 4-array
 
         """
-        return self._image_right
+        points = np.atleast_2d(points)
+        for panel in self.panels:
+            panel.refresh_points(points[:, 2*panel.side:2*panel.side+2])
 
-    @image_left.setter
-    def image_left(self, image):
-        if image is not self._image_left:
-            # An original version is also stored for reference for contrast
-            # adjustment.
-            self._image_left0 = self._image_left = image
-            self.nav_panel_left.update_raw_image(self.image_left)
-            self.zoom_panel_left.update_raw_image(self.image_left)
+        self.show_reprojection_errors()
 
-    @image_right.setter
-    def image_right(self, image):
-        if image is not self._image_right:
-            # An original version is also stored for reference for contrast
-            # adjustment.
-            self._image_right0 = self._image_right = image
-            self.nav_panel_right.update_raw_image(self.image_right)
-            self.zoom_panel_right.update_raw_image(self.image_right)
+    def set_fit(self, homography, side=0):
+        """Set the homography that the reprojection errors of the
+        correspondences are computed under, which colour their markers.
 
-    @property
-    def points_to_align(self):
-        """Points from left image and right image to use for alignment.
+        :param homography: Homography that warps one side's image into the
+            other, or None if there is no fit.
+        :type homography: numpy.ndarray of shape (3,3) | None
+
+        :param side: Side of the image that 'homography' warps (0 for left,
+            1 for right).
+        :type side: int
+
+        """
+        self.selection.set_fit(homography, side, self.fit_threshold)
+        self.refresh_panels()
+
+    @timed()
+    def show_reprojection_errors(self):
+        """Show statistics of the reprojection errors of the accepted
+        correspondences under the current fit in the status bar.
 
         """
-        return self.nav_panel_left.red_points, self.nav_panel_right.red_points
+        residuals = self.correspondences.residuals
+        if residuals.homography is None:
+            return
+
+        states = self.correspondences.states
+        accepted = states == CorrespondenceStore.ACCEPTED
+        num_outliers = np.count_nonzero(states == CorrespondenceStore.OUTLIER)
+        forward = error_summary(residuals.forward[accepted], (50, 90, 100))
+        backward = error_summary(residuals.backward[accepted], (50, 90, 100))
+        if forward is None:
+            msg = 'No accepted pairs of points.'
+        else:
+            msg = 'Accepted pairs: %i, outliers: %i. ' % \
+                  (np.count_nonzero(accepted), num_outliers)
+            for name, summary in [('Left->right', forward),
+                                  ('Right->left', backward)]:
+                rms, (median, p90, maximum) = summary
+                msg += ('%s error RMS %.2f, median %.2f, 90%% %.2f, max %.2f '
+                        'px. ' % (name, rms, median, p90, maximum))
+
+        self.status_bar.SetStatusText(msg.strip())
 
-    def fit_homography(self, pts1, pts2, homography_type):
-        """Fit special class of homomgraphy.
+    def fit_homography(self, side, homography_type):
+        """Fit special class of homomgraphy to the complete correspondences,
+        and flag them as accepted or outliers according to the fit (all are
+        accepted by a least squares fit).
+
+        The homography is fitted with the estimator set by 'fit_method'.
+
+        :param side: Side of the image whose points are warped (0 for left, 1
+            for right).
+        :type side: int
 
-        :param homography_type:
         :param homography_type: Integer indicating the type of homography to
             fit (0 - translation, 1 - rigid, 2 - similarity, 3 - affine, 4 -
             fully homography).
         :type homography_type: int
 
+        :return: Homography, or None if it could not be fitted.
+        :rtype: numpy.ndarray of shape (3,3) | None
+
         """
-        if homography_type == 0:
-            # Translation.
-            if pts1 is None or pts2 is None or len(pts1) < 1:
-                self._warn_need_at_least_n_points(1, 'translation')
-                return
+        try:
+            H, inliers, changed = self.selection.fit(
+                                    side, homography_type, self.fit_method,
+                                    self.fit_threshold, self.fit_confidence)
+        except ValueError as e:
+            dlg = wx.MessageDialog(self, str(e), 'Warning',
+                                   wx.OK | wx.ICON_WARNING)
+            dlg.ShowModal()
+            dlg.Destroy()
+            return
 
-            H = np.identity(3)
-            delta = np.mean(pts2 - pts1, 0)
-            H = np.identity(3)
-            H[:2,2] = delta
-        elif homography_type == 1:
-            # Rigid.
-            if pts1 is None or pts2 is None or len(pts1) < 2:
-                self._warn_need_at_least_n_points(2, 'rigid')
-                return
+        if self.fit_method is not None:
+            msg = '%s: %i of %i pairs of points are inliers.' % \
+                  (self.fit_method.upper(), np.count_nonzero(inliers),
+                   len(inliers))
+            self.status_bar.SetStatusText(msg)
 
-            H = transformations.affine_matrix_from_points(pts1.T, pts2.T,
-                                                          shear=False,
-                                                          scale=False)
-        elif homography_type == 2:
-            # Similarity.
-            if pts1 is None or pts2 is None or len(pts1) < 2:
-                self._warn_need_at_least_n_points(2, 'rigid')
-                return
+        if len(changed) > 0:
+            self.refresh_markers(changed)
 
-            H = transformations.affine_matrix_from_points(pts1.T, pts2.T,
-                                                          shear=False,
-                                                          scale=True)
-        elif homography_type == 3:
-            # Affine.
-            if pts1 is None or pts2 is None or len(pts1) < 3:
-                self._warn_need_at_least_n_points(3, 'affine')
-                return
+        return H
 
-            H = transformations.affine_matrix_from_points(pts1.T, pts2.T,
-                                                          shear=True,
-                                                          scale=True)
-        elif homography_type == 4:
-            # Homography.
-            if pts1 is None or pts2 is None or len(pts1) < 4:
-                self._warn_need_at_least_n_points(4, 'homography')
-                return
+    def update_image_left_contrast(self, event):
+        self._contrast_coalescers[0](0)
 
-            H = cv2.findHomography(pts1.reshape(-1,1,2),
-                                   pts2.reshape(-1,1,2))[0]
-        else:
-            raise Exception()
+    def update_image_right_contrast(self, event):
+        self._contrast_coalescers[1](1)
 
-        return H
+    @timed()
+    def apply_contrast(self, side):
+        """Show one side's image with the contrast set by its slider.
 
-    def _warn_need_at_least_n_points(self, n, tform_type):
-        msg = ('Need to select at least %i pairs of points for %s alignment.'
-               % (n,tform_type))
-        dlg = wx.MessageDialog(self, msg,'Warning',
-                               wx.OK | wx.ICON_WARNING)
-        dlg.ShowModal()
-        dlg.Destroy()
+        Contrast-adjusted images are cached per slider value. Otherwise, the
+        navigation panel first shows a preview computed from the pyramid level
+        it is rendered from, while the full-resolution image is computed in the
+        background.
 
-    def update_image_left_contrast(self, event):
-        if self._image_left0 is None:
+        :param side: 0 for the left image, 1 for the right image.
+        :type side: int
+
+        """
+        pyramid0 = self._image_pyramids0[side]
+        if pyramid0 is None or self._load_ids[side] is not None:
             return
 
-        c = 10*self.left_contrast_slider.GetValue()/1000.0
-        if c > 0:
-            self._image_left = update_contrast(self._image_left0, c)
+        if side == 0:
+            image0 = self._image_left0
+            key = self._image_left_key
+            slider = self.left_contrast_slider
         else:
-            self._image_left = self._image_left0
+            image0 = self._image_right0
+            key = self._image_right_key
+            slider = self.right_contrast_slider
+
+        self.record_event('contrast', side=side, value=slider.GetValue())
+        if image0.dtype != np.uint8:
+            self.status_bar.SetStatusText('Contrast adjustment requires an '
+                                          '8-bit image, use the Display menu '
+                                          'instead.')
+            return
 
-        self.nav_panel_left.update_raw_image(self.image_left)
-        self.zoom_panel_left.update_raw_image(self.image_left)
+        if isinstance(image0, ImageSource):
+            self.status_bar.SetStatusText('Contrast adjustment is not '
+                                          'available for images read from '
+                                          'disk on demand.')
+            return
 
-    def update_image_right_contrast(self, event):
-        if self._image_right0 is None:
+        c = 10*slider.GetValue()/1000.0
+        image_key = (key, c)
+        if image_key == self._contrast_keys[side]:
             return
 
-        c = 10*self.right_contrast_slider.GetValue()/1000.0
+        self._contrast_keys[side] = image_key
         if c > 0:
-            self._image_right = update_contrast(self._image_right0, c)
+            pyramid = self.contrast_cache.get(image_key)
+        else:
+            pyramid = pyramid0
+
+        if pyramid is not None:
+            self.show_contrast(side, image_key, pyramid)
+            return
+
+        nav_panel = self.side_panels(side)[0]
+        preview_level = nav_panel.get_view_level()
+        request = ContrastRequest(side, image_key, pyramid0, c, preview_level)
+        self._contrast_workers[side].submit(request)
+
+    @timed('update_contrast')
+    def compute_contrast(self, request):
+        """Compute a contrast-adjusted pyramid on a worker thread.
+
+        """
+        worker = self._contrast_workers[request.side]
+        return contrast_pyramid(request.image_pyramid, request.clip_limit,
+                                request.preview_level,
+                                lambda preview: wx.CallAfter(
+                                    self.on_contrast_preview, request,
+                                    preview),
+                                cancelled=lambda: worker.has_pending)
+
+    @timed()
+    def on_contrast_preview(self, request, pyramid):
+        if not self or request.image_key != self._contrast_keys[request.side]:
+            return
+
+        nav_panel = self.side_panels(request.side)[0]
+        nav_panel.update_raw_image(nav_panel.raw_image,
+                                   request.image_key + ('preview',), pyramid)
+
+    @timed()
+    def on_contrast_finished(self, request, pyramid):
+        if not self:
+            return
+
+        # Scale the budget to include the coarser pyramid levels.
+        num_bytes = pyramid.get_level(0).nbytes*4//3
+        self.contrast_cache.put(request.image_key, pyramid, num_bytes)
+        if request.image_key == self._contrast_keys[request.side]:
+            self.show_contrast(request.side, request.image_key, pyramid)
+
+    @timed()
+    def show_contrast(self, side, image_key, pyramid):
+        """Display a contrast-adjusted pyramid in one side's panels.
+
+        """
+        image = pyramid.get_level(0)
+        if side == 0:
+            self._image_left = image
         else:
-            self._image_right = self._image_right0
+            self._image_right = image
 
-        self.nav_panel_right.update_raw_image(self.image_right)
-        self.zoom_panel_right.update_raw_image(self.image_right)
+        for panel in self.side_panels(side):
+            panel.update_raw_image(image, image_key, pyramid)
 
+    @timed()
     def on_interpolation_update(self, event):
         interp = self.interpolation_choice.GetSelection()
+        self.record_event('interpolation', value=interp)
 
         # Image 1
         self.zoom_panel_left.set_interpolation(interp)
@@ -1011,40 +2645,7 @@ class MainFrame(form_builder_output.MainFrame):
         :param pos: Raw image coordinates of the clicked point.
 
         """
-        if button == 1:
-            self.zoom_panel_left.set_center(pos)
-            if self.sync_zooms_checkbox.GetValue():
-                h1 = self.nav_panel_left.align_homography
-                h2 = self.nav_panel_right.align_homography
-                if h1 is not None and h2 is None:
-                    h = h1
-                elif h2 is not None and h1 is None:
-                    h = np.linalg.inv(h2)
-                else:
-                    raise Exception()
-
-                pos2 = np.dot(h, np.hstack([pos,1]))
-                self.zoom_panel_right.set_center(pos2[:2]/pos2[2])
-
-            return
-
-        if self.click_state == 0:
-            # Ready to start a new point pair.
-            self.nav_panel_left.add_blue_point(pos)
-            self.zoom_panel_left.add_blue_point(pos)
-            self.click_state = 1
-        elif self.click_state == 2:
-            # Finish out the click pair.
-            point = self.nav_panel_right.blue_points
-            self.nav_panel_right.clear_blue_points(refresh=False)
-            self.zoom_panel_right.clear_blue_points(refresh=False)
-            self.nav_panel_right.add_red_point(point)
-            self.zoom_panel_right.add_red_point(point)
-            self.nav_panel_left.add_red_point(pos)
-            self.zoom_panel_left.add_red_point(pos)
-            self.click_state = 0
-
-        #print('Clicked Image Coordinates ({:.2f},{:.2f})'.format(*pos))
+        self.on_clicked_point(0, pos, button)
 
     def on_clicked_point2(self, pos, button):
         """
@@ -1053,108 +2654,102 @@ class MainFrame(form_builder_output.MainFrame):
         :param pos: Raw image coordinates of the clicked point.
 
         """
-        if button == 1:
-            self.zoom_panel_right.set_center(pos)
-            if self.sync_zooms_checkbox.GetValue():
-                h1 = self.nav_panel_left.align_homography
-                h2 = self.nav_panel_right.align_homography
-                if h1 is not None and h2 is None:
-                    h = np.linalg.inv(h1)
-                elif h2 is not None and h1 is None:
-                    h = h2
-                else:
-                    raise Exception()
+        self.on_clicked_point(1, pos, button)
 
-                pos2 = np.dot(h, np.hstack([pos,1]))
-                self.zoom_panel_left.set_center(pos2[:2]/pos2[2])
+    @timed()
+    def on_clicked_point(self, side, pos, button):
+        """Handle a click in one side's zoom panel.
 
-            return
-
-        if self.click_state == 0:
-            # Ready to start a new point pair.
-            self.nav_panel_right.add_blue_point(pos)
-            self.zoom_panel_right.add_blue_point(pos)
-            self.click_state = 2
-        elif self.click_state == 1:
-            # Finish out the click pair.
-            point = self.nav_panel_left.blue_points
-            self.nav_panel_left.clear_blue_points(refresh=False)
-            self.zoom_panel_left.clear_blue_points(refresh=False)
-            self.nav_panel_left.add_red_point(point)
-            self.zoom_panel_left.add_red_point(point)
-            self.nav_panel_right.add_red_point(pos)
-            self.zoom_panel_right.add_red_point(pos)
-            self.click_state = 0
-
-        #print('Clicked Image Coordinates ({:.2f},{:.2f})'.format(*pos))
+        :param side: 0 for the left image, 1 for the right image.
+        :type side: int
 
-    def on_align_original(self, event):
-        panels = [self.nav_panel_left, self.nav_panel_right,
-                  self.zoom_panel_left, self.zoom_panel_right]
-        for panel in panels:
-            panel.align_homography = None
-            if panel.raw_image is not None:
-                panel.corrected_img_shape = panel.raw_image.shape[:2]
-                panel.update_all()
+        :param pos: Raw image coordinates of the clicked point.
+        :type pos: 2-array
 
-        self.sync_zooms_checkbox.SetValue(False)
-        self.sync_zooms_checkbox.Enable(False)
+        :param button: 0 to select a point, 1 to recenter the zoom panel, 2
+            to remove a point.
+        :type button: int
 
-    def on_align_left_to_right(self, event):
-        pts1,pts2 = self.points_to_align
+        """
+        sync = self.sync_zooms_checkbox.GetValue()
+        self.record_event('click', side=side, pos=pos, button=button,
+                          sync=sync)
+        if button != 1 and self._load_ids[side] is not None:
+            # Points cannot be selected until the image has finished loading.
+            return
 
-        H = self.fit_homography(pts1, pts2,
-                                self.transformation_type_choice.GetSelection())
+        zoom_panels = [self.zoom_panel_left, self.zoom_panel_right]
+        panel = zoom_panels[side]
+        if button == 1:
+            panel.set_center(pos, interactive=True)
+            if sync:
+                homographies = [self.nav_panel_left.align_homography,
+                                self.nav_panel_right.align_homography]
+                pos2 = self.selection.synced_center(side, pos, homographies)
+                if pos2 is not None:
+                    zoom_panels[1 - side].set_center(pos2, interactive=True)
 
-        if H is None:
             return
 
-        self.nav_panel_left.align_homography = H
+        max_distance = self.selection.pick_distance(panel.homography, pos)
+        if button == 2:
+            points = self.selection.remove_point(side, pos, max_distance)
+        else:
+            points = self.selection.add_point(side, pos, max_distance)
 
-        # Set zooms so that they match after alignment.
-        self.zoom_panel_left.set_zoom(self.zoom_panel_right.zoom)
+        self.show_selection_changes(points)
 
-        img_shape = self.nav_panel_right.raw_image.shape[:2]
-        panels = [self.nav_panel_left, self.zoom_panel_left]
-        for panel in panels:
-            panel.align_homography = H
-            panel.corrected_img_shape = img_shape
-            panel.update_all()
+    @property
+    def side_views(self):
+        """Navigation and zoom panel of the left and of the right image.
 
-        panels = [self.nav_panel_right, self.zoom_panel_right]
-        for panel in panels:
-            panel.align_homography = None
-            panel.corrected_img_shape = panel.raw_image.shape[:2]
+        """
+        return [self.side_panels(0), self.side_panels(1)]
+
+    @timed()
+    def on_align_original(self, event):
+        if event is not None:
+            self.record_event('align', direction='original')
+
+        for panel in align_views(self.side_views):
             panel.update_all()
 
-        self.sync_zooms_checkbox.Enable(True)
-        #self.sync_zooms_checkbox.SetValue(True)
+        self.sync_zooms_checkbox.SetValue(False)
+        self.sync_zooms_checkbox.Enable(False)
+        self.set_fit(None)
+
+    @timed()
+    def on_align_left_to_right(self, event):
+        self.record_event('align', direction='left_to_right',
+                          transform=self.transformation_type_choice.
+                          GetSelection(), method=self.fit_method,
+                          threshold=self.fit_threshold)
+        self.align_side(0)
 
+    @timed()
     def on_align_right_to_left(self, event):
-        pts1,pts2 = self.points_to_align
+        self.record_event('align', direction='right_to_left',
+                          transform=self.transformation_type_choice.
+                          GetSelection(), method=self.fit_method,
+                          threshold=self.fit_threshold)
+        self.align_side(1)
 
-        H = self.fit_homography(pts2, pts1,
-                                self.transformation_type_choice.GetSelection())
+    def align_side(self, side):
+        """Fit an alignment to the points and show one side's image warped
+        into the other's coordinates.
 
+        :param side: Side of the image that is warped (0 for left, 1 for
+            right).
+        :type side: int
+
+        """
+        H = self.fit_homography(side,
+                                self.transformation_type_choice.GetSelection())
         if H is None:
             return
 
-        self.nav_panel_right.align_homography = H
-
-        # Set zooms so that they match after alignment.
-        self.zoom_panel_right.set_zoom(self.zoom_panel_left.zoom)
-
-        img_shape = self.nav_panel_left.raw_image.shape[:2]
-        panels = [self.nav_panel_right, self.zoom_panel_right]
-        for panel in panels:
-            panel.align_homography = H
-            panel.corrected_img_shape = img_shape
-            panel.update_all()
-
-        panels = [self.nav_panel_left, self.zoom_panel_left]
-        for panel in panels:
-            panel.align_homography = None
-            panel.corrected_img_shape = panel.raw_image.shape[:2]
+        self.set_fit(H, side)
+        for panel in align_views(self.side_views, H, side):
             panel.update_all()
 
         self.sync_zooms_checkbox.Enable(True)
@@ -1164,54 +2759,191 @@ class MainFrame(form_builder_output.MainFrame):
         """Called by GUI menu 'Load Left Image'.
 
         """
-        ret = self.load_image()
-
-        if ret is not None:
-            self.image_left = ret
-            self.on_clear_all_button()
-            self.on_align_original(None)
+        file_path = self.ask_image_path()
+        if file_path is not None:
+            self.load_image_file(0, file_path)
 
     def on_load_right_image(self, event):
         """Called by GUI menu 'Load Right Image'.
 
         """
-        ret = self.load_image()
-
-        if ret is not None:
-            self.image_right = ret
-            self.on_clear_all_button()
-            self.on_align_original(None)
+        file_path = self.ask_image_path()
+        if file_path is not None:
+            self.load_image_file(1, file_path)
 
-    def load_image(self):
-        """Ask user to load image from disk.
+    def ask_image_path(self):
+        """Ask user to select an image file.
 
         """
         fdlg = wx.FileDialog(self, 'Select an image.')
         if fdlg.ShowModal() == wx.ID_OK:
-            file_path = fdlg.GetPath()
-        else:
-            return None
+            return fdlg.GetPath()
+
+        return None
+
+    @timed()
+    def load_image_file(self, side, file_path):
+        """Load an image file into one side in the background.
 
-        raw_image = cv2.imread(file_path,-1)
+        The panels first show a reduced-resolution preview when one can be
+        decoded quickly, and the full-resolution image replaces it once it is
+        ready. Loading another file into the same side abandons this load.
+
+        :param side: 0 for the left image, 1 for the right image.
+        :type side: int
+
+        :param file_path: Path of the image file.
+        :type file_path: str
+
+        """
+        self.record_event('load_image', side=side,
+                          path=os.path.abspath(file_path))
+        load_id = next(image_keys)
+        self._load_ids[side] = load_id
+        self._load_workers[side].submit(LoadRequest(side, file_path, load_id))
+        self.show_load_status(LoadRequest(side, file_path, load_id),
+                              'loading...')
+
+    def show_load_status(self, request, msg):
+        if self and request.load_id == self._load_ids[request.side]:
+            name = os.path.basename(request.file_path)
+            self.status_bar.SetStatusText('%s image %s: %s' %
+                                          (('Left', 'Right')[request.side],
+                                           name, msg))
+
+    @timed()
+    def read_image_file(self, request):
+        """Read an image file on a load worker thread.
+
+        If the pyramid cache is enabled, the decoded pyramid of the image is
+        stored in the background, and loading the same file again memory maps
+        the stored pyramid instead of decoding the file.
+
+        :param request: File to load.
+        :type request: LoadRequest
+
+        :return: Image, its pyramid, and its histogram, all None if the file
+            could not be read, or None if a newer load was requested.
+        :rtype: (numpy.ndarray | ImageSource, ImagePyramid | None,
+            ImageHistogram | None) | None
 
+        """
+        worker = self._load_workers[request.side]
+        file_path = request.file_path
+        start = time.time()
+
+        # Large images that can be read region by region are not loaded.
+        # The navigation panels and the histogram still need a coarse level
+        # of the pyramid in memory, which is read here rather than on the GUI
+        # thread. Without overviews stored in the file, computing it reads
+        # the whole image once.
+        source = open_image_source(file_path, self.lazy_load_bytes)
+        if source is not None:
+            pyramid = ImagePyramid(source)
+            if pyramid.overview_levels:
+                msg = 'reading stored overviews...'
+            else:
+                msg = 'reading the whole image once to compute overviews...'
+
+            wx.CallAfter(self.show_load_status, request, msg)
+            histogram = self.compute_histogram(pyramid)
+            if worker.has_pending:
+                return None
+
+            wx.CallAfter(self.show_load_status, request,
+                         'reading tiles on demand.')
+            return source, pyramid, histogram
+
+        if self.pyramid_cache is not None:
+            cache_key = self.pyramid_cache.file_key(file_path)
+            levels = self.pyramid_cache.load(cache_key)
+            if levels is not None:
+                pyramid = ImagePyramid.from_levels(levels)
+                histogram = self.compute_histogram(pyramid)
+                wx.CallAfter(self.show_load_status, request,
+                             'loaded from cache.')
+                return levels[0], pyramid, histogram
+
+        if (os.path.splitext(file_path)[1].lower() in ('.jpg', '.jpeg') and
+            os.path.getsize(file_path) >= self.preview_min_bytes):
+            preview = cv2.imread(file_path, cv2.IMREAD_REDUCED_COLOR_8)
+            if preview is not None and not worker.has_pending:
+                preview = cv2.cvtColor(preview, cv2.COLOR_BGR2RGB)
+                wx.CallAfter(self.on_image_preview, request, preview, 3)
+
+        wx.CallAfter(self.show_load_status, request,
+                     'decoding full resolution...')
+        raw_image = read_image(file_path)
         if raw_image is None:
-            print("Cannot open image.")
+            wx.CallAfter(self.show_load_status, request, 'cannot open image.')
+            return None, None, None
+
+        if worker.has_pending:
             return None
 
-        if raw_image.dtype is not np.dtype('uint8'):
-            raw_image = stretch_range_to_8bit(raw_image)
+        pyramid = ImagePyramid(raw_image)
+        histogram = self.compute_histogram(pyramid)
+        wx.CallAfter(self.show_load_status, request,
+                     'loaded in %.1f s.' % (time.time() - start))
+        if self.pyramid_cache is not None:
+            thread = threading.Thread(target=self._store_pyramid,
+                                      args=(cache_key, pyramid))
+            thread.daemon = True
+            thread.start()
+
+        return raw_image, pyramid, histogram
+
+    def _store_pyramid(self, cache_key, pyramid):
+        levels = [pyramid.get_level(level)
+                  for level in range(pyramid.num_levels)]
+        self.pyramid_cache.store(cache_key, levels)
+
+    @timed()
+    def on_image_preview(self, request, preview, level):
+        """Show a reduced-resolution preview of an image that is loading.
+
+        :param preview: Image downsampled by 2**level.
+        :type preview: numpy.ndarray
+
+        """
+        if not self or request.load_id != self._load_ids[request.side]:
+            return
+
+        # The panels only need the shape of the full-resolution image, which
+        # the preview approximates to within 2**level pixels.
+        s = 2**level
+        shape = (preview.shape[0]*s, preview.shape[1]*s) + preview.shape[2:]
+        placeholder = np.broadcast_to(np.zeros((), dtype=preview.dtype),
+                                      shape)
+        pyramid = ImagePyramid(preview, level=level, shape=shape)
+        image_key = (request.load_id, 'preview')
+        for panel in self.side_panels(request.side):
+            panel.display_window = None
+            panel.update_raw_image(placeholder, image_key, pyramid)
+
+        self.on_clear_all_button()
+        self.on_align_original(None)
+        self.show_load_status(request, 'showing preview, decoding full '
+                              'resolution...')
+
+    @timed()
+    def on_image_loaded(self, request, result):
+        if not self or request.load_id != self._load_ids[request.side]:
+            return
 
-        if raw_image.ndim == 3:
-            # BGR to RGB.
-            raw_image = raw_image[:,:,::-1]
+        self._load_ids[request.side] = None
+        image, pyramid, histogram = result
+        if image is None:
+            return
 
-        return raw_image
+        self.set_image(request.side, image, pyramid, histogram)
+        self.on_clear_all_button()
+        self.on_align_original(None)
 
     def on_save_points(self, event):
-        pts1 = self.nav_panel_left.red_points
-        pts2 = self.nav_panel_right.red_points
+        points = self.correspondences.select(CorrespondenceStore.COMPLETE)
 
-        if pts1 is None or pts2 is None:
+        if len(points) == 0:
             msg = 'No points have been selected.'
             dlg = wx.MessageDialog(self, msg,'Warning',
                                    wx.OK | wx.ICON_WARNING)
@@ -1227,37 +2959,42 @@ class MainFrame(form_builder_output.MainFrame):
         else:
             return
 
-        points = np.hstack([pts1,pts2])
         np.savetxt(file_path, points)
 
     def on_load_points(self, event=None):
         fdlg = wx.FileDialog(self, 'Load point correspondences', os.getcwd(),
                              'points', '*.txt', style=wx.FD_OPEN)
         if fdlg.ShowModal() == wx.ID_OK:
-            file_path = fdlg.GetPath()
-        else:
-            return
+            self.load_points_file(fdlg.GetPath())
 
-        points = np.loadtxt(file_path)
-        pts1 = points[:,:2]
-        pts2 = points[:,2:]
-        self.nav_panel_left.set_red_points(pts1)
-        self.zoom_panel_left.set_red_points(pts1)
-        self.nav_panel_right.set_red_points(pts2)
-        self.zoom_panel_right.set_red_points(pts2)
+    @timed()
+    def load_points_file(self, file_path):
+        """Replace the point correspondences with those saved in a file.
+
+        """
+        self.record_event('load_points', path=os.path.abspath(file_path))
+        self.selection.load_points(np.loadtxt(file_path))
+        self.refresh_panels()
 
     def on_save_left_to_right_homography(self, event):
-        pts1 = self.nav_panel_left.red_points
-        pts2 = self.nav_panel_right.red_points
-        self.save_homography(pts1, pts2)
+        self.save_homography(0)
 
     def on_save_right_to_left_homography(self, event):
-        pts1 = self.nav_panel_left.red_points
-        pts2 = self.nav_panel_right.red_points
-        self.save_homography(pts2, pts1)
+        self.save_homography(1)
+
+    def save_homography(self, side):
+        """Fit a homography that warps the points of one side onto those of
+        the other and save it to a file chosen by the user.
+
+        The point pairs are flagged as accepted or outliers (see
+        fit_homography).
 
-    def save_homography(self, pts1, pts2):
-        if pts1 is None or pts2 is None or len(pts1) < 4:
+        :param side: Side of the image whose points are warped (0 for left, 1
+            for right).
+        :type side: int
+
+        """
+        if len(self.selection.rows_to_align) < 4:
             msg = ''.join(['Need at least four selected pairs of points to ',
                            'calculate homography.'])
             dlg = wx.MessageDialog(self, msg,'Warning',
@@ -1274,9 +3011,9 @@ class MainFrame(form_builder_output.MainFrame):
         else:
             return
 
-        H = cv2.findHomography(pts1.reshape(-1,1,2),
-                               pts2.reshape(-1,1,2))[0]
-        np.savetxt(file_path, H)
+        H = self.fit_homography(side, 4)
+        if H is not None:
+            np.savetxt(file_path, H)
 
     def on_menu_item_about(self, event):
         info = wx.adv.AboutDialogInfo()
@@ -1293,26 +3030,21 @@ class MainFrame(form_builder_output.MainFrame):
         # Show the AboutBox
         wx.adv.AboutBox(info)
 
+    @timed()
     def on_clear_last_button(self, event=None):
-        for panel in [self.nav_panel_left,
-                      self.nav_panel_right,
-                      self.zoom_panel_left,
-                      self.zoom_panel_right]:
-
-            if self.click_state == 0:
-                panel.clear_last_red_point(refresh=True)
-            else:
-                panel.clear_blue_points(refresh=True)
+        if event is not None:
+            self.record_event('clear_last')
 
-        self.click_state = 0
+        self.show_selection_changes(self.selection.clear_last())
 
+    @timed()
     def on_clear_all_button(self, event=None):
-        for panel in [self.nav_panel_left,
-                      self.nav_panel_right,
-                      self.zoom_panel_left,
-                      self.zoom_panel_right]:
-            panel.clear_blue_points(refresh=False)
-            panel.clear_red_points(refresh=True)
+        if event is not None:
+            self.record_event('clear_all')
+
+        self.selection.clear()
+        self.show_candidates(refresh=False)
+        self.refresh_panels()
 
     def on_cancel_button(self, event=None):
         self.on_clear_all_button()
@@ -1321,12 +3053,224 @@ class MainFrame(form_builder_output.MainFrame):
     def on_finish_button(self, event=None):
         self.Close()
 
-    def when_closed(self, event=None):
-        if self.nav_panel_left.red_points is not None and \
-           self.nav_panel_right.red_points is not None:
-            points = np.hstack([self.nav_panel_left.red_points,
-                                self.nav_panel_right.red_points])
+    def record_event(self, event, **fields):
+        """Record an input event of the session, if it is being recorded.
+
+        Events fed back by a replay are not recorded again.
+
+        """
+        if self.session_recorder is not None and self._replay is None:
+            self.session_recorder.record(event, **fields)
+
+    def dispatch_event(self, event):
+        """Feed a recorded input event through the handler that recorded it.
+
+        :param event: Recorded event (see keypointgui.session).
+        :type event: dict
+
+        :return: False if the kind of event is not replayed.
+        :rtype: bool
+
+        """
+        name = event['event']
+        if name == 'start':
+            self.SetSize(tuple(event['window']))
+            return False
+        elif name == 'load_image':
+            self.load_image_file(event['side'], event['path'])
+        elif name == 'click':
+            self.sync_zooms_checkbox.SetValue(event.get('sync', False))
+            handler = [self.on_clicked_point1,
+                       self.on_clicked_point2][event['side']]
+            handler(np.array(event['pos']), event['button'])
+        elif name == 'zoom':
+            panel = [self.zoom_panel_left,
+                     self.zoom_panel_right][event['side']]
+            panel.set_zoom(event['zoom'], interactive=True)
+        elif name == 'contrast':
+            slider = [self.left_contrast_slider,
+                      self.right_contrast_slider][event['side']]
+            slider.SetValue(event['value'])
+            self.apply_contrast(event['side'])
+        elif name == 'interpolation':
+            self.interpolation_choice.SetSelection(event['value'])
+            self.on_interpolation_update(None)
+        elif name == 'align':
+            if event['direction'] == 'original':
+                self.on_align_original(None)
+            else:
+                self.transformation_type_choice.SetSelection(
+                                                        event['transform'])
+                self.fit_method = event.get('method')
+                self.fit_threshold = event.get('threshold',
+                                               self.fit_threshold)
+                if event['direction'] == 'left_to_right':
+                    self.on_align_left_to_right(None)
+                else:
+                    self.on_align_right_to_left(None)
+        elif name == 'suggest_matches':
+            self.match_feature_type = event['feature_type']
+            self.match_ratio = event['ratio']
+            self.match_cross_check = event['cross_check']
+            self.match_ransac = event['ransac']
+            self.fit_threshold = event['threshold']
+            self.transformation_type_choice.SetSelection(event['transform'])
+            self.on_suggest_matches()
+        elif name == 'accept_suggestions':
+            self.on_accept_suggestions()
+        elif name == 'reject_suggestions':
+            self.on_reject_suggestions()
+        elif name == 'auto_stretch':
+            self.on_auto_stretch()
+        elif name == 'full_range':
+            self.on_full_range()
+        elif name == 'display_window':
+            self.set_display_window(event['side'], tuple(event['window']))
+        elif name == 'clear_last':
+            self.on_clear_last_button()
+        elif name == 'clear_all':
+            self.on_clear_all_button()
+        elif name == 'load_points':
+            self.load_points_file(event['path'])
+        else:
+            return False
+
+        return True
+
+    @property
+    def settled(self):
+        """True if all loads and contrast adjustments have finished, and every
+        panel displays its current view.
+
+        """
+        if any(load_id is not None for load_id in self._load_ids):
+            return False
+
+        if not all(worker.idle for worker in self._contrast_workers):
+            return False
+
+        # The worker is idle before the suggestions reach the panels.
+        if self._match_id is not None:
+            return False
+
+        for side in (0, 1):
+            if self._image_pyramids0[side] is None:
+                continue
+
+            # A contrast-adjusted image may still be on its way to the panels.
+            for panel in self.side_panels(side):
+                if panel.image_key != self._contrast_keys[side]:
+                    return False
+
+        return all(panel.settled for panel in self.panels)
+
+    def replay_session(self, events, realtime=False, callback=None,
+                       timeout=30):
+        """Feed recorded input events through the event handlers, one at a
+        time, and measure how long each takes to be handled and displayed.
+
+        The next event is dispatched once the frame is 'settled' after the
+        previous one, which is checked every millisecond.
+
+        :param events: Recorded events (see keypointgui.session).
+        :type events: list of dict
+
+        :param realtime: Dispatch events no earlier than at their recorded
+            time after the start of the replay, instead of as fast as
+            possible.
+        :type realtime: bool
+
+        :param callback: Function called with the latencies when the replay
+            has finished (see keypointgui.session.latency_percentiles).
+        :type callback: callable | None
+
+        :param timeout: Seconds after which an event that has not settled is
+            counted as timed out and the next event is dispatched.
+        :type timeout: float
+
+        """
+        self._replay = {'events': list(events), 'index': 0,
+                        'latencies': [], 'realtime': realtime,
+                        'callback': callback, 'timeout': timeout,
+                        't0': time.time()}
+        wx.CallAfter(self._replay_next)
+
+    def _replay_next(self):
+        replay = self._replay
+        if not self or replay is None:
+            return
+
+        if replay['index'] == len(replay['events']):
+            self._replay = None
+            latencies = replay['latencies']
+            summary = latency_percentiles(latencies)
+            if 'all' in summary and 'p50' in summary['all']:
+                self.status_bar.SetStatusText(
+                    'Replayed %i events, median latency %.1f ms.' %
+                    (summary['all']['count'], summary['all']['p50']))
+
+            if replay['callback'] is not None:
+                replay['callback'](latencies)
+
+            return
+
+        event = replay['events'][replay['index']]
+        if replay['realtime']:
+            delay = replay['t0'] + event.get('t', 0) - time.time()
+            if delay > 0.001:
+                wx.CallLater(int(delay*1000), self._replay_next)
+                return
+
+        replay['index'] += 1
+        start = time.time()
+        if self.dispatch_event(event):
+            wx.CallLater(1, self._replay_wait, event['event'], start)
+        else:
+            wx.CallAfter(self._replay_next)
+
+    def _replay_wait(self, name, start):
+        replay = self._replay
+        if not self or replay is None:
+            return
+
+        elapsed = time.time() - start
+        if self.settled:
+            replay['latencies'].append((name, elapsed))
+        elif elapsed > replay['timeout']:
+            replay['latencies'].append((name, None))
         else:
+            wx.CallLater(1, self._replay_wait, name, start)
+            return
+
+        self._replay_next()
+
+    def when_closed(self, event=None):
+        for panel in self.panels:
+            panel.close()
+
+        for coalescer, worker in zip(self._contrast_coalescers,
+                                     self._contrast_workers):
+            coalescer.stop()
+            worker.stop()
+
+        for worker in self._load_workers:
+            worker.stop()
+
+        self._match_worker.stop()
+        if self._match_pool is not None:
+            self._match_pool.terminate()
+
+        self.render_pool.stop()
+        cv2.setNumThreads(self._opencv_threads0)
+
+        if self.trace_file is not None and self.stage_timer.tracing:
+            self.save_trace(self.trace_file)
+
+        if self.session_recorder is not None:
+            self.session_recorder.close()
+
+        points = self.correspondences.select(CorrespondenceStore.COMPLETE)
+        if len(points) == 0:
             points = None
 
         self.passback_dict['points'] = points
@@ -1363,6 +3307,32 @@ def manual_registration(image1=None, image2=None, points=None,
         return passback_dict['points']
 
 
+def replay_session(events, realtime=False):
+    """Open the GUI, replay recorded input events through its event
+    handlers, and close it (see MainFrame.replay_session).
+
+    :param events: Recorded events (see keypointgui.session).
+    :type events: list of dict
+
+    :return: Kind of each replayed event and the time in seconds until it was
+        handled and displayed, or None if it timed out.
+    :rtype: list of (str, float | None)
+
+    """
+    app = wx.App(False)
+    frame = MainFrame(None, None, None, passback_dict={'points': None},
+                      session_file='')
+    result = []
+
+    def finished(latencies):
+        result.extend(latencies)
+        frame.Close()
+
+    frame.replay_session(events, realtime, finished)
+    app.MainLoop()
+    return result
+
+
 def main():
     """
 
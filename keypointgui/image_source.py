@@ -0,0 +1,664 @@
+#!/usr/bin/env python
+"""
+Image sources that are read one region at a time, so that images larger than
+the available memory can be displayed. Only the regions covering the current
+view are read, and decoded tiles are kept in a shared, size-bounded cache.
+
+Coarse views of the whole image (e.g., the navigation panels) need the image
+at a much lower resolution. Reduced-resolution versions stored in the file
+(e.g., the overviews of a pyramidal TIFF) are read for those when available.
+Otherwise, the lower resolution is computed from the full-resolution image,
+which reads all of it once.
+
+"""
+from __future__ import division, print_function
+import collections
+import hashlib
+import itertools
+import os
+import shutil
+import tempfile
+import threading
+import time
+import numpy as np
+import cv2
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+
+class LRUCache(object):
+    """Least-recently-used cache bounded by the total size of its values.
+
+    The cache may be used from several threads.
+
+    Attributes:
+    :param max_bytes: Maximum total size of all cached values. When adding a
+        value would exceed this budget, the least-recently-used values are
+        evicted.
+    :type max_bytes: int
+
+    :param num_bytes: Current total size of all cached values.
+    :type num_bytes: int
+
+    :param hits: Number of calls to 'get' that found the key.
+    :type hits: int
+
+    :param misses: Number of calls to 'get' that did not find the key.
+    :type misses: int
+
+    """
+    def __init__(self, max_bytes=256*2**20):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    @property
+    def hit_rate(self):
+        """Fraction of calls to 'get' that found the key.
+
+        """
+        num_calls = self.hits + self.misses
+        if num_calls == 0:
+            return 0.0
+
+        return self.hits/num_calls
+
+    def get(self, key, default=None):
+        """Return the value stored for 'key' and mark it as recently used.
+
+        """
+        with self._lock:
+            try:
+                entry = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, num_bytes):
+        """Add a value to the cache.
+
+        :param num_bytes: Size of 'value' counted against 'max_bytes'. Values
+            larger than the whole budget are not cached.
+        :type num_bytes: int
+
+        """
+        with self._lock:
+            self.pop(key)
+            if num_bytes > self.max_bytes:
+                return
+
+            self._entries[key] = (value, num_bytes)
+            self.num_bytes += num_bytes
+            while self.num_bytes > self.max_bytes:
+                self.num_bytes -= self._entries.popitem(last=False)[1][1]
+
+    def pop(self, key):
+        """Remove 'key' from the cache, returning its value or None.
+
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+
+            self.num_bytes -= entry[1]
+            return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.num_bytes = 0
+
+
+# Decoded tiles of all sources share one memory budget.
+tile_cache = LRUCache(256*2**20)
+
+# Source of unique keys identifying sources in 'tile_cache'.
+source_keys = itertools.count()
+
+# Types that OpenCV can resample. Other types are read as float32.
+warpable_dtypes = (np.uint8, np.uint16, np.int16, np.float32, np.float64)
+
+
+def warpable_dtype(dtype):
+    """Return the type that values of 'dtype' are resampled as.
+
+    """
+    if dtype in warpable_dtypes:
+        return np.dtype(dtype)
+
+    return np.dtype(np.float32)
+
+
+class ImageSource(object):
+    """Base class for an image that is read one region at a time.
+
+    Indexing a source with two slices, e.g., source[y0:y1, x0:x1], reads that
+    region into a numpy.ndarray, so a source can stand in for an array
+    wherever only regions of it are accessed.
+
+    Subclasses set 'shape' and 'dtype' and implement 'read_region'.
+
+    Attributes:
+    :param shape: Shape of the image, (height, width) or (height, width,
+        channels).
+    :type shape: tuple
+
+    :param dtype: Type of the arrays returned by 'read_region'.
+    :type dtype: numpy.dtype
+
+    """
+    shape = None
+    dtype = None
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape))*self.dtype.itemsize
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        if len(key) > 2 or not all(isinstance(k, slice) for k in key):
+            raise IndexError('ImageSource only supports indexing with one or '
+                             'two slices.')
+
+        key = key + (slice(None),)*(2 - len(key))
+        y0, y1, ystep = key[0].indices(self.shape[0])
+        x0, x1, xstep = key[1].indices(self.shape[1])
+        if ystep != 1 or xstep != 1:
+            raise IndexError('ImageSource does not support strided slices.')
+
+        return self.read_region(x0, y0, max(x1, x0), max(y1, y0))
+
+    def read_region(self, x0, y0, x1, y1):
+        """Read a rectangular region of the image.
+
+        :param x0: First column.
+        :type x0: int
+
+        :param y0: First row.
+        :type y0: int
+
+        :param x1: One past the last column.
+        :type x1: int
+
+        :param y1: One past the last row.
+        :type y1: int
+
+        :return: Region of the image.
+        :rtype: numpy.ndarray
+
+        """
+        raise NotImplementedError
+
+    def read(self, band_rows=256):
+        """Read the whole image, one band of rows at a time.
+
+        """
+        image = np.empty(self.shape, dtype=self.dtype)
+        for y0 in range(0, self.shape[0], band_rows):
+            image[y0:y0+band_rows] = self[y0:y0+band_rows, :]
+
+        return image
+
+    def overviews(self):
+        """Return the reduced-resolution versions of the image that are
+        stored with it, finest first.
+
+        :rtype: list of ImageSource
+
+        """
+        return []
+
+    def close(self):
+        pass
+
+
+class ArraySource(ImageSource):
+    """An image that is already in memory.
+
+    """
+    def __init__(self, array):
+        """
+        :param array: Image.
+        :type array: numpy.ndarray
+
+        """
+        self.array = array
+        self.shape = array.shape
+        self.dtype = array.dtype
+
+    def read_region(self, x0, y0, x1, y1):
+        return self.array[y0:y1, x0:x1]
+
+
+class MemmapSource(ImageSource):
+    """An image in a .npy file or raw binary file that is memory mapped, so
+    the operating system only reads the pages covering the requested regions.
+
+    """
+    def __init__(self, path, shape=None, dtype=None, offset=0):
+        """
+        :param path: Path of the file.
+        :type path: str
+
+        :param shape: Shape of the image in a raw file. If None, the file is
+            read as a .npy file.
+        :type shape: tuple | None
+
+        :param dtype: Type of the values in a raw file.
+        :type dtype: numpy.dtype | None
+
+        :param offset: Offset in bytes of the image in a raw file.
+        :type offset: int
+
+        """
+        if shape is None:
+            self._array = np.load(path, mmap_mode='r')
+        else:
+            self._array = np.memmap(path, dtype=dtype, mode='r',
+                                    offset=offset, shape=tuple(shape))
+
+        if self._array.ndim not in (2, 3):
+            raise ValueError('Expected an image array with two or three '
+                             'dimensions, not %i.' % self._array.ndim)
+
+        self.shape = self._array.shape
+        self.dtype = warpable_dtype(self._array.dtype)
+
+    def read_region(self, x0, y0, x1, y1):
+        return np.array(self._array[y0:y1, x0:x1], dtype=self.dtype)
+
+    def close(self):
+        self._array = None
+
+
+class TiffSource(ImageSource):
+    """A TIFF image that is decoded one tile (or strip) at a time.
+
+    Requires the tifffile package. Only the first page is read, and its
+    samples must be stored interleaved (planar configuration 1). Overviews
+    stored as reduced-resolution pages or SubIFDs of the first page (e.g., by
+    GDAL or in a pyramidal OME-TIFF) are available from 'overviews'.
+
+    """
+    def __init__(self, path, cache=None, level=0):
+        """
+        :param path: Path of the file.
+        :type path: str
+
+        :param cache: Cache of decoded tiles. Defaults to 'tile_cache', which
+            is shared by all sources.
+        :type cache: LRUCache | None
+
+        :param level: Resolution level to read, where 0 is the first page and
+            higher levels are its overviews, finest first.
+        :type level: int
+
+        """
+        if tifffile is None:
+            raise ImportError('Reading TIFF images tile by tile requires the '
+                              'tifffile package.')
+
+        self._path = path
+        self._level = level
+        self._tiff = tifffile.TiffFile(path)
+        try:
+            if level == 0:
+                page = self._tiff.pages[0]
+            else:
+                page = self._tiff.series[0].levels[level].keyframe
+
+            if page.imagedepth != 1 or len(page.shape) not in (2, 3):
+                raise ValueError('Volumetric TIFF images are not supported.')
+
+            if page.samplesperpixel > 1 and page.planarconfig != 1:
+                raise ValueError('TIFF images with separate sample planes are '
+                                 'not supported.')
+
+            if page.is_tiled:
+                self._tile_size = (page.tilelength, page.tilewidth)
+            else:
+                self._tile_size = (min(page.rowsperstrip, page.imagelength),
+                                   page.imagewidth)
+        except Exception:
+            self._tiff.close()
+            raise
+
+        self._page = page
+        self.shape = page.shape
+        self.dtype = warpable_dtype(page.dtype)
+        self._tiles_across = -(-page.imagewidth//self._tile_size[1])
+        self._lock = threading.Lock()
+        self._key = next(source_keys)
+        self.tile_cache = tile_cache if cache is None else cache
+
+    def overviews(self):
+        if self._level != 0:
+            return []
+
+        series = self._tiff.series[0]
+        if series.keyframe is not self._page:
+            # The first page is not the base of a pyramid.
+            return []
+
+        overviews = []
+        for level in range(1, len(series.levels)):
+            try:
+                overviews.append(TiffSource(self._path, self.tile_cache,
+                                            level))
+            except ValueError:
+                # Layouts that cannot be read tile by tile.
+                pass
+
+        return overviews
+
+    def get_tile(self, row, col):
+        """Return a decoded tile, reading it from the file if it is not in
+        the cache.
+
+        :param row: Tile row.
+        :type row: int
+
+        :param col: Tile column.
+        :type col: int
+
+        :return: Tile, which may extend beyond the image for tiles on the
+            bottom and right edges.
+        :rtype: numpy.ndarray
+
+        """
+        key = (self._key, row, col)
+        tile = self.tile_cache.get(key)
+        if tile is not None:
+            return tile
+
+        index = row*self._tiles_across + col
+        page = self._page
+        with self._lock:
+            fh = self._tiff.filehandle
+            fh.seek(page.dataoffsets[index])
+            data = fh.read(page.databytecounts[index])
+
+        # Decoding releases the GIL, so it happens outside of the lock.
+        tile, _, shape = page.decode(data, index, jpegtables=page.jpegtables)
+        if tile is None:
+            # Empty tiles are not stored in the file.
+            shape = self._tile_size + self.shape[2:]
+            tile = np.zeros(shape, dtype=self.dtype)
+        else:
+            tile = tile.reshape(shape[1:3] + self.shape[2:])
+            tile = tile.astype(self.dtype, copy=False)
+
+        self.tile_cache.put(key, tile, tile.nbytes)
+        return tile
+
+    def read_region(self, x0, y0, x1, y1):
+        region = np.empty((y1 - y0, x1 - x0) + self.shape[2:],
+                          dtype=self.dtype)
+        tile_height, tile_width = self._tile_size
+        for row in range(y0//tile_height, -(-y1//tile_height)):
+            ty = row*tile_height
+            for col in range(x0//tile_width, -(-x1//tile_width)):
+                tx = col*tile_width
+                tile = self.get_tile(row, col)
+                ry0, ry1 = max(y0, ty), min(y1, ty + tile_height)
+                rx0, rx1 = max(x0, tx), min(x1, tx + tile_width)
+                region[ry0-y0:ry1-y0, rx0-x0:rx1-x0] = tile[ry0-ty:ry1-ty,
+                                                            rx0-tx:rx1-tx]
+
+        return region
+
+    def close(self):
+        self._tiff.close()
+
+
+class DownsampledSource(ImageSource):
+    """Another source downsampled by a factor of two with cv2.pyrDown, one
+    region at a time.
+
+    Each region is computed from the corresponding region of the parent plus
+    a margin covering the support of the pyrDown filter, so the result matches
+    downsampling the whole parent image at once.
+
+    """
+    def __init__(self, parent):
+        """
+        :param parent: Source to downsample.
+        :type parent: ImageSource
+
+        """
+        self.parent = parent
+        height, width = parent.shape[:2]
+        self.shape = ((height + 1)//2, (width + 1)//2) + parent.shape[2:]
+        self.dtype = parent.dtype
+
+        # Factor by which the first source that is not downsampled is reduced.
+        if isinstance(parent, DownsampledSource):
+            self.factor = 2*parent.factor
+        else:
+            self.factor = 2
+
+    def read(self, max_source_pixels=2**24):
+        """Read the whole image, one square block at a time.
+
+        Each block is computed from the corresponding region of the first
+        source that is not downsampled, so blocks are sized for that region to
+        have about 'max_source_pixels' pixels, which bounds the memory used
+        however often the source is downsampled.
+
+        """
+        size = max(int(np.sqrt(max_source_pixels))//self.factor, 32)
+        image = np.empty(self.shape, dtype=self.dtype)
+        for y0 in range(0, self.shape[0], size):
+            for x0 in range(0, self.shape[1], size):
+                image[y0:y0+size, x0:x0+size] = self[y0:y0+size, x0:x0+size]
+
+        return image
+
+    def read_region(self, x0, y0, x1, y1):
+        height, width = self.parent.shape[:2]
+
+        # Margins are even, so the region starts on an even parent pixel.
+        px0 = max(2*x0 - 4, 0)
+        py0 = max(2*y0 - 4, 0)
+        px1 = min(2*x1 + 4, width)
+        py1 = min(2*y1 + 4, height)
+        patch = cv2.pyrDown(self.parent[py0:py1, px0:px1])
+        return patch[y0-py0//2:y1-py0//2, x0-px0//2:x1-px0//2]
+
+
+def open_image_source(path, min_bytes=256*2**20):
+    """Open an image file as a source that is read region by region.
+
+    :param path: Path of the image file.
+    :type path: str
+
+    :param min_bytes: Files smaller than this are better read into memory
+        whole.
+    :type min_bytes: int
+
+    :return: Image source, or None if the file is too small or its format
+        cannot be read region by region, in which case it should be decoded
+        normally.
+    :rtype: ImageSource | None
+
+    """
+    if os.path.getsize(path) < min_bytes:
+        return None
+
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.npy':
+        return MemmapSource(path)
+
+    if ext in ('.tif', '.tiff') and tifffile is not None:
+        try:
+            return TiffSource(path)
+        except ValueError:
+            # Layouts that cannot be read tile by tile.
+            return None
+
+    return None
+
+
+class PyramidDiskCache(object):
+    """Directory of decoded image pyramids stored as .npy files, which are
+    memory mapped when the same image file is loaded again.
+
+    Each entry is a subdirectory named by the key of the image file (see
+    'file_key') holding one file per pyramid level. When the total size of
+    all entries exceeds 'max_bytes', the least recently used entries are
+    deleted.
+
+    Attributes:
+    :param directory: Cache directory.
+    :type directory: str
+
+    :param max_bytes: Maximum total size of all entries.
+    :type max_bytes: int
+
+    """
+    # Changing how images are decoded invalidates existing entries.
+    version = 1
+
+    def __init__(self, directory, max_bytes=4*2**30):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def file_key(self, path, num_samples=16, sample_bytes=2**16):
+        """Return a key identifying the content of an image file.
+
+        Rather than hashing the whole file, the hash covers the file size,
+        modification time, and evenly spaced samples of its content, so
+        computing it takes milliseconds even for very large files.
+
+        :param path: Path of the image file.
+        :type path: str
+
+        :rtype: str
+
+        """
+        stat = os.stat(path)
+        sha = hashlib.sha1()
+        sha.update(repr((self.version, stat.st_size,
+                         stat.st_mtime)).encode('utf-8'))
+        with open(path, 'rb') as f:
+            max_offset = max(stat.st_size - sample_bytes, 0)
+            for i in range(num_samples + 1):
+                f.seek(max_offset*i//num_samples)
+                sha.update(f.read(sample_bytes))
+
+        return sha.hexdigest()
+
+    def load(self, key):
+        """Return the memory-mapped pyramid levels stored for 'key'.
+
+        :return: Pyramid levels, finest first, or None if there is no entry.
+        :rtype: list of numpy.ndarray | None
+
+        """
+        entry = os.path.join(self.directory, key)
+        levels = []
+        while True:
+            path = os.path.join(entry, 'level_%i.npy' % len(levels))
+            if not os.path.isfile(path):
+                break
+
+            try:
+                levels.append(np.load(path, mmap_mode='r'))
+            except (IOError, OSError, ValueError):
+                return None
+
+        if len(levels) == 0:
+            return None
+
+        # The modification time of an entry records when it was last used.
+        os.utime(entry, None)
+        return levels
+
+    def store(self, key, levels):
+        """Store pyramid levels for 'key' and evict old entries.
+
+        The levels are written to a temporary directory that is renamed once
+        complete, so a partially written entry is never loaded.
+
+        :param levels: Pyramid levels, finest first.
+        :type levels: list of numpy.ndarray
+
+        :return: True if the entry was stored.
+        :rtype: bool
+
+        """
+        entry = os.path.join(self.directory, key)
+        if os.path.isdir(entry):
+            return False
+
+        tmp = tempfile.mkdtemp(prefix='.tmp-', dir=self.directory)
+        try:
+            for i, level in enumerate(levels):
+                np.save(os.path.join(tmp, 'level_%i.npy' % i), level)
+
+            os.rename(tmp, entry)
+        except (IOError, OSError):
+            shutil.rmtree(tmp, ignore_errors=True)
+            return False
+
+        self.evict()
+        return True
+
+    def evict(self, stale_seconds=24*3600):
+        """Delete the least recently used entries until the cache fits in
+        'max_bytes', as well as temporary directories abandoned for
+        'stale_seconds' (e.g., by a process that exited while storing).
+
+        """
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not os.path.isdir(path):
+                continue
+
+            mtime = os.path.getmtime(path)
+            if name.startswith('.'):
+                if now - mtime > stale_seconds:
+                    shutil.rmtree(path, ignore_errors=True)
+
+                continue
+
+            size = sum(os.path.getsize(os.path.join(path, f))
+                       for f in os.listdir(path))
+            entries.append((mtime, size, path))
+
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+"""
+Suggestion of point correspondences by detecting and matching local features
+(ORB, AKAZE, or SIFT) between two images.
+
+Features are detected on a pyramid level of each image that is small enough
+to match quickly, one tile at a time, so memory use is bounded by the tile
+size however large the images are. Tiles can be processed in a pool of worker
+processes.
+
+"""
+from __future__ import division, print_function
+import collections
+import multiprocessing
+import cv2
+import numpy as np
+
+# TODO: cleaner solution for relative import handling.
+try:
+  from core import (apply_window, fit_homography_robust, ImagePyramid,
+                    TRANSFORM_MIN_POINTS)
+except ImportError:
+  from .core import (apply_window, fit_homography_robust, ImagePyramid,
+                     TRANSFORM_MIN_POINTS)
+
+FEATURE_TYPES = ('orb', 'akaze', 'sift')
+
+
+def create_detector(feature_type, max_features=5000):
+    """Return an OpenCV feature detector and descriptor extractor.
+
+    :param feature_type: One of FEATURE_TYPES.
+    :type feature_type: str
+
+    :param max_features: Maximum number of features that ORB and SIFT detect.
+    :type max_features: int
+
+    :raises ValueError: If the type is unknown or not available in the
+        installed OpenCV.
+
+    """
+    if feature_type not in FEATURE_TYPES:
+        raise ValueError('Invalid feature type: {}'.format(feature_type))
+
+    if feature_type == 'orb':
+        return cv2.ORB_create(max_features)
+
+    # SIFT moved from the contrib modules into OpenCV 4.4, and AKAZE moved
+    # into them in OpenCV 5.
+    name = feature_type.upper() + '_create'
+    create = getattr(cv2, name, None)
+    if create is None:
+        create = getattr(getattr(cv2, 'xfeatures2d', None), name, None)
+
+    if create is None:
+        raise ValueError('%s is not available in this version of OpenCV '
+                         '(try installing opencv-contrib-python).'
+                         % feature_type.upper())
+
+    if feature_type == 'sift':
+        return create(max_features)
+
+    return create()
+
+
+def descriptor_norm(feature_type):
+    """Return the OpenCV norm that descriptors of 'feature_type' are compared
+    with.
+
+    """
+    if feature_type == 'sift':
+        return cv2.NORM_L2
+
+    return cv2.NORM_HAMMING
+
+
+def to_gray_8bit(image, window=None):
+    """Convert an image to the 8-bit grayscale image that features are detected
+    in.
+
+    :param window: Image values mapped to black and white (see
+        core.apply_window), or None to map the range of values of 'image'.
+        8-bit images are used as is if None.
+    :type window: (float, float) | None
+
+    """
+    if window is None and image.dtype != np.uint8:
+        finite = image[np.isfinite(image)]
+        if len(finite) == 0:
+            window = (0, 1)
+        else:
+            window = (float(finite.min()), float(finite.max()))
+
+    if window is not None:
+        image = apply_window(image, window)
+
+    if image.ndim == 3:
+        if image.shape[2] == 1:
+            image = image[:,:,0]
+        else:
+            image = cv2.cvtColor(image[:,:,:3], cv2.COLOR_RGB2GRAY)
+
+    return np.ascontiguousarray(image)
+
+
+def _detect_tile(task):
+    """Detect the features of one tile (see detect_features).
+
+    Defined at module level so that it can be run in worker processes.
+
+    :param task: The tile, the (x, y) coordinates of its upper left corner,
+        the bounding box (x0, y0, x1, y1) in tile coordinates of the features
+        kept from it, the feature type, the maximum number of features, and
+        the window passed to to_gray_8bit.
+    :type task: tuple
+
+    :return: Coordinates, responses, and descriptors of the features.
+    :rtype: (Nx2 numpy.ndarray, N-array, numpy.ndarray | None)
+
+    """
+    tile, offset, rect, feature_type, max_features, window = task
+    detector = create_detector(feature_type, max_features)
+    keypoints, descriptors = detector.detectAndCompute(to_gray_8bit(tile,
+                                                                    window),
+                                                       None)
+    if descriptors is None or len(keypoints) == 0:
+        return np.zeros((0,2)), np.zeros(0), None
+
+    pts = np.array([kp.pt for kp in keypoints], dtype=np.float64)
+    responses = np.array([kp.response for kp in keypoints])
+
+    # Features in the margin belong to the neighboring tile.
+    x0, y0, x1, y1 = rect
+    keep = ((pts[:,0] >= x0) & (pts[:,0] < x1) &
+            (pts[:,1] >= y0) & (pts[:,1] < y1))
+    keep = np.flatnonzero(keep)
+    if len(keep) > max_features:
+        keep = keep[np.argsort(-responses[keep])[:max_features]]
+
+    return pts[keep] + offset, responses[keep], descriptors[keep]
+
+
+def _init_worker():
+    # Each worker process handles one tile at a time.
+    cv2.setNumThreads(1)
+
+
+def create_pool(processes=None):
+    """Return a pool of worker processes to detect features in.
+
+    Processes are spawned rather than forked where possible, since forking a
+    process whose GUI and OpenCV threads are running is not safe.
+
+    :param processes: Number of processes, or None for the number of CPUs.
+    :type processes: int | None
+
+    :rtype: multiprocessing.pool.Pool
+
+    """
+    get_context = getattr(multiprocessing, 'get_context', None)
+    if get_context is None:
+        context = multiprocessing
+    else:
+        context = get_context('spawn')
+
+    return context.Pool(processes, initializer=_init_worker)
+
+
+def _map_bounded(func, tasks, pool=None, max_pending=None):
+    """Yield func(task) for each of 'tasks' in order, with at most
+    'max_pending' tasks submitted to 'pool' at once, so that tasks are only
+    created (e.g., tiles read) as fast as the pool handles them.
+
+    """
+    if pool is None:
+        for task in tasks:
+            yield func(task)
+
+        return
+
+    if max_pending is None:
+        max_pending = 2*getattr(pool, '_processes', 1)
+
+    pending = collections.deque()
+    for task in tasks:
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+
+        pending.append(pool.apply_async(func, (task,)))
+
+    while pending:
+        yield pending.popleft().get()
+
+
+def detect_features(image, feature_type='orb', tile_size=2048, margin=32,
+                    max_features=5000, window=None, pool=None):
+    """Detect features in an image one tile at a time.
+
+    Each tile is read with a margin around it, so that features near its edges
+    are detected as in the whole image, but only features within the tile
+    itself are kept.
+
+    :param image: Image to detect features in.
+    :type image: numpy.ndarray | ImageSource
+
+    :param feature_type: One of FEATURE_TYPES.
+    :type feature_type: str
+
+    :param tile_size: Width and height of the tiles in pixels.
+    :type tile_size: int
+
+    :param margin: Width in pixels of the margin read around each tile.
+    :type margin: int
+
+    :param max_features: Maximum number of features kept, those with the
+        strongest response, which bounds the time to match them.
+    :type max_features: int
+
+    :param window: Image values mapped to black and white before detection
+        (see to_gray_8bit).
+    :type window: (float, float) | None
+
+    :param pool: Worker processes to detect the features of the tiles in, or
+        None to detect them in this process.
+    :type pool: multiprocessing.pool.Pool | None
+
+    :return: Coordinates of the features in 'image' and their descriptors.
+    :rtype: (Nx2 numpy.ndarray, numpy.ndarray | None)
+
+    """
+    # Raise errors, e.g., an unavailable feature type, before reading tiles.
+    create_detector(feature_type, max_features)
+    height, width = image.shape[:2]
+
+    def tasks():
+        for y0 in range(0, height, tile_size):
+            for x0 in range(0, width, tile_size):
+                x1 = min(x0 + tile_size, width)
+                y1 = min(y0 + tile_size, height)
+                tx0 = max(x0 - margin, 0)
+                ty0 = max(y0 - margin, 0)
+                tile = np.asarray(image[ty0:min(y1 + margin, height),
+                                        tx0:min(x1 + margin, width)])
+                yield (tile, (tx0, ty0), (x0 - tx0, y0 - ty0, x1 - tx0,
+                                          y1 - ty0),
+                       feature_type, max_features, window)
+
+    pts = []
+    responses = []
+    descriptors = []
+    for tile_pts, tile_responses, tile_descriptors in \
+        _map_bounded(_detect_tile, tasks(), pool):
+        if tile_descriptors is not None:
+            pts.append(tile_pts)
+            responses.append(tile_responses)
+            descriptors.append(tile_descriptors)
+
+    if len(pts) == 0:
+        return np.zeros((0,2)), None
+
+    pts = np.vstack(pts)
+    descriptors = np.vstack(descriptors)
+    if len(pts) > max_features:
+        keep = np.argsort(-np.hstack(responses),
+                          kind='mergesort')[:max_features]
+        pts = pts[keep]
+        descriptors = descriptors[keep]
+
+    return pts, descriptors
+
+
+def match_descriptors(descriptors1, descriptors2, norm, ratio=0.8,
+                      cross_check=True):
+    """Match descriptors by nearest neighbor.
+
+    :param norm: OpenCV norm that descriptors are compared with (see
+        descriptor_norm).
+    :type norm: int
+
+    :param ratio: A match is kept only if its distance is less than 'ratio'
+        times the distance of the second nearest neighbor (Lowe's ratio test).
+    :type ratio: float
+
+    :param cross_check: A match is kept only if the first descriptor is also
+        the nearest neighbor of the second.
+    :type cross_check: bool
+
+    :return: Indices of the matched descriptors in 'descriptors1' and
+        'descriptors2', and the distances of the matches, best first.
+    :rtype: (N-array of int, N-array of int, N-array of float)
+
+    """
+    if (descriptors1 is None or descriptors2 is None or
+        len(descriptors1) == 0 or len(descriptors2) < 2):
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                np.zeros(0))
+
+    matcher = cv2.BFMatcher(norm)
+    matches = [m for m in matcher.knnMatch(descriptors1, descriptors2, k=2)
+               if len(m) == 2 and m[0].distance < ratio*m[1].distance]
+    ind1 = np.array([m[0].queryIdx for m in matches], dtype=np.int64)
+    ind2 = np.array([m[0].trainIdx for m in matches], dtype=np.int64)
+    distances = np.array([m[0].distance for m in matches])
+
+    if cross_check and len(matches) > 0:
+        backward = np.full(len(descriptors2), -1, dtype=np.int64)
+        for m in matcher.match(descriptors2, descriptors1):
+            backward[m.queryIdx] = m.trainIdx
+
+        keep = backward[ind2] == ind1
+        ind1, ind2, distances = ind1[keep], ind2[keep], distances[keep]
+
+    order = np.argsort(distances, kind='mergesort')
+    return ind1[order], ind2[order], distances[order]
+
+
+def detection_level(pyramid, max_size):
+    """Return the finest level of a pyramid whose larger dimension is at most
+    'max_size'.
+
+    :type pyramid: ImagePyramid
+
+    :type max_size: int
+
+    """
+    size = max(pyramid.shape[:2])
+    level = int(np.ceil(np.log2(max(size/max_size, 1))))
+    return int(np.clip(level, pyramid.base_level, pyramid.num_levels - 1))
+
+
+def suggest_matches(image1, image2, feature_type='orb', ratio=0.8,
+                    cross_check=True, ransac_threshold=None,
+                    homography_type=4, max_size=4096, tile_size=2048,
+                    max_features=5000, windows=(None, None), pool=None):
+    """Suggest point correspondences between two images.
+
+    Features are detected on the finest pyramid level of each image that is at
+    most 'max_size' pixels wide and high, matched with a ratio test and
+    optionally a cross-check, and optionally filtered to those consistent with
+    a homography fitted with RANSAC.
+
+    :param image1: Left image or its pyramid.
+    :type image1: ImagePyramid | numpy.ndarray | ImageSource
+
+    :param image2: Right image or its pyramid.
+    :type image2: ImagePyramid | numpy.ndarray | ImageSource
+
+    :param feature_type: One of FEATURE_TYPES.
+    :type feature_type: str
+
+    :param ratio: Ratio test threshold (see match_descriptors).
+    :type ratio: float
+
+    :param cross_check: Keep only mutual nearest neighbors.
+    :type cross_check: bool
+
+    :param ransac_threshold: If not None, only matches whose right point is
+        within this many pixels of the detection level of the right image from
+        the warped left point are kept, under a homography fitted to the
+        matches with RANSAC.
+    :type ransac_threshold: float | None
+
+    :param homography_type: Type of homography fitted with RANSAC (see
+        core.fit_homography).
+    :type homography_type: int
+
+    :param max_size: Largest dimension of the pyramid levels that features
+        are detected in.
+    :type max_size: int
+
+    :param tile_size: See detect_features.
+    :type tile_size: int
+
+    :param max_features: Maximum number of features per image (see
+        detect_features).
+    :type max_features: int
+
+    :param windows: Image values of each image mapped to black and white
+        before detection (see to_gray_8bit).
+    :type windows: 2-tuple
+
+    :param pool: Worker processes to detect features in (see create_pool).
+    :type pool: multiprocessing.pool.Pool | None
+
+    :return: Suggested pairs (x1, y1, x2, y2) in full-resolution image
+        coordinates, those with the most similar descriptors first.
+    :rtype: Nx4 numpy.ndarray
+
+    :raises ValueError: If the feature type is not available.
+
+    """
+    pts = []
+    descriptors = []
+    scales = []
+    for image, window in zip([image1, image2], windows):
+        if not isinstance(image, ImagePyramid):
+            image = ImagePyramid(image)
+
+        level = detection_level(image, max_size)
+        level_pts, level_descriptors = detect_features(image.get_level(level),
+                                                       feature_type,
+                                                       tile_size,
+                                                       max_features=
+                                                       max_features,
+                                                       window=window,
+                                                       pool=pool)
+
+        # See ImagePyramid for the coordinates of the levels.
+        pts.append(2**level*level_pts)
+        descriptors.append(level_descriptors)
+        scales.append(2**level)
+
+    ind1, ind2, _ = match_descriptors(descriptors[0], descriptors[1],
+                                      descriptor_norm(feature_type), ratio,
+                                      cross_check)
+    matches = np.hstack([pts[0][ind1], pts[1][ind2]])
+    if ransac_threshold is None or len(matches) == 0:
+        return matches
+
+    if len(matches) < TRANSFORM_MIN_POINTS[homography_type]:
+        return np.zeros((0,4))
+
+    try:
+        inliers = fit_homography_robust(matches[:,:2], matches[:,2:],
+                                        homography_type, 'ransac',
+                                        ransac_threshold*scales[1])[1]
+    except ValueError:
+        return np.zeros((0,4))
+
+    return matches[inliers]
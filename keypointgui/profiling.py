@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""
+Timing of the processing stages of the GUI (e.g., rendering a view, copying
+it into a bitmap, painting a panel), used to show recent frame times and to
+record a trace that can be opened in Chrome's about:tracing or Perfetto.
+
+"""
+from __future__ import division, print_function
+import collections
+import contextlib
+import functools
+import json
+import os
+import threading
+import timeit
+
+
+class StageTimer(object):
+    """Collects the durations of named stages.
+
+    Stages are identified by a category (e.g., the name of the panel) and a
+    name (e.g., 'render'). The most recent durations of each stage are kept
+    to report recent averages. While tracing, every stage is also recorded as
+    a Chrome trace event. Stages may be timed on any thread.
+
+    """
+    def __init__(self, window=32, max_events=2**20):
+        """
+        :param window: Number of recent durations and hits kept per stage.
+        :type window: int
+
+        :param max_events: Number of trace events after which recording stops
+            (the events are kept until the trace is stopped), which bounds the
+            memory used when tracing is left on.
+        :type max_events: int
+
+        """
+        self.window = window
+        self.max_events = max_events
+        self._lock = threading.Lock()
+        self._durations = {}
+        self._hits = {}
+        self._tracing = False
+        self._events = []
+        self._thread_names = {}
+        self._async_ids = 0
+        self._t0 = timeit.default_timer()
+
+    @staticmethod
+    def now():
+        """Return the current time in seconds, as used for 'start' arguments.
+
+        """
+        return timeit.default_timer()
+
+    @property
+    def tracing(self):
+        return self._tracing
+
+    def start_trace(self):
+        """Start recording trace events, discarding any recorded before.
+
+        """
+        with self._lock:
+            self._tracing = True
+            self._events = []
+            self._thread_names = {}
+
+    def stop_trace(self):
+        """Stop recording trace events.
+
+        :return: The recorded events.
+        :rtype: list of dict
+
+        """
+        with self._lock:
+            self._tracing = False
+            events = self._events
+            self._events = []
+            thread_names = self._thread_names
+
+        pid = os.getpid()
+        metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                     'args': {'name': name}}
+                    for tid, name in thread_names.items()]
+        return metadata + events
+
+    def write_trace(self, file_path):
+        """Stop recording trace events and write them to a file in the Chrome
+        trace event format.
+
+        :return: Number of events written.
+        :rtype: int
+
+        """
+        events = self.stop_trace()
+        with open(file_path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+        return len(events)
+
+    @contextlib.contextmanager
+    def stage(self, name, category='', **args):
+        """Context manager that times the enclosed code as one stage.
+
+        Keyword arguments are stored with the trace event.
+
+        """
+        start = timeit.default_timer()
+        try:
+            yield
+        finally:
+            self.record(name, category, start,
+                        timeit.default_timer() - start, args)
+
+    def record(self, name, category, start, duration, args=None,
+               span=False):
+        """Record a stage that was timed by the caller.
+
+        :param start: Start time (see 'now').
+        :type start: float
+
+        :param duration: Duration in seconds.
+        :type duration: float
+
+        :param span: The stage may overlap other stages on the same thread
+            (e.g., a frame spanning several events), so it is traced as an
+            asynchronous event.
+        :type span: bool
+
+        """
+        key = (category, name)
+        with self._lock:
+            durations = self._durations.get(key)
+            if durations is None:
+                durations = collections.deque(maxlen=self.window)
+                self._durations[key] = durations
+
+            durations.append(duration)
+            if not self._tracing:
+                return
+
+            thread = threading.current_thread()
+            self._thread_names[thread.ident] = thread.name
+            event = {'name': name, 'cat': category, 'pid': os.getpid(),
+                     'tid': thread.ident,
+                     'ts': (start - self._t0)*1e6}
+            if args:
+                event['args'] = args
+
+            if span:
+                self._async_ids += 1
+                event['id'] = self._async_ids
+                end = dict(event, ph='e', ts=event['ts'] + duration*1e6)
+                event['ph'] = 'b'
+                self._events.extend([event, end])
+            else:
+                event['ph'] = 'X'
+                event['dur'] = duration*1e6
+                self._events.append(event)
+
+            if len(self._events) >= self.max_events:
+                self._tracing = False
+
+    def count(self, name, hit, category=''):
+        """Record whether a lookup (e.g., of a cache) was successful.
+
+        """
+        key = (category, name)
+        with self._lock:
+            hits = self._hits.get(key)
+            if hits is None:
+                hits = collections.deque(maxlen=self.window)
+                self._hits[key] = hits
+
+            hits.append(bool(hit))
+
+    def mean(self, name, category=''):
+        """Return the mean of the recent durations of a stage in seconds, or
+        None if it has not been timed.
+
+        """
+        with self._lock:
+            durations = self._durations.get((category, name))
+            if not durations:
+                return None
+
+            return sum(durations)/len(durations)
+
+    def hit_rate(self, name, category=''):
+        """Return the fraction of recent lookups that were successful, or None
+        if there were none.
+
+        """
+        with self._lock:
+            hits = self._hits.get((category, name))
+            if not hits:
+                return None
+
+            return sum(hits)/len(hits)
+
+
+def timed(name=None):
+    """Decorator that times each call of a method as a stage.
+
+    The method's object must have a 'stage_timer' attribute (a StageTimer or
+    None to not time the call), and its 'stage_category' attribute, if any,
+    is used as the category.
+
+    :param name: Name of the stage. Defaults to the name of the method.
+    :type name: str | None
+
+    """
+    def decorator(func):
+        stage_name = func.__name__ if name is None else name
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            timer = self.stage_timer
+            if timer is None:
+                return func(self, *args, **kwargs)
+
+            category = getattr(self, 'stage_category', type(self).__name__)
+            with timer.stage(stage_name, category):
+                return func(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
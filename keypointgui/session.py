@@ -0,0 +1,560 @@
+#!/usr/bin/env python
+"""
+Recording and replay of interaction sessions, used to compare the latency of
+rendering changes on identical, real-world sequences of input.
+
+MainFrame records the semantic input events of a session (e.g., loading an
+image, clicking a raw-image position, zooming, moving a contrast slider,
+aligning the images) as lines of JSON, one event per line, each with the time
+'t' in seconds since recording started. A session is replayed either through
+the event handlers of a MainFrame (see keypointgui.gui.replay_session) or,
+without a display, by HeadlessSession, which applies the events to
+keypointgui.core views. Replays report percentiles of the time taken to
+handle each kind of event.
+
+To record a session, set the environment variable KEYPOINTGUI_RECORD to the
+file to write before starting the GUI. To replay one:
+
+    $ python -m keypointgui.session session.jsonl
+    $ python -m keypointgui.session session.jsonl --gui
+
+"""
+from __future__ import division, print_function
+import argparse
+import json
+import os
+import sys
+import timeit
+import numpy as np
+
+# TODO: cleaner solution for relative import handling.
+try:
+  from image_source import open_image_source, LRUCache
+  from matching import suggest_matches
+  from core import (read_image, ImageHistogram, ImagePyramid, PointSelection,
+                    NavigationViewport, ZoomViewport, align_views,
+                    contrast_pyramid, image_keys)
+except ImportError:
+  from .image_source import open_image_source, LRUCache
+  from .matching import suggest_matches
+  from .core import (read_image, ImageHistogram, ImagePyramid,
+                     PointSelection, NavigationViewport, ZoomViewport,
+                     align_views, contrast_pyramid, image_keys)
+
+SESSION_VERSION = 1
+
+# Names of the four panels of MainFrame, as used in the 'start' event.
+PANEL_NAMES = ('left navigation', 'right navigation', 'left zoom',
+               'right zoom')
+
+
+def _to_json(obj):
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+
+    raise TypeError('Cannot record %r' % (obj,))
+
+
+class SessionRecorder(object):
+    """Writes a stream of input events to a file as lines of JSON.
+
+    """
+    def __init__(self, file_path):
+        """
+        :param file_path: File to write, which is overwritten.
+        :type file_path: str
+
+        """
+        self.file_path = file_path
+        self._file = open(file_path, 'w')
+        self._t0 = timeit.default_timer()
+
+    def record(self, event, **fields):
+        """Write one event.
+
+        :param event: Kind of the event, e.g., 'click'.
+        :type event: str
+
+        """
+        fields['event'] = event
+        fields['t'] = round(timeit.default_timer() - self._t0, 6)
+        self._file.write(json.dumps(fields, default=_to_json,
+                                    sort_keys=True))
+        self._file.write('\n')
+
+        # Keep the file complete if the application crashes.
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def read_session(file_path):
+    """Read the events of a recorded session.
+
+    :rtype: list of dict
+
+    """
+    events = []
+    with open(file_path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                events.append(json.loads(line))
+
+    return events
+
+
+def latency_percentiles(latencies, percentiles=(50, 90, 99)):
+    """Summarize the latencies of a replay by kind of event.
+
+    :param latencies: Kind of each replayed event and the time in seconds that
+        it took to handle it, or None if it timed out.
+    :type latencies: list of (str, float | None)
+
+    :return: For each kind of event and for all events ('all'), the number of
+        events ('count'), timeouts ('timeouts'), and the percentiles and
+        maximum of the latencies in milliseconds (e.g., 'p50', 'max').
+    :rtype: dict
+
+    """
+    kinds = {}
+    for name, latency in latencies:
+        kinds.setdefault(name, []).append(latency)
+        kinds.setdefault('all', []).append(latency)
+
+    summary = {}
+    for name, values in kinds.items():
+        times = np.array([v for v in values if v is not None])*1000
+        stats = {'count': len(values),
+                 'timeouts': len(values) - len(times)}
+        if len(times) > 0:
+            for p in percentiles:
+                stats['p%g' % p] = float(np.percentile(times, p))
+
+            stats['max'] = float(times.max())
+
+        summary[name] = stats
+
+    return summary
+
+
+def format_latencies(summary, percentiles=(50, 90, 99)):
+    """Return the output of 'latency_percentiles' as a text table.
+
+    """
+    columns = ['p%g' % p for p in percentiles] + ['max']
+    width = max([16] + [len(name) for name in summary])
+    lines = ['%-*s %6s' % (width, 'event', 'count') +
+             ''.join('%10s' % ('%s ms' % c) for c in columns)]
+    names = sorted(n for n in summary if n != 'all')
+    if 'all' in summary:
+        names.append('all')
+
+    for name in names:
+        stats = summary[name]
+        line = '%-*s %6i' % (width, name, stats['count'])
+        line += ''.join('%10.1f' % stats[c] if c in stats else '%10s' % '-'
+                        for c in columns)
+        if stats['timeouts']:
+            line += '  (%i timed out)' % stats['timeouts']
+
+        lines.append(line)
+
+    return '\n'.join(lines)
+
+
+def write_results(file_path, latencies, summary):
+    """Write the latencies of a replay and their summary as JSON.
+
+    """
+    with open(file_path, 'w') as f:
+        json.dump({'latencies': latencies, 'summary': summary}, f, indent=2,
+                  sort_keys=True)
+
+
+class HeadlessSession(object):
+    """Replays recorded events on views rendered without a display.
+
+    The events are applied to a navigation and a zoom view of each image
+    through the same code as MainFrame's handlers use for its panels (e.g.,
+    PointSelection for clicks, align_views, and contrast_pyramid), and every
+    view whose contents changed is rendered. Rendered views are not cached,
+    but views whose contents did not change are not rendered again. Work that
+    MainFrame does in the background (e.g., adjusting the contrast, detecting
+    the features of suggested matches) is done in this thread, and images are
+    loaded without a preview.
+
+    Attributes:
+    :param navigation_views: Left and right navigation views.
+    :type navigation_views: list of NavigationViewport
+
+    :param zoom_views: Left and right zoom views.
+    :type zoom_views: list of ZoomViewport
+
+    :param selection: Selected point correspondences and suggested pairs.
+    :type selection: PointSelection
+
+    :param correspondences: Selected point correspondences.
+    :type correspondences: CorrespondenceStore
+
+    :param contrast_cache: Pyramids of contrast-adjusted images by slider
+        value, as in MainFrame.
+    :type contrast_cache: LRUCache
+
+    """
+    def __init__(self, panel_sizes=None, zoom=400, interpolation=1,
+                 contrast_cache_bytes=512*2**20):
+        """
+        :param panel_sizes: Size (width, height) of each panel by name (see
+            PANEL_NAMES). Panels default to 400 by 300, and the 'start' event
+            of a recorded session sets the recorded sizes.
+        :type panel_sizes: dict | None
+
+        :param zoom: Initial zoom of the zoom views.
+        :type zoom: float
+
+        :param interpolation: Interpolation (see Viewport.set_interpolation).
+        :type interpolation: int
+
+        :param contrast_cache_bytes: Memory budget for the cache of
+            contrast-adjusted images.
+        :type contrast_cache_bytes: int
+
+        """
+        self.navigation_views = [NavigationViewport(size=(400, 300)),
+                                 NavigationViewport(size=(400, 300))]
+        self.zoom_views = [ZoomViewport(size=(400, 300), zoom=zoom),
+                           ZoomViewport(size=(400, 300), zoom=zoom)]
+        self.selection = PointSelection()
+        self.correspondences = self.selection.correspondences
+        self.contrast_cache = LRUCache(contrast_cache_bytes)
+        self._images0 = [None, None]
+        self._pyramids0 = [None, None]
+        self._keys = [None, None]
+        self._contrast_keys = [None, None]
+        self._histograms = [None, None]
+        self._rendered = {}
+        self.auto_stretch_percentiles = (0.5, 99.5)
+        if panel_sizes is not None:
+            self.on_start(panels=panel_sizes)
+
+        self.on_interpolation(interpolation)
+
+    @property
+    def views(self):
+        return self.navigation_views + self.zoom_views
+
+    def side_views(self, side):
+        return [self.navigation_views[side], self.zoom_views[side]]
+
+    @property
+    def candidates(self):
+        """Suggested pairs (x1, y1, x2, y2) that were neither accepted nor
+        rejected.
+
+        """
+        return self.selection.candidates
+
+    def apply(self, event):
+        """Apply one recorded event and render the views that changed.
+
+        :param event: Recorded event.
+        :type event: dict
+
+        :return: False if the kind of event is not supported.
+        :rtype: bool
+
+        """
+        fields = dict(event)
+        handler = getattr(self, 'on_' + fields.pop('event'), None)
+        if handler is None:
+            return False
+
+        fields.pop('t', None)
+        handler(**fields)
+        self.render()
+        return True
+
+    def render(self):
+        """Render every view whose contents changed since it was last
+        rendered, and transform the points of its image into it.
+
+        """
+        # As the panels do to colour the markers.
+        self.correspondences.residuals.classify()
+        for side in (0, 1):
+            points = self.correspondences.side_points(side)
+            for view in self.side_views(side):
+                if view.raw_image is None:
+                    continue
+
+                key = view.render_key()
+                if self._rendered.get(id(view)) != key:
+                    view.render_view()
+                    self._rendered[id(view)] = key
+
+                view.marker_positions(points)
+                view.marker_positions(self.candidates[:,2*side:2*side+2])
+
+    def on_start(self, panels=None, zoom=None, interpolation=None,
+                 **kwargs):
+        """Apply the initial state of a recorded session.
+
+        """
+        if panels is not None:
+            for name, view in zip(PANEL_NAMES, self.views):
+                if name in panels:
+                    view.set_size(panels[name])
+
+        if zoom is not None:
+            for view, z in zip(self.zoom_views, zoom):
+                view.set_zoom(z)
+
+        if interpolation is not None:
+            self.on_interpolation(interpolation)
+
+    def on_load_image(self, side, path):
+        image = open_image_source(path)
+        if image is None:
+            image = read_image(path)
+
+        if image is None:
+            return
+
+        pyramid = ImagePyramid(image)
+        self._images0[side] = image
+        self._pyramids0[side] = pyramid
+        self._keys[side] = key = next(image_keys)
+        self._contrast_keys[side] = (key, 0)
+        level = pyramid.in_memory_level()
+        self._histograms[side] = ImageHistogram(pyramid.get_level(level))
+        window = self.default_window(side)
+        for view in self.side_views(side):
+            view.display_window = window
+            view.set_image(image, (key, 0), pyramid)
+
+        self.on_clear_all()
+        self.on_align('original')
+
+    def default_window(self, side):
+        histogram = self._histograms[side]
+        if histogram is None or histogram.dtype == np.uint8:
+            return None
+
+        return histogram.lower, histogram.upper
+
+    def on_click(self, side, pos, button, sync=False):
+        pos = np.asarray(pos, dtype=np.float64)
+        view = self.zoom_views[side]
+        if button == 1:
+            view.set_center(pos)
+            if sync:
+                homographies = [v.align_homography
+                                for v in self.navigation_views]
+                pos2 = self.selection.synced_center(side, pos, homographies)
+                if pos2 is not None:
+                    self.zoom_views[1 - side].set_center(pos2)
+
+            return
+
+        max_distance = self.selection.pick_distance(view.homography, pos)
+        if button == 2:
+            self.selection.remove_point(side, pos, max_distance)
+        else:
+            self.selection.add_point(side, pos, max_distance)
+
+    def on_zoom(self, side, zoom):
+        self.zoom_views[side].set_zoom(zoom)
+
+    def on_contrast(self, side, value):
+        image0 = self._images0[side]
+        if (image0 is None or not isinstance(image0, np.ndarray) or
+            image0.dtype != np.uint8):
+            return
+
+        c = 10*value/1000.0
+        image_key = (self._keys[side], c)
+        if image_key == self._contrast_keys[side]:
+            return
+
+        self._contrast_keys[side] = image_key
+        if c > 0:
+            pyramid = self.contrast_cache.get(image_key)
+        else:
+            pyramid = self._pyramids0[side]
+
+        if pyramid is None:
+            nav_view = self.navigation_views[side]
+
+            def show_preview(preview):
+                nav_view.set_image(nav_view.raw_image,
+                                   image_key + ('preview',), preview)
+                self.render()
+
+            pyramid = contrast_pyramid(self._pyramids0[side], c,
+                                       nav_view.get_view_level(),
+                                       show_preview)
+
+            # Scale the budget to include the coarser pyramid levels.
+            num_bytes = pyramid.get_level(0).nbytes*4//3
+            self.contrast_cache.put(image_key, pyramid, num_bytes)
+
+        image = pyramid.get_level(0)
+        for view in self.side_views(side):
+            view.set_image(image, image_key, pyramid)
+
+    def on_interpolation(self, value):
+        for view in self.views:
+            view.set_interpolation(value)
+
+    def on_align(self, direction, transform=4, method=None, threshold=3.0):
+        side_views = [self.side_views(0), self.side_views(1)]
+        if direction == 'original':
+            self.selection.set_fit(None)
+            for view in align_views(side_views):
+                view.update()
+
+            return
+
+        side = 0 if direction == 'left_to_right' else 1
+        try:
+            H = self.selection.fit(side, transform, method, threshold)[0]
+        except ValueError:
+            return
+
+        self.selection.set_fit(H, side, threshold)
+        for view in align_views(side_views, H, side):
+            view.update()
+
+    def on_display_window(self, side, window):
+        for view in self.side_views(side):
+            view.display_window = None if window is None else tuple(window)
+
+    def on_auto_stretch(self):
+        for side in (0, 1):
+            histogram = self._histograms[side]
+            if histogram is not None:
+                window = histogram.window(*self.auto_stretch_percentiles)
+                self.on_display_window(side, window)
+
+    def on_full_range(self):
+        for side in (0, 1):
+            self.on_display_window(side, self.default_window(side))
+
+    def on_clear_last(self):
+        self.selection.clear_last()
+
+    def on_clear_all(self):
+        self.selection.clear()
+
+    def on_suggest_matches(self, feature_type='orb', ratio=0.8,
+                           cross_check=True, ransac=True, threshold=3.0,
+                           transform=4):
+        if any(pyramid is None for pyramid in self._pyramids0):
+            return
+
+        windows = [self.navigation_views[side].display_window
+                   for side in (0, 1)]
+        try:
+            candidates = suggest_matches(self._pyramids0[0],
+                                         self._pyramids0[1], feature_type,
+                                         ratio, cross_check,
+                                         threshold if ransac else None,
+                                         transform, windows=windows)
+        except ValueError:
+            return
+
+        self.selection.set_candidates(candidates)
+
+    def on_accept_suggestions(self):
+        self.selection.accept_candidates()
+
+    def on_reject_suggestions(self):
+        self.selection.reject_candidates()
+
+    def on_load_points(self, path):
+        self.selection.load_points(np.loadtxt(path))
+
+
+def replay_headless(events, session=None):
+    """Replay recorded events on a HeadlessSession as fast as possible.
+
+    :param session: Session to apply the events to. If None, a new one is
+        created.
+    :type session: HeadlessSession | None
+
+    :return: Kind of each supported event and the time in seconds taken to
+        apply it and render the views.
+    :rtype: list of (str, float)
+
+    """
+    if session is None:
+        session = HeadlessSession()
+
+    latencies = []
+    for event in events:
+        if event['event'] == 'start':
+            # The initial state, which is not an input event.
+            session.apply(event)
+            continue
+
+        t0 = timeit.default_timer()
+        if session.apply(event):
+            latencies.append((event['event'],
+                              timeit.default_timer() - t0))
+
+    return latencies
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay a recorded '
+                                     'session and report the latency of '
+                                     'each kind of event.')
+    parser.add_argument('session', help='Recorded session (JSON lines).')
+    parser.add_argument('--gui', action='store_true',
+                        help='Replay through the handlers of the GUI instead '
+                        'of on views rendered without a display.')
+    parser.add_argument('--realtime', action='store_true',
+                        help='With --gui, keep the recorded time between '
+                        'events instead of replaying as fast as possible.')
+    parser.add_argument('--left', help='Image to load into the left side '
+                        'before replaying, e.g., if the session was recorded '
+                        'with images passed to the GUI directly.')
+    parser.add_argument('--right', help='Image to load into the right side.')
+    parser.add_argument('-o', '--output',
+                        help='Write the latencies as JSON to this file.')
+    args = parser.parse_args(argv)
+
+    events = read_session(args.session)
+    preload = [{'event': 'load_image', 'side': side, 't': 0,
+                'path': os.path.abspath(path)}
+               for side, path in enumerate([args.left, args.right])
+               if path is not None]
+
+    # The initial state must be applied before the images are loaded.
+    if events and events[0]['event'] == 'start':
+        events = events[:1] + preload + events[1:]
+    else:
+        events = preload + events
+
+    if args.gui:
+        try:
+          from gui import replay_session
+        except ImportError:
+          from .gui import replay_session
+
+        latencies = replay_session(events, args.realtime)
+    else:
+        latencies = replay_headless(events)
+
+    summary = latency_percentiles(latencies)
+    print(format_latencies(summary))
+    if args.output is not None:
+        write_results(args.output, latencies, summary)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
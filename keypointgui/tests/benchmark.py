@@ -0,0 +1,482 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the rendering, contrast, fitting, feature matching, point I/O,
+and marker drawing hot paths. They run without a display, on synthetic image
+pairs generated from 'image.jpg' the same way as demo.py, resized to several
+image sizes.
+
+Results are written as JSON, which can be passed to a later run with
+'--compare' to report benchmarks that became slower:
+
+    $ python -m keypointgui.tests.benchmark --output baseline.json
+    $ python -m keypointgui.tests.benchmark --compare baseline.json
+
+Each benchmark is timed by calling it repeatedly in several samples, after the
+setup (e.g., generating the images) is done. The reported times are per call.
+
+"""
+from __future__ import division, print_function
+import argparse
+import itertools
+import json
+import os
+import platform
+import re
+import shutil
+import sys
+import tempfile
+import timeit
+import numpy as np
+import cv2
+
+from keypointgui.core import (update_contrast, update_contrast_tiled,
+                              stretch_range_to_8bit, image_keys,
+                              CorrespondenceStore, NavigationViewport,
+                              ZoomViewport, fit_homography,
+                              fit_homography_robust, draw_circles,
+                              TRANSFORM_NAMES, ROBUST_METHODS)
+from keypointgui.matching import (detect_features, match_descriptors,
+                                  descriptor_norm)
+
+path = os.path.dirname(os.path.realpath(__file__))
+
+# Widths of the synthetic images, which have a 4:3 aspect ratio.
+SIZES = (1000, 4000)
+
+# Panel sizes (width, height) of the navigation and zoom views.
+NAVIGATION_PANEL_SIZE = (640, 480)
+ZOOM_PANEL_SIZE = (800, 600)
+
+BENCHMARKS = []
+
+
+def benchmark(**params):
+    """Register a benchmark that is run for every combination of 'params'.
+
+    The decorated function is called with one value of each parameter as
+    keyword arguments, does any setup, and returns a function without
+    arguments that is timed.
+
+    """
+    def decorator(setup):
+        BENCHMARKS.append((setup.__name__, setup, params))
+        return setup
+
+    return decorator
+
+
+_images = {}
+def synthetic_images(size):
+    """Return a synthetic pair of images and corresponding points.
+
+    As in demo.py, the right image is the left image warped by a rotation,
+    anisotropic scaling and translation, and converted to grayscale.
+
+    :param size: Width of the images.
+    :type size: int
+
+    :return: RGB left image, grayscale right image, and a function returning
+        'n' random pairs of corresponding points as an Nx4 array.
+    :rtype: (numpy.ndarray, numpy.ndarray, callable)
+
+    """
+    if size in _images:
+        return _images[size]
+
+    image = cv2.imread(''.join([path,'/image.jpg']))[:,:,::-1]
+    dsize = (size, int(round(size*3/4)))
+    image1 = cv2.resize(image, dsize, interpolation=cv2.INTER_AREA)
+
+    theta = 30.0/180*np.pi
+    h = np.array([[np.cos(theta),-np.sin(theta),0],
+                  [np.sin(theta),np.cos(theta),0],
+                  [0,0,1]])
+    h[0,0] *= 1.5
+    h[1,1] *= 2
+    h[0,2] -= 500
+    h[1,2] -= 1800
+
+    # Apply the transformation of demo.py in the coordinates of the original
+    # image.
+    s = np.diag([size/image.shape[1], size/image.shape[1], 1])
+    h = np.dot(s, np.dot(h, np.linalg.inv(s)))
+    image2 = cv2.warpPerspective(image1, h, dsize=dsize)
+    image2 = cv2.cvtColor(image2, cv2.COLOR_RGB2GRAY)
+
+    def random_points(n, seed=0):
+        random = np.random.RandomState(seed)
+        pts2 = random.rand(3, n)
+        pts2[0] *= image2.shape[1]
+        pts2[1] *= image2.shape[0]
+        pts2[2] = 1
+        pts1 = np.dot(np.linalg.inv(h), pts2)
+        pts1 = (pts1[:2]/pts1[2]).T
+        pts2 = (pts2[:2]/pts2[2]).T
+        return np.hstack([pts1, pts2])
+
+    _images[size] = image1, image2, random_points
+    return _images[size]
+
+
+def render_full(view):
+    """Return a function that renders the current view of 'view' from
+    scratch, as when the view is shown for the first time.
+
+    """
+    def run():
+        # A new key prevents reusing the previously rendered view.
+        view.render(view.get_request(key=(next(image_keys),)))
+
+    return run
+
+
+@benchmark(size=SIZES, image=('rgb', 'gray'),
+           interpolation=('nearest', 'linear'))
+def warp_navigation(size, image, interpolation):
+    image = synthetic_images(size)[0 if image == 'rgb' else 1]
+    view = NavigationViewport(image, NAVIGATION_PANEL_SIZE,
+                              interpolation=0 if interpolation == 'nearest'
+                              else 1)
+    return render_full(view)
+
+
+@benchmark(size=SIZES, image=('rgb', 'gray'), zoom=(50, 400))
+def warp_zoom(size, image, zoom):
+    image = synthetic_images(size)[0 if image == 'rgb' else 1]
+    view = ZoomViewport(image, ZOOM_PANEL_SIZE, zoom=zoom)
+    return render_full(view)
+
+
+@benchmark(size=SIZES, image=('rgb', 'gray'))
+def pan_zoom(size, image):
+    """Render views panned by whole pixels, as when dragging the zoom view.
+
+    """
+    image = synthetic_images(size)[0 if image == 'rgb' else 1]
+    view = ZoomViewport(image, ZOOM_PANEL_SIZE, zoom=400)
+    center = np.array(view.center, dtype=float)
+    view.render_view()
+    steps = itertools.cycle([(5, 3), (-5, -3)])
+
+    def run():
+        center[:] += np.array(next(steps))/4
+        view.set_center(center)
+        view.render_view()
+
+    return run
+
+
+@benchmark(size=SIZES, image=('rgb', 'gray'))
+def contrast(size, image):
+    image = synthetic_images(size)[0 if image == 'rgb' else 1]
+    return lambda: update_contrast(image, 2)
+
+
+@benchmark(size=SIZES, image=('rgb', 'gray'))
+def contrast_tiled(size, image):
+    image = synthetic_images(size)[0 if image == 'rgb' else 1]
+    return lambda: update_contrast_tiled(image, 2)
+
+
+@benchmark(size=SIZES)
+def stretch_range(size):
+    image = synthetic_images(size)[1].astype(np.uint16)*64 + 1000
+    return lambda: stretch_range_to_8bit(image)
+
+
+@benchmark(transform=TRANSFORM_NAMES, num_points=(20, 1000))
+def fit(transform, num_points):
+    points = synthetic_images(SIZES[0])[2](num_points)
+    pts1 = points[:,:2].copy()
+    pts2 = points[:,2:].copy()
+    homography_type = TRANSFORM_NAMES.index(transform)
+    return lambda: fit_homography(pts1, pts2, homography_type)
+
+
+@benchmark(transform=TRANSFORM_NAMES, method=ROBUST_METHODS,
+           num_points=(20, 1000))
+def fit_robust(transform, method, num_points):
+    points = synthetic_images(SIZES[0])[2](num_points)
+    pts1 = points[:,:2].copy()
+    homography_type = TRANSFORM_NAMES.index(transform)
+
+    # The inliers are consistent with a transform of the fitted type, and a
+    # quarter of the pairs are outliers.
+    h = fit_homography(pts1, points[:,2:], homography_type)
+    pts2 = cv2.perspectiveTransform(pts1.reshape(-1,1,2), h).reshape(-1,2)
+    rng = np.random.RandomState(0)
+    pts2[::4] += rng.uniform(-100, 100, pts2[::4].shape)
+    return lambda: fit_homography_robust(pts1, pts2, homography_type, method)
+
+
+@benchmark(num_points=(1000, 100000))
+def residuals(num_points):
+    points = synthetic_images(SIZES[0])[2](num_points)
+    correspondences = CorrespondenceStore(points)
+    h = fit_homography(points[:,:2], points[:,2:], 4)
+
+    def run():
+        # Setting the homography invalidates the errors of all rows.
+        correspondences.residuals.homography = h
+        correspondences.residuals.classify()
+
+    return run
+
+
+@benchmark(num_points=(1000, 100000))
+def residuals_append(num_points):
+    points = synthetic_images(SIZES[0])[2](num_points)
+    correspondences = CorrespondenceStore(points)
+    correspondences.residuals.homography = fit_homography(points[:,:2],
+                                                          points[:,2:], 4)
+    correspondences.residuals.classify()
+
+    def run():
+        i = correspondences.append(points[0,:2], points[0,2:])
+        correspondences.residuals.classify()
+        correspondences.delete(i)
+
+    return run
+
+
+@benchmark(size=SIZES, feature_type=('orb', 'sift'))
+def detect(size, feature_type):
+    image = synthetic_images(size)[1]
+    return lambda: detect_features(image, feature_type)
+
+
+@benchmark(feature_type=('orb', 'sift'))
+def match(feature_type):
+    image1, image2 = synthetic_images(SIZES[-1])[:2]
+    d1 = detect_features(image1, feature_type)[1]
+    d2 = detect_features(image2, feature_type)[1]
+    norm = descriptor_norm(feature_type)
+    return lambda: match_descriptors(d1, d2, norm)
+
+
+@benchmark(num_points=(100, 10000))
+def save_points(num_points):
+    points = synthetic_images(SIZES[0])[2](num_points)
+    fname = os.path.join(_tempdir(), 'points.txt')
+    return lambda: np.savetxt(fname, points)
+
+
+@benchmark(num_points=(100, 10000))
+def load_points(num_points):
+    points = synthetic_images(SIZES[0])[2](num_points)
+    fname = os.path.join(_tempdir(), 'points.txt')
+    np.savetxt(fname, points)
+
+    def run():
+        correspondences = CorrespondenceStore()
+        correspondences.extend(np.loadtxt(fname))
+
+    return run
+
+
+@benchmark(view=('navigation', 'zoom'), num_points=(10, 1000, 100000))
+def draw_markers(view, num_points):
+    """Select, transform, and draw the markers of one side as on_paint does
+    for a full repaint, drawing into an RGB array instead of a wx.DC.
+
+    """
+    image, _, random_points = synthetic_images(SIZES[0])
+    if view == 'navigation':
+        view = NavigationViewport(image, NAVIGATION_PANEL_SIZE)
+    else:
+        view = ZoomViewport(image, ZOOM_PANEL_SIZE, zoom=400)
+
+    correspondences = CorrespondenceStore(random_points(num_points))
+    radius, thickness = 5, 3
+    panel_width, panel_height = view.size
+    canvas = np.zeros((panel_height, panel_width, 3), dtype=np.uint8)
+
+    def run():
+        rect = view.get_view_rect(radius + thickness)
+        ind = correspondences.query_rect(0, rect)
+        states = correspondences.states[ind]
+        points = correspondences.side_points(0)[ind]
+        points = points[states == CorrespondenceStore.ACCEPTED]
+        pts = view.marker_positions(points, radius + thickness)[0]
+        draw_circles(canvas, pts, (255, 0, 0), radius, thickness)
+
+    return run
+
+
+_tempdirs = []
+def _tempdir():
+    if not _tempdirs:
+        _tempdirs.append(tempfile.mkdtemp(prefix='keypointgui_benchmark'))
+
+    return _tempdirs[0]
+
+
+def time_function(func, repeat=5, min_time=0.05):
+    """Time calls to 'func'.
+
+    The number of calls per sample is increased until one sample takes at
+    least 'min_time' seconds.
+
+    :return: Number of calls per sample and the time per call of each sample
+        in seconds.
+    :rtype: (int, list of float)
+
+    """
+    def sample(number):
+        t0 = timeit.default_timer()
+        for _ in range(number):
+            func()
+
+        return timeit.default_timer() - t0
+
+    number = 1
+    while True:
+        t = sample(number)
+        if t >= min_time:
+            break
+
+        number = max(number*2, int(np.ceil(number*min_time/max(t, 1e-9))))
+
+    times = [t/number]
+    for _ in range(repeat - 1):
+        times.append(sample(number)/number)
+
+    return number, times
+
+
+def benchmark_id(name, params):
+    """Return a string uniquely identifying a benchmark and its parameters,
+    e.g., 'warp_zoom(image=rgb, size=1000, zoom=400)'.
+
+    """
+    return '%s(%s)' % (name, ', '.join('%s=%s' % (k, params[k])
+                                      for k in sorted(params)))
+
+
+def run_benchmarks(pattern=None, sizes=None, repeat=5, min_time=0.05,
+                   log=sys.stderr):
+    """Run the registered benchmarks.
+
+    :param pattern: Regular expression that the benchmark id must contain
+        (see benchmark_id) for the benchmark to be run.
+    :type pattern: str | None
+
+    :param sizes: Image widths to use instead of SIZES.
+    :type sizes: sequence of int | None
+
+    :return: One result per benchmark and combination of parameters.
+    :rtype: list of dict
+
+    """
+    results = []
+    for name, setup, params in BENCHMARKS:
+        params = dict(params)
+        if sizes is not None and 'size' in params:
+            params['size'] = tuple(sizes)
+
+        keys = sorted(params)
+        for values in itertools.product(*[params[k] for k in keys]):
+            kwargs = dict(zip(keys, values))
+            bid = benchmark_id(name, kwargs)
+            if pattern is not None and not re.search(pattern, bid):
+                continue
+
+            number, times = time_function(setup(**kwargs), repeat, min_time)
+            result = {'id': bid, 'name': name, 'params': kwargs,
+                      'number': number, 'times': times,
+                      'min': min(times), 'median': float(np.median(times)),
+                      'mean': float(np.mean(times)),
+                      'stdev': float(np.std(times))}
+            results.append(result)
+            if log is not None:
+                print('%-60s %10.3f ms' % (bid, result['median']*1e3),
+                      file=log)
+
+    return results
+
+
+def machine_info():
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count() if hasattr(os, 'cpu_count') else None,
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'opencv_threads': cv2.getNumThreads()}
+
+
+def compare(results, baseline, tolerance=0.25):
+    """Return the benchmarks whose median time exceeds that of the same
+    benchmark in 'baseline' by more than the fraction 'tolerance'.
+
+    :return: Benchmark id, baseline median time, and median time of each
+        slower benchmark.
+    :rtype: list of (str, float, float)
+
+    """
+    baseline = dict((r['id'], r['median']) for r in baseline['benchmarks'])
+    regressions = []
+    for r in results['benchmarks']:
+        t0 = baseline.get(r['id'])
+        if t0 is not None and r['median'] > t0*(1 + tolerance):
+            regressions.append((r['id'], t0, r['median']))
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0],
+                                     formatter_class=argparse.
+                                     RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--output', help='Write the results as JSON to '
+                        'this file ("-" for stdout).')
+    parser.add_argument('-k', '--filter', dest='pattern',
+                        help='Only run benchmarks whose id matches this '
+                        'regular expression, e.g., "warp_zoom.*size=4000".')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        help='Image widths (default: %s).' %
+                        ' '.join(str(s) for s in SIZES))
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of samples per benchmark.')
+    parser.add_argument('--min-time', type=float, default=0.05,
+                        help='Minimum duration of a sample in seconds.')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='JSON results of a previous run. Exits with '
+                        'status 1 if any benchmark became slower.')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Fraction by which a benchmark may be slower '
+                        'than the baseline.')
+    args = parser.parse_args(argv)
+
+    try:
+        results = {'machine': machine_info(),
+                   'benchmarks': run_benchmarks(args.pattern, args.sizes,
+                                                args.repeat, args.min_time)}
+    finally:
+        for d in _tempdirs:
+            shutil.rmtree(d, ignore_errors=True)
+
+    if args.output == '-':
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+    elif args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        regressions = compare(results, baseline, args.tolerance)
+        for bid, t0, t1 in regressions:
+            print('Slower: %s %.3f ms -> %.3f ms' % (bid, t0*1e3, t1*1e3),
+                  file=sys.stderr)
+
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
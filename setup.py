@@ -46,6 +46,9 @@ setup(name='keypointgui',
         'opencv-python',
         'wxpython',
         'transformations'
-    ]
+    ],
+      extras_require={
+        'tiff': ['tifffile']
+    }
 
      )